@@ -10,15 +10,49 @@ python create_dataset.py -inventory ./test_big/cat_dog_dir_test.json \
 -split_percent 0.7 0.15 0.15 \
 -overwrite
 
+Retry records whose images could not be read (e.g. after fixing a mount),
+only the dropped records are written to additional files:
+--------------
+python create_dataset.py -inventory ./test_big/cat_dog_dir_test.json \
+-output_dir ./test_big/cats_vs_dogs/tfr_files/ \
+-image_save_side_max 200 \
+-split_percent 0.7 0.15 0.15 \
+-retry_failed
+
+Store images only as large as needed to train a specific model:
+--------------
+python create_dataset.py -inventory ./test_big/cat_dog_dir_test.json \
+-output_dir ./test_big/cats_vs_dogs/tfr_files/ \
+-storage_profile_model ResNet18 \
+-split_percent 0.7 0.15 0.15 \
+-overwrite
+
+Store only the data needed for training in flat records (the remaining
+data of each record is written to a '.meta.jsonl' file next to each file):
+--------------
+python create_dataset.py -inventory ./test_big/cat_dog_dir_test.json \
+-output_dir ./test_big/cats_vs_dogs/tfr_files/ \
+-record_format flat_example \
+-split_percent 0.7 0.15 0.15 \
+-overwrite
+
 """
 import argparse
 import logging
 
+from config.config import ConfigLoader
 from config.config_logging import setup_logging
-from data.inventory import DatasetInventoryMaster
+from data.inventory import DatasetInventoryMaster, export_splits_to_tfrecord
 from data.writer import DatasetWriter
-from data.tfr_encoder_decoder import DefaultTFRecordEncoderDecoder
+from data.tfr_encoder_decoder import (
+    create_tfr_encoder_decoder, RECORD_FORMATS, SEQUENCE_EXAMPLE_FORMAT,
+    LABEL_MAPPING_FILE_NAME)
 from data.image import resize_jpeg
+from data.image_cache import ImageCache
+from data.storage_profile import create_storage_profile
+from data.remote import is_remote_path
+from data.dedup import (
+    ImageHashIndex, write_duplicate_report, DUPLICATE_REPORT_FILE_NAME)
 
 # Configure Logging
 setup_logging()
@@ -82,8 +116,18 @@ if __name__ == '__main__':
                               supported in model training")
     parser.add_argument("-image_root_path", type=str, default=None,
                         help='Root path of all images - will be appended to\
-                              the image paths stored in the dataset inventory',
+                              the image paths stored in the dataset inventory,\
+                              can be an http(s) url of an image server',
                         required=False)
+    parser.add_argument("-remote_max_connections", type=int, default=16,
+                        required=False,
+                        help="if image_root_path is an url - max number of \
+                              simultaneous connections to the image server \
+                              (default 16)")
+    parser.add_argument("-remote_max_retries", type=int, default=3,
+                        required=False,
+                        help="if image_root_path is an url - how often a \
+                              failed request is retried (default 3)")
     parser.add_argument("-image_save_side_max", type=int,
                         default=500,
                         required=False,
@@ -91,26 +135,110 @@ if __name__ == '__main__':
                               the larger side of each image has that\
                               many pixels, typically at least 330\
                               (depending on the model architecture)")
+    parser.add_argument("-storage_profile_model", type=str, default=None,
+                        required=False,
+                        help="store images at the smallest size that is \
+                              needed by this model (see config/models.yaml) \
+                              instead of using image_save_side_max, e.g. \
+                              ResNet18")
+    parser.add_argument("-storage_profile_ignore_aspect_ratio", default=False,
+                        action='store_true', required=False,
+                        help="if storage_profile_model is specified - store \
+                              images large enough for training with \
+                              -ignore_aspect_ratio")
+    parser.add_argument("-record_format", type=str,
+                        default=SEQUENCE_EXAMPLE_FORMAT,
+                        choices=sorted(RECORD_FORMATS.keys()),
+                        required=False,
+                        help="format of the records: sequence_example stores \
+                              all data of a record, flat_example only the \
+                              images, numeric labels and image sizes (faster \
+                              to read, the remaining data is written to \
+                              metadata files next to the TFRecord files)")
+    parser.add_argument("-jpeg_passthrough", default=False,
+                        action='store_true', required=False,
+                        help="store JPEGs that are not larger than \
+                              image_save_side_max as they are, instead of \
+                              decoding and re-encoding them")
     parser.add_argument("-overwrite", default=False,
                         action='store_true', required=False,
-                        help="whether to overwrite existing tfr files")
+                        help="whether to overwrite existing tfr files, \
+                              otherwise only files that are missing or \
+                              incomplete according to the dataset manifest \
+                              are (re-)written (resume an aborted run)")
+    parser.add_argument("-retry_failed", default=False,
+                        action='store_true', required=False,
+                        help="only process the records that were dropped \
+                              because none of their images could be read \
+                              (see failed_images.jsonl in the output_dir) \
+                              and write them to additional files, existing \
+                              files are not changed")
     parser.add_argument("-write_tfr_in_parallel", default=False,
                         action='store_true', required=False,
-                        help="whether to write tfrecords in parallel if more \
-                              than one is created (preferably use \
-                              'process_images_in_parallel')")
+                        help="deprecated - same as \
+                              'process_images_in_parallel'")
     parser.add_argument("-process_images_in_parallel", default=False,
                         action='store_true', required=False,
-                        help="whether to process images in parallel \
-                              (only if 'write_tfr_in_parallel' is false)")
+                        help="whether to process images in parallel, all \
+                              files of all splits are written through one \
+                              shared pool of worker processes")
     parser.add_argument("-process_images_in_parallel_size", type=int,
                         default=320, required=False,
-                        help="if processing images in parallel - how many per \
-                              process, this can influene memory requirements")
+                        help="if processing images in parallel - how many \
+                              records are in flight in the worker pool at \
+                              any time, this can influene memory requirements")
     parser.add_argument("-processes_images_in_parallel_n_processes", type=int,
                         default=4, required=False,
                         help="if processing images in parallel - how many \
                               processes to use (default 4)")
+    parser.add_argument("-write_queue_size", type=int,
+                        default=1000, required=False,
+                        help="max number of serialized records waiting to \
+                              be written to disk (default 1000)")
+    parser.add_argument("-compression_type", type=str,
+                        default=None, required=False,
+                        choices=['GZIP', 'ZLIB'],
+                        help="write compressed TFRecord files, the \
+                              compression is detected when reading \
+                              (default None)")
+    parser.add_argument("-stats_report_interval", type=int,
+                        default=60, required=False,
+                        help="write timings of all stages and the \
+                              throughput to dataset_stats.json in the \
+                              output_dir every n seconds (default 60)")
+    parser.add_argument("-image_cache_dir", type=str, default=None,
+                        required=False,
+                        help="directory of an on-disk cache of resized \
+                              images, re-creating a dataset (e.g. with \
+                              different splits) re-uses the cached images \
+                              instead of resizing them again")
+    parser.add_argument("-image_cache_max_gb", type=float, default=50,
+                        required=False,
+                        help="max size of the image cache in GB, least \
+                              recently used images are removed first \
+                              (default 50)")
+    parser.add_argument("-dedup", type=str, default=None,
+                        required=False, choices=['remove', 'group', 'flag'],
+                        help="find records with identical images: 'remove' \
+                              keeps only one record of each group of \
+                              duplicates, 'group' assigns them to the same \
+                              split, 'flag' only reports them (in \
+                              duplicates.json in the output_dir), requires \
+                              local images (not an url as image_root_path)")
+    parser.add_argument("-dedup_perceptual", default=False,
+                        action='store_true', required=False,
+                        help="also find similar images (e.g. frames of a \
+                              burst) with a perceptual hash")
+    parser.add_argument("-dedup_max_distance", type=int, default=4,
+                        required=False,
+                        help="max number of different bits of the 64 bit \
+                              perceptual hashes of similar images \
+                              (default 4)")
+    parser.add_argument("-dedup_index_path", type=str, default=None,
+                        required=False,
+                        help="path of the sqlite index of image hashes, \
+                              re-used by repeated runs (default: \
+                              image_hashes.sqlite in output_dir)")
     parser.add_argument("-max_records_per_file", type=int,
                         default=5000,
                         required=False,
@@ -118,10 +246,27 @@ if __name__ == '__main__':
                              Multiple files are generated if the size of\
                              the dataset exceeds this value. It is recommended\
                              to use large values (default 5000)")
+    parser.add_argument("-stratify_files_by_label", nargs='+', type=str,
+                        default=None, required=False,
+                        help="spread each value of these labels evenly \
+                              over the TFRecord files of a split, e.g. \
+                              species - allows for smaller shuffle buffers \
+                              during model training (default None)")
+    parser.add_argument("-max_mb_per_file", type=float,
+                        default=None,
+                        required=False,
+                        help="The max size of a TFRecord file in MB. If \
+                              specified, files are split by size instead of \
+                              -max_records_per_file, e.g. 200 for files \
+                              of about 200 MB (default None)")
 
     # Parse command line arguments
     args = vars(parser.parse_args())
 
+    if args['dedup'] is not None and is_remote_path(args['image_root_path']):
+        raise ValueError("-dedup requires local images - image_root_path %s \
+                          is an url" % args['image_root_path'])
+
     # Configure Logging
     if args['log_outdir'] is None:
         args['log_outdir'] = args['output_dir']
@@ -163,6 +308,24 @@ if __name__ == '__main__':
             label_name_list=args['keep_label_name'],
             label_value_list=args['keep_label_value'])
 
+    # Find duplicates
+    if args['dedup'] is not None:
+        if args['dedup_index_path'] is None:
+            args['dedup_index_path'] = \
+                args['output_dir'] + 'image_hashes.sqlite'
+        hash_index = ImageHashIndex(args['dedup_index_path'])
+        duplicate_groups = dinv.find_duplicates(
+            hash_index,
+            image_root_path=args['image_root_path'],
+            perceptual=args['dedup_perceptual'],
+            max_hamming_distance=args['dedup_max_distance'],
+            n_processes=args['processes_images_in_parallel_n_processes'])
+        hash_index.close()
+        if args['dedup'] == 'remove':
+            dinv.remove_duplicates(duplicate_groups)
+        elif args['dedup'] == 'group':
+            dinv.group_duplicates(duplicate_groups)
+
     # Log Statistics
     dinv.log_stats()
 
@@ -205,35 +368,81 @@ if __name__ == '__main__':
         logging.debug("Stats for Split %s" % split_name)
         split_data.log_stats(debug_only=True)
 
+    # Report duplicates and their splits
+    if args['dedup'] is not None:
+        record_to_split = {
+            record_id: split_name
+            for split_name, split_data in splitted.items()
+            for record_id in split_data.get_all_record_ids()}
+        write_duplicate_report(
+            args['output_dir'] + DUPLICATE_REPORT_FILE_NAME,
+            duplicate_groups, record_to_split)
+
     # Write Label Mappings
-    out_label_mapping = args['output_dir'] + 'label_mapping.json'
+    out_label_mapping = args['output_dir'] + LABEL_MAPPING_FILE_NAME
     dinv.export_label_mapping(out_label_mapping)
 
+    # Cache of resized images
+    if args['image_cache_dir'] is not None:
+        image_cache = ImageCache(
+            args['image_cache_dir'],
+            max_size_bytes=int(args['image_cache_max_gb'] * 2**30))
+    else:
+        image_cache = None
+
+    if args['max_mb_per_file'] is None:
+        max_bytes_per_file = None
+    else:
+        max_bytes_per_file = int(args['max_mb_per_file'] * 2**20)
+
+    # Size of the stored images
+    if args['storage_profile_model'] is not None:
+        model_cfg = ConfigLoader('./config/models.yaml')
+        assert args['storage_profile_model'] in model_cfg.cfg['models'], \
+            "model %s not found in config/models.yaml" % \
+            args['storage_profile_model']
+        model_image_processing = model_cfg.cfg['models'][
+            args['storage_profile_model']]['image_processing']
+        storage_profile = create_storage_profile(
+            args['storage_profile_model'], model_image_processing,
+            args['storage_profile_ignore_aspect_ratio'])
+        image_pre_processing_args = {'min_side': storage_profile['min_side']}
+        logging.info("Storing images with a smaller side of %s pixels" %
+                     storage_profile['min_side'])
+    else:
+        storage_profile = {'max_side': args['image_save_side_max']}
+        image_pre_processing_args = {'max_side': args['image_save_side_max']}
+
     # Write TFrecord files
-    tfr_encoder_decoder = DefaultTFRecordEncoderDecoder()
-    tfr_writer = DatasetWriter(tfr_encoder_decoder.encode_record)
+    tfr_encoder_decoder = create_tfr_encoder_decoder(args['record_format'])
+    tfr_writer = DatasetWriter(tfr_encoder_decoder.encode_record,
+                               tfr_encoder_decoder.record_format)
 
-    counter = 0
-    n_splits = len(splitted.keys())
-    for split_name, split_data in splitted.items():
-        counter += 1
-        logging.info("Starting to process %s (%s / %s)" %
-                     (split_name, counter, n_splits))
-        out_name = args['output_dir'] + split_name + '.tfrecord'
-        split_data.export_to_tfrecord(
-            tfr_writer,
-            args['output_dir'],
-            file_prefix=split_name,
-            image_root_path=args['image_root_path'],
-            image_pre_processing_fun=resize_jpeg,
-            image_pre_processing_args={"max_side":
-                                       args['image_save_side_max']},
-            random_shuffle_before_save=True,
-            overwrite_existing_files=args['overwrite'],
-            max_records_per_file=args['max_records_per_file'],
-            write_tfr_in_parallel=args['write_tfr_in_parallel'],
-            process_images_in_parallel=args['process_images_in_parallel'],
-            process_images_in_parallel_size=args['process_images_in_parallel_size'],
-            processes_images_in_parallel_n_processes=args['processes_images_in_parallel_n_processes']
-            )
+    logging.info("Starting to write splits: %s" % list(splitted.keys()))
+    export_splits_to_tfrecord(
+        splitted,
+        tfr_writer,
+        args['output_dir'],
+        image_root_path=args['image_root_path'],
+        image_pre_processing_fun=resize_jpeg,
+        image_pre_processing_args=image_pre_processing_args,
+        random_shuffle_before_save=True,
+        overwrite_existing_files=args['overwrite'],
+        max_records_per_file=args['max_records_per_file'],
+        max_bytes_per_file=max_bytes_per_file,
+        write_tfr_in_parallel=args['write_tfr_in_parallel'],
+        process_images_in_parallel=args['process_images_in_parallel'],
+        process_images_in_parallel_size=args['process_images_in_parallel_size'],
+        processes_images_in_parallel_n_processes=args['processes_images_in_parallel_n_processes'],
+        write_queue_size=args['write_queue_size'],
+        image_cache=image_cache,
+        jpeg_passthrough=args['jpeg_passthrough'],
+        stats_report_interval=args['stats_report_interval'],
+        compression_type=args['compression_type'],
+        retry_failed_records=args['retry_failed'],
+        remote_max_connections=args['remote_max_connections'],
+        remote_max_retries=args['remote_max_retries'],
+        storage_profile=storage_profile,
+        stratify_by_labels=args['stratify_files_by_label']
+        )
     logging.info("Finished writing TFRecords")
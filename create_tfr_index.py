@@ -0,0 +1,76 @@
+""" Create Record Offset Indexes of existing TFRecord Files
+
+Creates a sidecar index ('<file>.tfrecord.index') for each TFRecord file
+that maps record ids to their offsets - this allows to read single records
+by id (see data/tfr_index.py). Files written by create_dataset.py already
+have an index.
+
+Example Usage:
+--------------
+python create_tfr_index.py -tfr_dir ./test_big/cats_vs_dogs/tfr_files/ \
+-n_processes 4
+
+Read a single record:
+--------------
+python create_tfr_index.py -tfr_dir ./test_big/cats_vs_dogs/tfr_files/ \
+-show_record_id 123
+"""
+import os
+import argparse
+import logging
+
+from config.config_logging import setup_logging
+from data.utils import find_tfr_files_pattern_subdir
+from data.tfr_index import (
+    create_indexes_parallel, index_path, IndexedTFRecordReader)
+
+# Configure Logging
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(prog='CREATE TFRECORD INDEX')
+    parser.add_argument("-tfr_dir", type=str, required=True,
+                        help="Directory with TFRecord files (including \
+                              sub-directories)")
+    parser.add_argument("-n_processes", type=int, default=4,
+                        required=False,
+                        help="number of files to scan in parallel \
+                              (default 4)")
+    parser.add_argument("-overwrite", default=False,
+                        action='store_true', required=False,
+                        help="re-create existing indexes")
+    parser.add_argument("-show_record_id", type=str, nargs='+',
+                        default=None, required=False,
+                        help="print the records with these ids")
+    args = vars(parser.parse_args())
+
+    tfr_files = find_tfr_files_pattern_subdir(args['tfr_dir'])
+
+    if args['overwrite']:
+        to_index = tfr_files
+    else:
+        to_index = [x for x in tfr_files if not os.path.exists(index_path(x))]
+
+    logger.info("Found %s TFRecord files - creating %s indexes" %
+                (len(tfr_files), len(to_index)))
+
+    n_records = create_indexes_parallel(to_index, args['n_processes'])
+
+    logger.info("Indexed %s records" % n_records)
+
+    if args['show_record_id'] is not None:
+        reader = IndexedTFRecordReader(tfr_files)
+        for record_id, record in zip(
+                args['show_record_id'],
+                reader.get_records(args['show_record_id'])):
+            print("Record %s" % record_id)
+            # print the records without their images
+            if hasattr(record, 'context'):
+                print(record.context)
+            else:
+                del record.features.feature['images']
+                print(record)
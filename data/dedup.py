@@ -0,0 +1,283 @@
+""" Find Exact and Perceptual Duplicate Images of a Dataset Inventory """
+import os
+import json
+import sqlite3
+import logging
+from hashlib import md5
+from multiprocessing import Pool
+
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_REPORT_FILE_NAME = 'duplicates.json'
+
+
+def file_md5_hex(path, block_size=2**20):
+    """ md5 of the raw bytes of a file """
+    hasher = md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def dhash(image_path, hash_size=8):
+    """ Difference hash of an image - 64 bit int for hash_size 8
+
+        The image is decoded at reduced size (JPEG draft mode), converted
+        to grayscale and resized to (hash_size+1, hash_size). Each bit
+        tells whether a pixel is brighter than its right neighbour.
+    """
+    with Image.open(image_path) as img:
+        img.draft('L', (4 * (hash_size + 1), 4 * hash_size))
+        img = img.convert('L').resize(
+            (hash_size + 1, hash_size), Image.BILINEAR)
+        pixels = list(img.getdata())
+    value = 0
+    for row in range(0, hash_size):
+        for col in range(0, hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | int(left > right)
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _hash_image(args):
+    """ Calculate the hashes of an image (in a worker process) """
+    path, perceptual = args
+    try:
+        stat = os.stat(path)
+        exact = file_md5_hex(path)
+        perceptual_hash = dhash(path) if perceptual else None
+    except Exception as e:
+        logger.debug("Failed to hash image %s, error %s" % (path, str(e)))
+        return path, None
+    return path, (stat.st_mtime_ns, stat.st_size, exact, perceptual_hash)
+
+
+class ImageHashIndex(object):
+    """ Persistent (sqlite) index of image hashes
+
+        Hashes are only re-calculated if the modification time or size of
+        an image changes, hence repeated dataset builds are fast.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS image_hashes ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, "
+            "md5 TEXT, dhash TEXT)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def _lookup(self, paths):
+        """ Get cached hashes that are still valid {path: (md5, dhash)} """
+        cached = dict()
+        for path in paths:
+            row = self.connection.execute(
+                "SELECT mtime_ns, size, md5, dhash FROM image_hashes "
+                "WHERE path = ?", (path, )).fetchone()
+            if row is None:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (stat.st_mtime_ns, stat.st_size) != (row[0], row[1]):
+                continue
+            cached[path] = (row[2], None if row[3] is None
+                            else int(row[3], 16))
+        return cached
+
+    def get_hashes(self, paths, perceptual=False, n_processes=4):
+        """ Get the hashes of all images, calculate missing ones in
+            parallel
+            Returns: {path: (md5, dhash)}, dhash is None if not
+            'perceptual', unreadable images are missing
+        """
+        paths = sorted(set(paths))
+        hashes = self._lookup(paths)
+        to_hash = [x for x in paths if x not in hashes or
+                   (perceptual and hashes[x][1] is None)]
+
+        logger.info("Image hashes - cached: %s to calculate: %s" %
+                    (len(paths) - len(to_hash), len(to_hash)))
+
+        tasks = [(x, perceptual) for x in to_hash]
+        if n_processes > 1 and len(tasks) > 0:
+            pool = Pool(processes=n_processes)
+            results = pool.imap_unordered(_hash_image, tasks, chunksize=64)
+        else:
+            pool = None
+            results = map(_hash_image, tasks)
+
+        n_failed = 0
+        for path, result in results:
+            if result is None:
+                n_failed += 1
+                continue
+            mtime_ns, size, exact, perceptual_hash = result
+            perceptual_hex = None if perceptual_hash is None \
+                else '%016x' % perceptual_hash
+            self.connection.execute(
+                "INSERT OR REPLACE INTO image_hashes VALUES (?, ?, ?, ?, ?)",
+                (path, mtime_ns, size, exact, perceptual_hex))
+            hashes[path] = (exact, perceptual_hash)
+        self.connection.commit()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if n_failed > 0:
+            logger.warning("Failed to hash %s images" % n_failed)
+        return hashes
+
+
+class _UnionFind(object):
+    """ Disjoint sets of record ids """
+    def __init__(self):
+        self.parent = dict()
+
+    def find(self, x):
+        self.parent.setdefault(x, x)
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            # smaller id becomes the root - deterministic groups
+            if root_b < root_a:
+                root_a, root_b = root_b, root_a
+            self.parent[root_b] = root_a
+
+    def groups(self):
+        groups = dict()
+        for x in self.parent.keys():
+            groups.setdefault(self.find(x), list()).append(x)
+        return [sorted(x) for x in groups.values() if len(x) > 1]
+
+
+def _near_duplicate_pairs(perceptual_hashes, max_distance, n_bits=64):
+    """ Find all pairs of hashes within 'max_distance' bits
+
+        Multi-index search: each hash is split into max_distance + 1
+        bands, two hashes within max_distance bits have at least one
+        identical band (pigeonhole), hence only hashes that share a band
+        are compared.
+    """
+    n_bands = max_distance + 1
+    band_bits = [n_bits // n_bands + (1 if i < n_bits % n_bands else 0)
+                 for i in range(0, n_bands)]
+    buckets = dict()
+    for key, value in perceptual_hashes.items():
+        shift = 0
+        for band, bits in enumerate(band_bits):
+            band_value = (value >> shift) & ((1 << bits) - 1)
+            buckets.setdefault((band, band_value), list()).append(key)
+            shift += bits
+
+    pairs = set()
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        for i in range(0, len(members)):
+            for j in range(i + 1, len(members)):
+                a, b = members[i], members[j]
+                if (a, b) in pairs or (b, a) in pairs:
+                    continue
+                if hamming_distance(perceptual_hashes[a],
+                                    perceptual_hashes[b]) <= max_distance:
+                    pairs.add((a, b))
+    return pairs
+
+
+def find_duplicate_groups(record_images, image_hashes,
+                          max_hamming_distance=None):
+    """ Group records that share an identical image or, if
+        'max_hamming_distance' is specified, a perceptually similar image
+
+        record_images: {record_id: [image_path, ...]}
+        image_hashes: {image_path: (md5, dhash)}
+        Returns: list of groups [{'record_ids': [...], 'type': 'exact'}]
+    """
+    exact = _UnionFind()
+    first_record_of_hash = dict()
+    for record_id in sorted(record_images.keys()):
+        for image_path in record_images[record_id]:
+            if image_path not in image_hashes:
+                continue
+            exact_hash = image_hashes[image_path][0]
+            if exact_hash in first_record_of_hash:
+                exact.union(first_record_of_hash[exact_hash], record_id)
+            else:
+                first_record_of_hash[exact_hash] = record_id
+
+    groups = [{'record_ids': x, 'type': 'exact'} for x in exact.groups()]
+
+    if max_hamming_distance is None:
+        return groups
+
+    # one perceptual hash per distinct image
+    perceptual_hashes = dict()
+    image_to_records = dict()
+    for record_id, image_paths in record_images.items():
+        for image_path in image_paths:
+            if image_path not in image_hashes or \
+               image_hashes[image_path][1] is None:
+                continue
+            exact_hash, perceptual_hash = image_hashes[image_path]
+            perceptual_hashes[exact_hash] = perceptual_hash
+            image_to_records.setdefault(exact_hash, set()).add(record_id)
+
+    combined = _UnionFind()
+    for group in groups:
+        for record_id in group['record_ids'][1:]:
+            combined.union(group['record_ids'][0], record_id)
+    for a, b in _near_duplicate_pairs(perceptual_hashes,
+                                      max_hamming_distance):
+        for record_a in image_to_records[a]:
+            for record_b in image_to_records[b]:
+                combined.union(record_a, record_b)
+
+    exact_groups = set(tuple(x['record_ids']) for x in groups)
+    return [{'record_ids': x,
+             'type': 'exact' if tuple(x) in exact_groups else 'perceptual'}
+            for x in combined.groups()]
+
+
+def write_duplicate_report(path, groups, record_to_split=None):
+    """ Write duplicate groups (and their splits) to a json file """
+    n_cross_split = 0
+    report_groups = list()
+    for group in groups:
+        entry = dict(group)
+        if record_to_split is not None:
+            entry['splits'] = {x: record_to_split.get(x)
+                               for x in group['record_ids']}
+            if len(set(entry['splits'].values()) - {None}) > 1:
+                n_cross_split += 1
+        report_groups.append(entry)
+    report = {
+        'n_groups': len(groups),
+        'n_records_in_groups': sum([len(x['record_ids']) for x in groups]),
+        'n_groups_across_splits': n_cross_split,
+        'groups': report_groups}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if n_cross_split > 0:
+        logger.warning("%s duplicate groups span multiple splits - see %s" %
+                       (n_cross_split, path))
+    return report
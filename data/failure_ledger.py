@@ -0,0 +1,57 @@
+""" Ledger of Images that could not be processed when writing a Dataset
+
+One json line per failed image (or record):
+{"split": "train", "record_id": "123", "path": "/images/123.jpg",
+ "stage": "decode", "exception": "OSError", "message": "...",
+ "record_dropped": true}
+
+'stage' is the pipeline stage that failed (read, decode, resize, encode,
+serialize, ...). 'record_dropped' is true if the record was not written
+because none of its images could be processed - such records can be
+written later with DatasetWriter.encode_splits_to_tfr(...,
+retry_failed_records=True).
+"""
+import os
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+FAILURE_LEDGER_FILE_NAME = 'failed_images.jsonl'
+
+
+def failure_entry(path, exception, stage):
+    """ Ledger entry of an image (path) that failed in 'stage' """
+    return {
+        'path': path,
+        'stage': stage,
+        'exception': type(exception).__name__,
+        'message': str(exception)}
+
+
+def read_failure_ledger(path):
+    """ Read all entries of a ledger, returns [] if it does not exist """
+    if not os.path.exists(path):
+        return []
+    entries = list()
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                entries.append(json.loads(line))
+    return entries
+
+
+def write_failure_ledger(path, entries):
+    """ Write all entries of a ledger (atomically) """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+    os.replace(tmp_path, path)
+
+
+def dropped_record_ids(entries, split_name):
+    """ Ids of the records of a split that were not written """
+    return {x['record_id'] for x in entries
+            if x['split'] == split_name and x['record_dropped']}
@@ -5,11 +5,17 @@ from tensorflow.python.ops import control_flow_ops
 from PIL import Image
 import numpy as np
 import io
+import math
+
+from data.stats import NO_STATS
 
 # FLAGS
 cb_distortion_range = 0.05
 cr_distortion_range = 0.05
 
+# scales at which JPEGs can be decoded (in the DCT domain)
+JPEG_DECODE_RATIOS = [8, 4, 2]
+
 
 def resize_image(image, target_size):
     """ Resize Image """
@@ -266,6 +272,149 @@ def _aspect_preserving_resize(image, smallest_side):
     return resized_image
 
 
+def _random_resize_side(resize_side_min, resize_side_max,
+                        ignore_aspect_ratio):
+    """ Random resize side of preprocess_for_train """
+    if ignore_aspect_ratio:
+        # choose a wider range if apsect ratio is ignored
+        return tf.random_uniform(
+          [], minval=resize_side_min, maxval=int(1.2*resize_side_max)+1,
+          dtype=tf.int32)
+    return tf.random_uniform(
+      [], minval=resize_side_min, maxval=resize_side_max+1, dtype=tf.int32)
+
+
+def random_train_crop_window(height, width, output_height, output_width,
+                             resize_side_min, resize_side_max,
+                             ignore_aspect_ratio=False):
+    """Samples the region of an image that preprocess_for_train crops.
+    preprocess_for_train resizes the image such that its smaller side (or
+    both sides if the aspect ratio is ignored) has a random size and crops a
+    random window of the output size. The resize side and the window are
+    sampled the same way here and the window is mapped back to the image,
+    hence only that region has to be decoded (see decode_and_crop_for_train).
+    Args:
+    height: an int32 scalar tensor, the height of the image.
+    width: an int32 scalar tensor, the width of the image.
+    output_height: The height of the image after preprocessing.
+    output_width: The width of the image after preprocessing.
+    resize_side_min: The lower bound for the smallest side of the image for
+      aspect-preserving resizing.
+    resize_side_max: The upper bound for the smallest side of the image for
+      aspect-preserving resizing.
+    Returns:
+    an int32 tensor [offset_height, offset_width, crop_height, crop_width].
+    """
+    height = tf.to_int32(height)
+    width = tf.to_int32(width)
+    resize_side = _random_resize_side(resize_side_min, resize_side_max,
+                                      ignore_aspect_ratio)
+    if ignore_aspect_ratio:
+        new_height, new_width = resize_side, resize_side
+    else:
+        new_height, new_width = _smallest_size_at_least(
+            height, width, resize_side)
+
+    # offsets in the resized image (as tf.random_crop)
+    offset_height = tf.random_uniform(
+        [], maxval=new_height - output_height + 1, dtype=tf.int32)
+    offset_width = tf.random_uniform(
+        [], maxval=new_width - output_width + 1, dtype=tf.int32)
+
+    # map the window to the image
+    scale_height = tf.to_float(height) / tf.to_float(new_height)
+    scale_width = tf.to_float(width) / tf.to_float(new_width)
+    crop_height = tf.clip_by_value(
+        tf.to_int32(tf.rint(output_height * scale_height)), 1, height)
+    crop_width = tf.clip_by_value(
+        tf.to_int32(tf.rint(output_width * scale_width)), 1, width)
+    offset_height = tf.minimum(
+        tf.to_int32(tf.to_float(offset_height) * scale_height),
+        height - crop_height)
+    offset_width = tf.minimum(
+        tf.to_int32(tf.to_float(offset_width) * scale_width),
+        width - crop_width)
+    return tf.stack([offset_height, offset_width, crop_height, crop_width])
+
+
+def decode_and_crop_for_train(image_bytes, height, width,
+                              output_height, output_width,
+                              resize_side_min, resize_side_max,
+                              ignore_aspect_ratio=False,
+                              n_color_channels=3,
+                              ratio=1):
+    """Decodes only the region of a JPEG that preprocess_for_train crops.
+    The window is sampled with random_train_crop_window, decoded with the
+    fused decode-and-crop op and resized to the output size. The result is
+    pre-processed with preprocess_image(..., is_cropped=True).
+    Args:
+    image_bytes: a string tensor, the encoded JPEG.
+    height: a scalar tensor, the stored height of the JPEG.
+    width: a scalar tensor, the stored width of the JPEG.
+    ratio: decode the JPEG at 1/ratio scale (1, 2, 4 or 8), the window is
+      sampled on the scaled image with ceil(side / ratio) pixels.
+    Returns:
+    a float image of shape [output_height, output_width, n_color_channels].
+    """
+    height = (tf.to_int32(height) + ratio - 1) // ratio
+    width = (tf.to_int32(width) + ratio - 1) // ratio
+    crop_window = random_train_crop_window(
+        height, width, output_height, output_width,
+        resize_side_min, resize_side_max, ignore_aspect_ratio)
+    image = tf.image.decode_and_crop_jpeg(
+        image_bytes, crop_window, channels=n_color_channels, ratio=ratio)
+    image = tf.expand_dims(image, 0)
+    image = tf.image.resize_bilinear(image, [output_height, output_width],
+                                     align_corners=False)
+    image = tf.squeeze(image, [0])
+    image.set_shape([output_height, output_width, n_color_channels])
+    return image
+
+
+def decode_at_scale(smaller_side, min_side, decode_fun):
+    """Decodes a JPEG at the smallest scale that is still large enough.
+    A JPEG decoded at 1/ratio scale (in the DCT domain) has
+    ceil(side / ratio) pixels, the largest ratio for which the smaller side
+    still has at least min_side pixels is chosen.
+    Args:
+    smaller_side: a scalar tensor, the smaller side of the JPEG.
+    min_side: the number of pixels the smaller side needs at least.
+    decode_fun: a function that returns a function that decodes the JPEG at
+      1/ratio scale, i.e. decode_fun(ratio)() returns the image.
+    Returns:
+    the decoded image.
+    """
+    pred_fn_pairs = [
+        (tf.greater(smaller_side, (min_side - 1) * ratio), decode_fun(ratio))
+        for ratio in JPEG_DECODE_RATIOS]
+    return tf.case(pred_fn_pairs, default=decode_fun(1), exclusive=False)
+
+
+def decode_jpeg_scaled(image_bytes, min_side, n_color_channels=3,
+                       try_recover_truncated=False):
+    """Decodes a JPEG at 1/2, 1/4 or 1/8 scale if its smaller side still has
+    at least min_side pixels, the size is read from the JPEG header.
+    Other images (e.g. PNG) are decoded at full size with decode_jpeg.
+    Args:
+    image_bytes: a string tensor, the encoded JPEG.
+    min_side: the number of pixels the smaller side needs at least.
+    Returns:
+    the decoded image.
+    """
+    def decode_jpeg(ratio):
+        return lambda: tf.image.decode_jpeg(
+            image_bytes, channels=n_color_channels, ratio=ratio,
+            try_recover_truncated=try_recover_truncated)
+
+    def decode_scaled():
+        shape = tf.image.extract_jpeg_shape(image_bytes)
+        smaller_side = tf.minimum(shape[0], shape[1])
+        return decode_at_scale(smaller_side, min_side, decode_jpeg)
+
+    return tf.cond(tf.image.is_jpeg(image_bytes), decode_scaled,
+                   decode_jpeg(1))
+
+
 def preprocess_for_train(image,
                          output_height,
                          output_width,
@@ -274,7 +423,8 @@ def preprocess_for_train(image,
                          resize_side_min,
                          resize_side_max,
                          color_augmentation,
-                         ignore_aspect_ratio):
+                         ignore_aspect_ratio,
+                         is_cropped=False):
     """Preprocesses the given image for training.
     Note that the actual resizing scale is sampled from
     [`resize_size_min`, `resize_size_max`].
@@ -287,24 +437,24 @@ def preprocess_for_train(image,
     resize_side_max: The upper bound for the smallest side of the image for
       aspect-preserving resizing.
      color_augmentation: different options regarding color augmentation
+    is_cropped: whether the image was already resized and randomly cropped
+      to the output size (see decode_and_crop_for_train).
     Returns:
     A preprocessed image.
     """
 
-    if ignore_aspect_ratio:
-        # choose a wider range if apsect ratio is ignored
-        resize_side = tf.random_uniform(
-          [], minval=resize_side_min, maxval=int(1.2*resize_side_max)+1, dtype=tf.int32)
-        image = tf.expand_dims(image, 0)
-        image = tf.image.resize_bilinear(
-            image, size=[resize_side, resize_side])
-        image = tf.squeeze(image)
-        image.set_shape([None, None, 3])
-    else:
-        resize_side = tf.random_uniform(
-          [], minval=resize_side_min, maxval=resize_side_max+1, dtype=tf.int32)
-        image = _aspect_preserving_resize(image, resize_side)
-    image = tf.random_crop(image, [output_height, output_width, 3])
+    if not is_cropped:
+        resize_side = _random_resize_side(resize_side_min, resize_side_max,
+                                          ignore_aspect_ratio)
+        if ignore_aspect_ratio:
+            image = tf.expand_dims(image, 0)
+            image = tf.image.resize_bilinear(
+                image, size=[resize_side, resize_side])
+            image = tf.squeeze(image)
+            image.set_shape([None, None, 3])
+        else:
+            image = _aspect_preserving_resize(image, resize_side)
+        image = tf.random_crop(image, [output_height, output_width, 3])
     image = tf.to_float(image)
     image = tf.image.random_flip_left_right(image)
     image = tf.divide(image, tf.cast(255.0, tf.float32))
@@ -377,7 +527,8 @@ def preprocess_image(image, output_height, output_width,
                      image_means=[0, 0, 0],
                      image_stdevs=[1, 1, 1],
                      color_augmentation=None,
-                     ignore_aspect_ratio=False):
+                     ignore_aspect_ratio=False,
+                     is_cropped=False):
     """Preprocesses the given image.
     Args:
     image: A `Tensor` representing an image of arbitrary size.
@@ -392,6 +543,8 @@ def preprocess_image(image, output_height, output_width,
       aspect-preserving resizing. If `is_training` is `False`, this value is
       ignored. Otherwise, the resize side is sampled from
         [resize_size_min, resize_size_max].
+    is_cropped: whether the image was already resized and randomly cropped
+      for training (see decode_and_crop_for_train).
     Returns:
     A preprocessed image.
     """
@@ -401,7 +554,8 @@ def preprocess_image(image, output_height, output_width,
                                     image_means, image_stdevs,
                                     resize_side_min, resize_side_max,
                                     color_augmentation,
-                                    ignore_aspect_ratio)
+                                    ignore_aspect_ratio,
+                                    is_cropped)
     else:
         return preprocess_for_eval(image, output_height, output_width,
                                    image_means, image_stdevs,
@@ -409,25 +563,136 @@ def preprocess_image(image, output_height, output_width,
                                    ignore_aspect_ratio)
 
 
-def resize_jpeg(image,  max_side):
+def _as_file(image):
+    """ Image path or file-like object of image bytes """
+    if isinstance(image, bytes):
+        return io.BytesIO(image)
+    return image
+
+
+def is_jpeg_within_size(image, max_side=None, min_side=None):
+    """ Check whether an image is a JPEG that can be stored as is, i.e.
+        without resizing it to 'max_side' (or 'min_side', the smaller
+        side) - only the header is read
+    """
+    with Image.open(_as_file(image)) as img:
+        if img.format != 'JPEG' or img.mode not in ('RGB', 'L'):
+            return False
+        if min_side is not None:
+            return min(img.size) <= min_side
+        if max_side is None:
+            return True
+        return max(img.size) <= max_side
+
+
+def image_dimensions(image):
+    """ Height, width and number of channels of an image (path or bytes),
+        only the header is read
+    """
+    with Image.open(_as_file(image)) as img:
+        width, height = img.size
+        return height, width, len(img.getbands())
+
+
+def read_image_bytes(image):
+    """ Read the original bytes of an image (path or bytes, e.g. fetched
+        from a remote source)
+    """
+    if isinstance(image, bytes):
+        return image
+    with open(image, 'rb') as f:
+        return f.read()
+
+
+def _thumbnail_size(size, max_side):
+    """ Size of an image after aspect preserving resizing such that the
+        larger side has at most max_side pixels
+    """
+    width, height = size
+    scale = min(max_side / max(width, height), 1.0)
+    return (max(int(math.ceil(width * scale)), 1),
+            max(int(math.ceil(height * scale)), 1))
+
+
+def _min_side_size(size, min_side):
+    """ Size of an image after aspect preserving resizing such that the
+        smaller side has min_side pixels (images are not enlarged)
+    """
+    width, height = size
+    scale = min_side / min(width, height)
+    if scale >= 1.0:
+        return size
+    # the smaller side is exactly min_side, the larger is rounded up
+    if width <= height:
+        return (min_side, max(int(math.ceil(height * scale)), min_side))
+    return (max(int(math.ceil(width * scale)), min_side), min_side)
+
+
+def _read_and_open(image, stats):
+    """ Read an image from disk and open it (without decoding) """
+    with stats.time('read'):
+        raw_bytes = read_image_bytes(image)
+    stats.count('bytes_read', len(raw_bytes))
+    with stats.time('open'):
+        return Image.open(io.BytesIO(raw_bytes))
+
+
+def _encode_jpeg(img, stats):
+    """ Encode an image as JPEG bytes """
+    with stats.time('encode'):
+        b = io.BytesIO()
+        img.save(b, 'JPEG')
+        return b.getvalue()
+
+
+def resize_jpeg(image,  max_side=None, passthrough=False, reduced_decode=True,
+                stats=NO_STATS, min_side=None):
     """ Take Raw JPEG resize with aspect ratio preservation
          and return bytes
+        max_side: max number of pixels of the larger side
+        min_side: resize such that the smaller side has that many pixels
+         instead of using max_side (see data/storage_profile.py)
+        passthrough: return the original bytes if the image is a JPEG
+         that is not larger than max_side / min_side (no re-encoding)
+        reduced_decode: decode JPEGs at 1/2, 1/4 or 1/8 scale (in the DCT
+         domain) if that still exceeds the target size, the final resize
+         is done with a high-quality filter
+        stats: PipelineStats to record the time of the read, decode,
+         resize and encode stages
+    """
+    if passthrough and is_jpeg_within_size(image, max_side, min_side):
+        return read_image_bytes(image)
+    img = _read_and_open(image, stats)
+    with stats.time('decode'):
+        if reduced_decode and img.format == 'JPEG':
+            if min_side is not None:
+                target_size = _min_side_size(img.size, min_side)
+            else:
+                target_size = _thumbnail_size(img.size, max_side)
+            img.draft(img.mode, target_size)
+        img.load()
+    with stats.time('resize'):
+        if min_side is not None:
+            target_size = _min_side_size(img.size, min_side)
+            if target_size != img.size:
+                img = img.resize(target_size, Image.LANCZOS)
+        else:
+            img.thumbnail([max_side, max_side], Image.ANTIALIAS)
+    return _encode_jpeg(img, stats)
+
+
+def read_jpeg(image, passthrough=False, stats=NO_STATS):
+    """ Reads jpeg and returns Bytes
+        passthrough: return the original bytes if the image is a JPEG
+        stats: PipelineStats to record the time of the read, decode
+         and encode stages
     """
-    img = Image.open(image)
-    img.thumbnail([max_side, max_side], Image.ANTIALIAS)
-    b = io.BytesIO()
-    img.save(b, 'JPEG')
-    image_bytes = b.getvalue()
-    return image_bytes
-
-
-def read_jpeg(image):
-    """ Reads jpeg and returns Bytes """
-    img = Image.open(image)
-    b = io.BytesIO()
-    img.save(b, 'JPEG')
-    image_bytes = b.getvalue()
-    return image_bytes
+    if passthrough and is_jpeg_within_size(image):
+        return read_image_bytes(image)
+    img = _read_and_open(image, stats)
+    with stats.time('decode'):
+        img.load()
+    return _encode_jpeg(img, stats)
 
 
 # https://github.com/tensorflow/tpu/blob/master/models/experimental/inception/
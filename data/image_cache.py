@@ -0,0 +1,134 @@
+""" On-disk Cache of processed (e.g. resized) Image Bytes """
+import os
+import json
+import logging
+from hashlib import md5
+
+from data.remote import is_remote_path
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache(object):
+    """ Content-addressed on-disk cache of processed image bytes
+
+        Keys are derived from the source path, its modification time and
+        size, and the processing parameters (e.g. 'max_side'). Entries are
+        evicted least-recently-used first once the cache exceeds
+        'max_size_bytes'. The cache can be shared by multiple processes.
+
+        The size is checked by the process that owns the cache object. Worker
+        processes add entries with 'put(..., check_size=False)' and the owner
+        accounts for them with 'add_written', as the counter of a copy of the
+        cache in a worker process is lost.
+    """
+    def __init__(self, cache_dir, max_size_bytes=50 * 2**30,
+                 evict_to_fraction=0.9):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.evict_to_fraction = evict_to_fraction
+        # check the size of the cache after this many new bytes
+        self._evict_check_bytes = max(int(max_size_bytes * 0.05), 1)
+        self._bytes_since_check = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, image_path, params):
+        """ Create the cache key of an image processed with 'params',
+            images of remote sources (urls) are assumed to not change
+        """
+        if is_remote_path(image_path):
+            to_hash = json.dumps([image_path, params], sort_keys=True)
+            return md5(to_hash.encode('utf-8')).hexdigest()
+        stat = os.stat(image_path)
+        to_hash = json.dumps(
+            [os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size,
+             params], sort_keys=True)
+        return md5(to_hash.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.jpg')
+
+    def contains(self, key):
+        """ Check whether an entry exists """
+        return os.path.exists(self._entry_path(key))
+
+    def get(self, key):
+        """ Return cached bytes or None """
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'rb') as f:
+                image_bytes = f.read()
+        except FileNotFoundError:
+            return None
+        self.touch(key)
+        return image_bytes
+
+    def touch(self, key):
+        """ Mark an entry as recently used, returns whether it exists """
+        try:
+            os.utime(self._entry_path(key), None)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, image_bytes, check_size=True):
+        """ Add an entry to the cache """
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = '%s.%s.tmp' % (entry_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, entry_path)
+        if check_size:
+            self.add_written(len(image_bytes))
+
+    def add_written(self, n_bytes):
+        """ Account for 'n_bytes' added to the cache, checks the size of the
+            cache once enough new bytes were added
+        """
+        self._bytes_since_check += n_bytes
+        if self._bytes_since_check >= self._evict_check_bytes:
+            self.evict()
+
+    def _list_entries(self):
+        """ List (mtime, size, path) of all entries """
+        entries = list()
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if not entry.name.endswith('.jpg'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        """ Total size of all entries in bytes """
+        return sum(x[1] for x in self._list_entries())
+
+    def evict(self):
+        """ Remove least recently used entries if the cache is too large """
+        self._bytes_since_check = 0
+        entries = self._list_entries()
+        total_size = sum(x[1] for x in entries)
+        if total_size <= self.max_size_bytes:
+            return
+        target_size = self.max_size_bytes * self.evict_to_fraction
+        entries.sort()
+        n_removed = 0
+        for _mtime, entry_size, entry_path in entries:
+            if total_size <= target_size:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_size -= entry_size
+            n_removed += 1
+        logger.debug("Evicted %s entries from image cache %s" %
+                     (n_removed, self.cache_dir))
@@ -0,0 +1,196 @@
+""" Size Distributions of the Images stored in TFRecord Files
+
+The sizes are read from the per-image features stored by the writer
+('image_heights', 'image_widths', ...), for older files without them only
+the JPEG headers are read - no image is decoded.
+"""
+import logging
+from collections import Counter
+from multiprocessing import Pool
+
+import tensorflow as tf
+
+from data.image import image_dimensions
+from data.tfr_index import iterate_records
+from data.tfr_encoder_decoder import (
+    IMAGE_SIZE_FEATURES, SEQUENCE_EXAMPLE_FORMAT, FLAT_EXAMPLE_FORMAT,
+    record_format_of_tfr_files)
+
+
+logger = logging.getLogger(__name__)
+
+
+class ValueDistribution(object):
+    """ Distribution of integer values (e.g. pixels), stores the count of
+        each distinct value - distributions can be merged
+    """
+    def __init__(self):
+        self.counts = Counter()
+
+    def add(self, value):
+        """ Add a value """
+        self.counts[value] += 1
+
+    def merge(self, other):
+        """ Add all values of another distribution """
+        self.counts.update(other.counts)
+
+    @property
+    def count(self):
+        return sum(self.counts.values())
+
+    def quantile(self, q):
+        """ Smallest value with at least q of all values below or equal """
+        if len(self.counts) == 0:
+            return None
+        threshold = q * self.count
+        cumulative = 0
+        for value in sorted(self.counts.keys()):
+            cumulative += self.counts[value]
+            if cumulative >= threshold:
+                return value
+        return max(self.counts.keys())
+
+    def n_below(self, value):
+        """ Number of values smaller than 'value' """
+        return sum([v for k, v in self.counts.items() if k < value])
+
+    def to_dict(self):
+        """ Summary with quantiles """
+        count = self.count
+        if count == 0:
+            return {'count': 0}
+        total = sum([k * v for k, v in self.counts.items()])
+        return {
+            'count': count,
+            'min': min(self.counts.keys()),
+            'max': max(self.counts.keys()),
+            'mean': round(total / count, 1),
+            'p01': self.quantile(0.01),
+            'p10': self.quantile(0.1),
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)}
+
+
+def image_sizes_of_record(serialized_record,
+                          record_format=SEQUENCE_EXAMPLE_FORMAT):
+    """ Sizes of the images of a serialized record in 'record_format',
+        returns a list of (height, width, n_channels, n_bytes) and whether
+        the sizes were stored in the record
+    """
+    if record_format == FLAT_EXAMPLE_FORMAT:
+        features = tf.train.Example.FromString(
+            serialized_record).features.feature
+        if all([k in features for k in IMAGE_SIZE_FEATURES]):
+            columns = [features[k].int64_list.value
+                       for k in IMAGE_SIZE_FEATURES]
+            return list(zip(*columns)), True
+        images = features['images'].bytes_list.value
+    elif record_format == SEQUENCE_EXAMPLE_FORMAT:
+        example = tf.train.SequenceExample.FromString(serialized_record)
+        feature_lists = example.feature_lists.feature_list
+        if all([k in feature_lists for k in IMAGE_SIZE_FEATURES]):
+            columns = [[x.int64_list.value[0]
+                        for x in feature_lists[k].feature]
+                       for k in IMAGE_SIZE_FEATURES]
+            return list(zip(*columns)), True
+        images = [x.bytes_list.value[0]
+                  for x in feature_lists['images'].feature]
+    else:
+        raise ValueError("Record format %s not supported" % record_format)
+    sizes = list()
+    for image_bytes in images:
+        sizes.append(image_dimensions(image_bytes) + (len(image_bytes), ))
+    return sizes, False
+
+
+class ImageSizeStats(object):
+    """ Size distributions of the images in TFRecord files
+
+        Example:
+        stats = image_size_stats_parallel(tfr_files, n_processes=4)
+        print(stats.report(min_side=224))
+    """
+    def __init__(self):
+        self.n_records = 0
+        self.n_records_without_sizes = 0
+        self.distributions = {
+            k: ValueDistribution() for k in
+            ['height', 'width', 'min_side', 'max_side', 'n_bytes',
+             'n_channels', 'n_images_per_record']}
+
+    def add_record(self, serialized_record,
+                   record_format=SEQUENCE_EXAMPLE_FORMAT):
+        """ Add the images of a serialized record """
+        sizes, stored = image_sizes_of_record(
+            serialized_record, record_format)
+        self.n_records += 1
+        if not stored:
+            self.n_records_without_sizes += 1
+        self.distributions['n_images_per_record'].add(len(sizes))
+        for height, width, n_channels, n_bytes in sizes:
+            self.distributions['height'].add(height)
+            self.distributions['width'].add(width)
+            self.distributions['min_side'].add(min(height, width))
+            self.distributions['max_side'].add(max(height, width))
+            self.distributions['n_channels'].add(n_channels)
+            self.distributions['n_bytes'].add(n_bytes)
+
+    def add_file(self, tfr_path, record_format=None):
+        """ Add the images of all records of a TFRecord file, the record
+            format is read from the dataset manifest if not specified
+        """
+        if record_format is None:
+            record_format = record_format_of_tfr_files([tfr_path])
+        for _, serialized_record in iterate_records(tfr_path):
+            self.add_record(serialized_record, record_format)
+
+    def merge(self, other):
+        """ Add the stats of other files """
+        self.n_records += other.n_records
+        self.n_records_without_sizes += other.n_records_without_sizes
+        for k, distribution in other.distributions.items():
+            self.distributions[k].merge(distribution)
+
+    def report(self, min_side=None):
+        """ Summary of all distributions, counts images whose smaller side
+            is below 'min_side' if specified
+        """
+        report = {
+            'n_records': self.n_records,
+            'n_records_without_stored_sizes': self.n_records_without_sizes,
+            **{k: v.to_dict() for k, v in self.distributions.items()}}
+        report['n_channels']['counts'] = {
+            str(k): v for k, v in
+            sorted(self.distributions['n_channels'].counts.items())}
+        if min_side is not None:
+            report['n_images_below_min_side'] = {
+                'min_side': min_side,
+                'count': self.distributions['min_side'].n_below(min_side)}
+        return report
+
+
+def image_size_stats_of_file(tfr_path):
+    """ Image size distributions of a TFRecord file """
+    stats = ImageSizeStats()
+    stats.add_file(tfr_path)
+    return stats
+
+
+def image_size_stats_parallel(tfr_paths, n_processes=4):
+    """ Image size distributions of all TFRecord files, files are read in
+        parallel
+    """
+    stats = ImageSizeStats()
+    if n_processes <= 1:
+        for tfr_path in tfr_paths:
+            stats.add_file(tfr_path)
+        return stats
+    pool = Pool(processes=n_processes)
+    for file_stats in pool.imap_unordered(image_size_stats_of_file,
+                                          tfr_paths):
+        stats.merge(file_stats)
+    pool.close()
+    pool.join()
+    return stats
@@ -0,0 +1,215 @@
+""" Settings of the Input Pipeline of DatasetReader.get_iterator
+
+Stages and their settings:
+    reading: 'interleave_cycle_length' files are read in parallel
+    prefetching: 'prefetch_records' records are prefetched before the
+     shuffle (default: batch size, 0: no prefetching)
+    shuffling: 'shuffle_buffer_size' records are shuffled (training only)
+    decoding: 'num_parallel_calls' records are decoded and pre-processed in
+     parallel
+    batching: 'prefetch_batches' batches are prefetched (0: none)
+
+Settings are taken from (highest priority first): train.py arguments, the
+'input_pipeline' block of a model in config/models.yaml, the global
+'input_pipeline' block in config/models.yaml and the defaults. Settings
+that are 'auto' are calibrated by measuring the throughput of the
+pipeline for a few batches with different values.
+
+Training can be resumed where the input pipeline was interrupted: with a
+seed the order of the training records is reproducible (see
+DatasetReader.get_iterator), the input state (seed, records read, epoch)
+is saved next to each model checkpoint and the records that were already
+read are skipped when training is continued.
+"""
+import os
+import json
+import time
+import logging
+
+import tensorflow as tf
+
+
+logger = logging.getLogger(__name__)
+
+AUTO = 'auto'
+
+DEFAULT_PIPELINE_SETTINGS = {
+    'num_parallel_calls': 4,
+    'interleave_cycle_length': 12,
+    'prefetch_records': None,
+    'prefetch_batches': 0,
+    'shuffle_buffer_size': 32768}
+
+# settings that can be calibrated (in the order they are calibrated) -
+# the shuffle buffer changes how the records are shuffled
+TUNABLE_SETTINGS = ['num_parallel_calls', 'interleave_cycle_length',
+                    'prefetch_batches', 'prefetch_records']
+
+
+def pipeline_setting(value):
+    """ Parse a setting: a non-negative integer or 'auto' (e.g. as type of
+        an argparse argument)
+    """
+    if value is None or value == AUTO:
+        return value
+    value = int(value)
+    if value < 0:
+        raise ValueError("Pipeline settings must not be negative")
+    return value
+
+
+def resolve_pipeline_settings(*settings_by_priority):
+    """ Merge pipeline settings, later dictionaries overwrite earlier ones
+        (None values are ignored), the defaults are used for missing
+        settings
+    """
+    settings = dict(DEFAULT_PIPELINE_SETTINGS)
+    for overwrites in settings_by_priority:
+        if overwrites is None:
+            continue
+        for key, value in overwrites.items():
+            if key not in DEFAULT_PIPELINE_SETTINGS:
+                logger.error("Unknown input pipeline setting %s - choose "
+                             "from %s" %
+                             (key, sorted(DEFAULT_PIPELINE_SETTINGS.keys())))
+                raise ValueError("Unknown input pipeline setting %s" % key)
+            if value is None:
+                continue
+            value = pipeline_setting(value)
+            if value == AUTO and key not in TUNABLE_SETTINGS:
+                raise ValueError("Input pipeline setting %s can not be "
+                                 "calibrated ('auto')" % key)
+            settings[key] = value
+    return settings
+
+
+def reader_arguments(settings):
+    """ Arguments of DatasetReader.get_iterator for pipeline settings """
+    return {
+        'num_parallel_calls': settings['num_parallel_calls'],
+        'interleave_cycle_length': settings['interleave_cycle_length'],
+        'prefetch_records': settings['prefetch_records'],
+        'prefetch_batches': settings['prefetch_batches'],
+        'buffer_size': settings['shuffle_buffer_size']}
+
+
+def candidate_values(setting, batch_size, n_files, n_cpus=None):
+    """ Values of a setting that are tried during the calibration """
+    n_cpus = n_cpus or os.cpu_count() or 1
+    if setting == 'num_parallel_calls':
+        candidates = _powers_of_two(n_cpus) + [n_cpus]
+    elif setting == 'interleave_cycle_length':
+        candidates = _powers_of_two(min(n_files, 2 * n_cpus)) + \
+            [min(n_files, 2 * n_cpus)]
+    elif setting == 'prefetch_batches':
+        candidates = [0, 1, 2, 4]
+    elif setting == 'prefetch_records':
+        candidates = [0, batch_size, 4 * batch_size]
+    else:
+        raise ValueError("Input pipeline setting %s can not be calibrated"
+                         % setting)
+    return sorted(set([max(x, 0) for x in candidates]))
+
+
+def _powers_of_two(max_value):
+    values = [1]
+    while values[-1] * 2 <= max_value:
+        values.append(values[-1] * 2)
+    return values
+
+
+def measure_batches_per_second(create_dataset, settings, n_batches=20,
+                               n_warmup_batches=3):
+    """ Batches per second of the dataset create_dataset(settings)
+        creates, the first 'n_warmup_batches' are not timed
+    """
+    with tf.Graph().as_default():
+        dataset = create_dataset(settings)
+        iterator = dataset.make_initializable_iterator()
+        next_batch = iterator.get_next()
+        with tf.Session() as sess:
+            tf.tables_initializer().run()
+            sess.run(iterator.initializer)
+            for _ in range(0, n_warmup_batches):
+                sess.run(next_batch)
+            start_time = time.time()
+            for _ in range(0, n_batches):
+                sess.run(next_batch)
+            duration = time.time() - start_time
+    return n_batches / duration
+
+
+def calibrate_pipeline_settings(create_dataset, settings, batch_size,
+                                n_files, n_batches=20, n_cpus=None,
+                                measure_fun=measure_batches_per_second):
+    """ Replace the 'auto' settings with the values that give the highest
+        throughput of the dataset create_dataset(settings) creates
+
+        The settings are calibrated one after another, settings that are
+        not calibrated yet use their default value. Returns the calibrated
+        settings and the measurements [(settings, batches per second)].
+    """
+    to_calibrate = [x for x in TUNABLE_SETTINGS if settings[x] == AUTO]
+    calibrated = {k: (DEFAULT_PIPELINE_SETTINGS[k] if v == AUTO else v)
+                  for k, v in settings.items()}
+    measurements = list()
+    if len(to_calibrate) == 0:
+        return calibrated, measurements
+
+    logger.info("Calibrating input pipeline settings %s" % to_calibrate)
+    for setting in to_calibrate:
+        best_value, best_speed = None, None
+        for value in candidate_values(setting, batch_size, n_files, n_cpus):
+            trial = dict(calibrated)
+            trial[setting] = value
+            speed = measure_fun(create_dataset, trial, n_batches)
+            measurements.append((trial, speed))
+            logger.info("Input pipeline %s=%s: %.2f batches/s" %
+                        (setting, value, speed))
+            if best_speed is None or speed > best_speed:
+                best_value, best_speed = value, speed
+        calibrated[setting] = best_value
+
+    logger.info("Calibrated input pipeline settings: %s" %
+                {k: calibrated[k] for k in to_calibrate})
+    return calibrated, measurements
+
+
+INPUT_STATE_SUFFIX = '.input_state.json'
+
+
+def input_state_path(model_path):
+    """ Path of the input state saved with a model checkpoint """
+    return os.path.splitext(model_path)[0] + INPUT_STATE_SUFFIX
+
+
+def save_input_state(model_path, state):
+    """ Save the input state next to a model checkpoint (atomically) """
+    path = input_state_path(model_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def load_input_state(model_path):
+    """ Load the input state of a model checkpoint, None if there is none
+    """
+    path = input_state_path(model_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def records_to_skip(state, epoch_size):
+    """ Number of training records to skip to continue after the input
+        state - from the beginning of the epoch of the state if the
+        number of records per epoch has changed
+    """
+    if state['epoch_size'] == epoch_size:
+        return state['records_read']
+    logger.warning("Records per epoch changed from %s to %s - continuing "
+                   "the input at the beginning of epoch %s" %
+                   (state['epoch_size'], epoch_size, state['epoch']))
+    return state['epoch'] * epoch_size
@@ -1,19 +1,32 @@
 """ Class To Create Dataset Inventory """
+import os
 import random
 import json
 import logging
 import copy
+from collections.abc import Mapping
 
 
 from data.utils import (
     randomly_split_dataset, map_label_list_to_numeric_dict,
     export_dict_to_json, _balanced_sampling)
 from data.importer import DatasetImporter
+from data.dedup import find_duplicate_groups
+from data.remote import is_remote_path
 
 
 logger = logging.getLogger(__name__)
 
 
+def export_splits_to_tfrecord(splits, tfr_writer, tfr_path, **kwargs):
+    """ Export several splits ({'train': DatasetInventory, ...}) to TFRecord
+        files through one shared writing pipeline
+    """
+    split_dicts = {split_name: split_data.get_tfrecord_view()
+                   for split_name, split_data in splits.items()}
+    tfr_writer.encode_splits_to_tfr(split_dicts, tfr_path, **kwargs)
+
+
 class DatasetInventory(object):
     """ Defines a Datset Inventory - Contains labels, links and data about each
         Record
@@ -115,15 +128,31 @@ class DatasetInventory(object):
                            **kwargs):
         """ Export Dataset to TFRecod """
 
-        # create tfrecord dictionary
-        tfrecord_dict = dict()
-        for _id, record_values in self.data_inventory.items():
-            tfr_record = self._convert_record_to_tfr_format(
-                _id, record_values)
-            tfrecord_dict[_id] = tfr_record
+        # records are converted when the writer reads them
+        tfrecord_view = self.get_tfrecord_view()
 
         # Write to disk
-        tfr_writer.encode_to_tfr(tfrecord_dict, tfr_path, **kwargs)
+        tfr_writer.encode_to_tfr(tfrecord_view, tfr_path, **kwargs)
+
+    def get_tfrecord_dict(self):
+        """ Convert all records to the tfr format """
+        return dict(self.iter_tfrecords())
+
+    def get_tfrecord_view(self):
+        """ Read-only mapping of record ids to records in the tfr format,
+            records are converted when accessed (see TFRecordView)
+        """
+        return TFRecordView(self)
+
+    def iter_tfrecords(self, record_ids=None):
+        """ Generator of (id, record in the tfr format) of all records or
+            of 'record_ids' in that order
+        """
+        if record_ids is None:
+            record_ids = self.data_inventory.keys()
+        for _id in record_ids:
+            yield _id, self._convert_record_to_tfr_format(
+                _id, self.data_inventory[_id])
 
     def _convert_record_to_tfr_format(self, id, record):
         """ Convert a record to a tfr format """
@@ -185,6 +214,32 @@ class DatasetInventory(object):
         export_dict_to_json(self.labels_numeric_map, path)
 
 
+class TFRecordView(Mapping):
+    """ Read-only mapping of record ids to records in the tfr format that
+        converts each record when it is accessed, hence the converted
+        records are not kept in memory
+
+        Example:
+        view = inventory.get_tfrecord_view()
+        record = view['capture_1']
+    """
+    def __init__(self, inventory):
+        self.inventory = inventory
+
+    def __getitem__(self, record_id):
+        return self.inventory._convert_record_to_tfr_format(
+            record_id, self.inventory.data_inventory[record_id])
+
+    def __contains__(self, record_id):
+        return record_id in self.inventory.data_inventory
+
+    def __iter__(self):
+        return iter(self.inventory.data_inventory)
+
+    def __len__(self):
+        return len(self.inventory.data_inventory)
+
+
 class DatasetInventorySplit(DatasetInventory):
     """ Datset Dictionary Split - Does not allow further
         manipulations
@@ -203,6 +258,7 @@ class DatasetInventoryMaster(DatasetInventory):
         self.data_inventory = None
         self.labels = None
         self.labels_numeric_map = labels_numeric_map
+        self.split_keys = None
 
     def _map_labels_to_numeric(self):
         """ Map all labels to numerics """
@@ -240,6 +296,67 @@ class DatasetInventoryMaster(DatasetInventory):
         for record_id in to_remove:
             self.remove_record(record_id)
 
+    def find_duplicates(self, hash_index, image_root_path=None,
+                        perceptual=False, max_hamming_distance=4,
+                        n_processes=4):
+        """ Find groups of records that share an identical image or, if
+            'perceptual', a similar image (dhash within
+            'max_hamming_distance' bits)
+            hash_index: ImageHashIndex
+            Returns: list of groups [{'record_ids': [...], 'type': 'exact'}]
+
+            Images have to be local files, the hash index relies on their
+            modification time and size.
+        """
+        if is_remote_path(image_root_path):
+            raise ValueError(
+                "Finding duplicates requires local images - image_root_path "
+                "%s is an url" % image_root_path)
+        record_images = dict()
+        for record_id, record_value in self.data_inventory.items():
+            image_paths = list()
+            for image_path in record_value['images']:
+                if image_root_path is not None:
+                    image_path = os.path.join(image_root_path,
+                                              image_path.lstrip(os.sep))
+                image_paths.append(image_path)
+            record_images[record_id] = image_paths
+
+        all_paths = [x for paths in record_images.values() for x in paths]
+        remote_paths = [x for x in all_paths if is_remote_path(x)]
+        if len(remote_paths) > 0:
+            raise ValueError(
+                "Finding duplicates requires local images - %s image paths "
+                "are urls, e.g. %s" % (len(remote_paths), remote_paths[0]))
+        image_hashes = hash_index.get_hashes(
+            all_paths, perceptual=perceptual, n_processes=n_processes)
+
+        groups = find_duplicate_groups(
+            record_images, image_hashes,
+            max_hamming_distance if perceptual else None)
+
+        logger.info("Found %s groups of duplicates with %s records" %
+                    (len(groups), sum([len(x['record_ids']) for x in groups])))
+        return groups
+
+    def remove_duplicates(self, duplicate_groups):
+        """ Keep only the first record of each group of duplicates """
+        to_remove = [record_id for group in duplicate_groups
+                     for record_id in group['record_ids'][1:]]
+        logger.info("Removing %s duplicate records" % len(to_remove))
+        for record_id in to_remove:
+            self.remove_record(record_id)
+
+    def group_duplicates(self, duplicate_groups):
+        """ Assign all records of a group of duplicates to the same split
+            when splitting randomly
+        """
+        if self.split_keys is None:
+            self.split_keys = dict()
+        for group in duplicate_groups:
+            for record_id in group['record_ids']:
+                self.split_keys[record_id] = group['record_ids'][0]
+
     def randomly_remove_samples_to_percent(self, p_keep):
         """ Randomly sample a percentage of all records """
         if not p_keep <= 1:
@@ -366,7 +483,8 @@ class DatasetInventoryMaster(DatasetInventory):
             split_names,
             split_percent,
             balanced_sampling_min=True,
-            balanced_sampling_id_to_label=ids_to_split_label)
+            balanced_sampling_id_to_label=ids_to_split_label,
+            split_keys=self.split_keys)
 
         logging.debug("Found %s records with split assignments" %
                       len(split_assignments.keys()))
@@ -388,7 +506,8 @@ class DatasetInventoryMaster(DatasetInventory):
             split_names,
             split_percent,
             balanced_sampling_min=False,
-            balanced_sampling_id_to_label=None)
+            balanced_sampling_id_to_label=None,
+            split_keys=self.split_keys)
 
         return self._convert_splits_to_dataset_inventorys(split_assignments)
 
@@ -0,0 +1,173 @@
+""" Manifest of a TFRecord Dataset - keeps track of completed files """
+import os
+import json
+import logging
+from hashlib import md5
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = 'dataset_manifest.json'
+
+
+def file_md5(path, block_size=2**20):
+    """ Calculate the md5 checksum of a file """
+    hasher = md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def hash_record_ids(record_ids):
+    """ Order independent hash of a list of record ids """
+    hasher = md5()
+    for record_id in sorted(record_ids):
+        hasher.update(str(record_id).encode('utf-8'))
+        hasher.update(b'\n')
+    return hasher.hexdigest()
+
+
+class DatasetManifest(object):
+    """ Json file in the output directory that lists all completed
+        TFRecord files per split with their record count and checksum
+
+        Example:
+        {'record_format': 'sequence_example',
+         'splits': {'train': {'files': {'train_001-of-002.tfrecord': {
+            'n_records': 5000, 'size': 1234, 'md5': '...',
+            'record_ids_hash': '...',
+            'label_histograms': {'species': {'zebra': 2500, ...}}}}}}}
+
+        The manifest is re-read before each update and written atomically,
+        hence it always reflects all files completed so far, even if the
+        process dies.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+        self.data = self._load()
+
+    def _load(self):
+        """ Read manifest from disk or create an empty one """
+        if not os.path.exists(self.path):
+            return {'splits': dict()}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("Manifest %s is corrupt - ignoring it" % self.path)
+            return {'splits': dict()}
+
+    def save(self):
+        """ Write manifest to disk (atomically) """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get_files(self, split_name):
+        """ Get all completed files of a split """
+        split = self.data['splits'].get(split_name, dict())
+        return split.get('files', dict())
+
+    def get_file(self, split_name, file_name):
+        """ Get the entry of a completed file or None """
+        return self.get_files(split_name).get(file_name)
+
+    def add_file(self, split_name, file_name, file_info):
+        """ Register a completed file and save the manifest """
+        self.data = self._load()
+        split = self.data['splits'].setdefault(split_name, dict())
+        split.setdefault('files', dict())[file_name] = file_info
+        self.save()
+
+    def remove_file(self, split_name, file_name):
+        """ Remove the entry of a file and save the manifest """
+        self.data = self._load()
+        split = self.data['splits'].get(split_name, dict())
+        split.get('files', dict()).pop(file_name, None)
+        self.save()
+
+    def get_storage_profile(self):
+        """ Get the storage profile of the images or None """
+        return self.data.get('storage_profile')
+
+    def set_storage_profile(self, storage_profile):
+        """ Set the storage profile of the images and save the manifest """
+        self.data = self._load()
+        self.data['storage_profile'] = storage_profile
+        self.save()
+
+    def get_record_format(self):
+        """ Get the format of the records or None (older datasets) """
+        return self.data.get('record_format')
+
+    def set_record_format(self, record_format):
+        """ Set the format of the records and save the manifest """
+        self.data = self._load()
+        self.data['record_format'] = record_format
+        self.save()
+
+    def get_split(self, split_name):
+        """ Get the split-level entry (e.g. sharding settings) or None """
+        return self.data['splits'].get(split_name, dict()).get('split')
+
+    def update_split(self, split_name, split_info):
+        """ Set the split-level entry and save the manifest """
+        self.data = self._load()
+        split = self.data['splits'].setdefault(split_name, dict())
+        split['split'] = split_info
+        self.save()
+
+    def is_split_complete(self, split_name, output_dir, split_info):
+        """ Check if all files of a split were completely written with the
+            same settings ('split_info' without 'file_names') and are
+            unchanged (size and md5 checksum)
+        """
+        stored_info = self.get_split(split_name)
+        if stored_info is None:
+            return False
+        for key, value in split_info.items():
+            if stored_info.get(key) != value:
+                return False
+        for file_name in stored_info['file_names']:
+            file_path = os.path.join(output_dir, file_name)
+            file_info = self.get_file(split_name, file_name)
+            if file_info is None or not os.path.exists(file_path):
+                return False
+            if os.path.getsize(file_path) != file_info['size']:
+                return False
+        for file_name in stored_info['file_names']:
+            if not self.verify_file(
+                    split_name, os.path.join(output_dir, file_name)):
+                return False
+        return True
+
+    def is_file_complete(self, split_name, file_path, record_ids_hash,
+                         file_settings=None):
+        """ Check if a file was completely written with the same records
+            and the same 'file_settings' (e.g. {'compression_type': None})
+            and is unchanged (size and md5 checksum)
+        """
+        file_info = self.get_file(split_name, os.path.basename(file_path))
+        if file_info is None:
+            return False
+        if not os.path.exists(file_path):
+            return False
+        if os.path.getsize(file_path) != file_info['size']:
+            return False
+        if file_settings is not None:
+            for key, value in file_settings.items():
+                if file_info.get(key) != value:
+                    return False
+        if file_info['record_ids_hash'] != record_ids_hash:
+            return False
+        return self.verify_file(split_name, file_path)
+
+    def verify_file(self, split_name, file_path):
+        """ Verify the checksum of a completed file """
+        file_info = self.get_file(split_name, os.path.basename(file_path))
+        if file_info is None or not os.path.exists(file_path):
+            return False
+        return file_md5(file_path) == file_info['md5']
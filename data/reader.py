@@ -4,68 +4,333 @@
 import tensorflow as tf
 import logging
 
+from data.utils import detect_tfr_compression_type
+
 
 logger = logging.getLogger(__name__)
 
+# how the images of records with several images are used:
+#  random: one random image per record
+#  expand: one example per image of a record (with the labels of the record)
+#  stack: all images of a record, padded with zeros to the record with the
+#   most images of a batch (e.g. to average predictions over them)
+MULTI_IMAGE_RANDOM = 'random'
+MULTI_IMAGE_EXPAND = 'expand'
+MULTI_IMAGE_STACK = 'stack'
+MULTI_IMAGE_MODES = [MULTI_IMAGE_RANDOM, MULTI_IMAGE_EXPAND,
+                     MULTI_IMAGE_STACK]
+
 
 class DatasetReader(object):
-    def __init__(self, tfr_decoder):
+    """ Read TFRecord files with 'tfr_decoder' (e.g.
+        DefaultTFRecordEncoderDecoder.decode_record)
+
+        'tfr_batch_decoder' is an encoder / decoder that supports batch
+        parsing (decode_batch, e.g. FlatTFRecordEncoderDecoder) and is
+        needed for 'batch_parse'
+    """
+    def __init__(self, tfr_decoder, tfr_batch_decoder=None):
         self.tfr_decoder = tfr_decoder
+        self.tfr_batch_decoder = tfr_batch_decoder
 
     def get_iterator(self, tfr_files, batch_size, is_train, n_repeats,
                      output_labels,
                      label_to_numeric_mapping=None,
                      buffer_size=10192, num_parallel_calls=4,
-                     drop_batch_remainder=True, **kwargs):
-        """ Create Iterator from TFRecord """
+                     drop_batch_remainder=True, compression_type=None,
+                     record_filter_fun=None,
+                     batch_parse=False,
+                     interleave_cycle_length=12,
+                     prefetch_records=None,
+                     prefetch_batches=None,
+                     seed=None,
+                     epoch_size=None,
+                     skip_records=0,
+                     multi_image_mode=MULTI_IMAGE_RANDOM,
+                     image_indices_fun=None,
+                     **kwargs):
+        """ Create Iterator from TFRecord
+
+            The compression of each file ('', 'GZIP' or 'ZLIB') is detected
+            unless 'compression_type' is specified.
+
+            record_filter_fun: function that maps a serialized record to a
+             boolean tensor, records for which it is False are skipped
+             (e.g. DefaultTFRecordEncoderDecoder.has_image_with_min_side)
+            batch_parse: batch the serialized records first, parse each
+             batch at once and map its labels, then decode and pre-process
+             the images of the batch in parallel
+
+            Settings of the pipeline stages (see data/input_pipeline.py):
+            interleave_cycle_length: number of files read in parallel
+            prefetch_records: number of records prefetched before the
+             shuffle (default: batch_size, 0: none)
+            buffer_size: number of records shuffled (training only)
+            num_parallel_calls: number of records decoded in parallel
+            prefetch_batches: number of batches prefetched (default: none)
+
+            Reproducible training input (e.g. to resume training):
+            seed: shuffle the files and records of each epoch with a seed
+             derived from 'seed' and the epoch, the files are read in a
+             deterministic order
+            epoch_size: number of records of each epoch (with 'seed')
+            skip_records: number of records to skip (with 'seed'), e.g. the
+             records read before a restart (see data/input_pipeline.py),
+             with 'epoch_size' only the records of the last epoch are read
+
+            Records with several images (see MULTI_IMAGE_MODES):
+            multi_image_mode: 'random' (default), 'expand' or 'stack', with
+             'expand' the record counts (e.g. 'buffer_size', 'epoch_size',
+             'skip_records') are numbers of examples (images), with
+             'stack' the features have the number of images of each
+             record ('n_images') and 'batch_parse' is ignored
+            image_indices_fun: function that maps a serialized record to
+             the indices of its images to use (e.g.
+             DefaultTFRecordEncoderDecoder.image_indices), needed for
+             'expand'
+        """
 
         assert type(output_labels) is list, "label_list must be of " + \
             " type list is of type %s" % type(output_labels)
 
         logger.info("Creating dataset TFR iterator")
 
+        if multi_image_mode not in MULTI_IMAGE_MODES:
+            logger.error("Multi image mode %s not supported - choose one "
+                         "of %s" % (multi_image_mode, MULTI_IMAGE_MODES))
+            raise ValueError("Multi image mode %s not supported" %
+                             multi_image_mode)
+
+        if multi_image_mode != MULTI_IMAGE_EXPAND:
+            image_indices_fun = None
+        elif image_indices_fun is None:
+            raise ValueError("Multi image mode 'expand' needs an "
+                             "image_indices_fun")
+
+        if batch_parse and multi_image_mode == MULTI_IMAGE_STACK:
+            logger.warning("Batch parsing is not supported with multi "
+                           "image mode 'stack' - parsing one record at a "
+                           "time")
+            batch_parse = False
+
         # Create Hash Map to map str labels to numerics if specified
         class_to_index_mappings = self._create_lookup_table(
             output_labels, label_to_numeric_mapping)
 
-        # Create a tf.Dataset
-        dataset = tf.data.Dataset.from_tensor_slices(tfr_files)
-
-        # Shuffle input files for training
-        if is_train:
-            dataset = dataset.shuffle(buffer_size=len(tfr_files))
+        if compression_type is None:
+            compression_types = [detect_tfr_compression_type(x)
+                                 for x in tfr_files]
+        else:
+            compression_types = [compression_type for x in tfr_files]
 
-        dataset = dataset.apply(
-            tf.contrib.data.parallel_interleave(
-                lambda filename: tf.data.TFRecordDataset(filename),
-                sloppy=is_train,
-                cycle_length=12))
+        if prefetch_records is None:
+            prefetch_records = batch_size
 
-        dataset = dataset.prefetch(buffer_size=batch_size)
+        def read_records(shuffle_files, sloppy, file_seed=None):
+            return self._read_records(
+                tfr_files, compression_types, shuffle_files, sloppy,
+                interleave_cycle_length, record_filter_fun,
+                prefetch_records, file_seed, image_indices_fun)
 
-        # shuffle records only for training
-        if is_train:
-            dataset = dataset.apply(
+        if is_train and seed is not None:
+            # reproducible order of the records, e.g. to resume training
+            dataset = self._seeded_epochs(
+                read_records, n_repeats, buffer_size, seed, epoch_size,
+                skip_records)
+        elif is_train:
+            # shuffle records only for training
+            dataset = read_records(shuffle_files=True, sloppy=True).apply(
                 tf.contrib.data.shuffle_and_repeat(
                     buffer_size=buffer_size,
                     count=n_repeats))
+        else:
+            dataset = read_records(shuffle_files=False, sloppy=False)
 
-        dataset = dataset.apply(
-              tf.contrib.data.map_and_batch(
-                  lambda x: self.tfr_decoder(
-                          serialized_example=x,
-                          output_labels=output_labels,
-                          label_lookup_dict=class_to_index_mappings,
-                          **kwargs),
-                  batch_size=batch_size,
-                  num_parallel_calls=num_parallel_calls,
-                  drop_remainder=drop_batch_remainder))
+        if batch_parse:
+            dataset = self._decode_batches(
+                dataset, batch_size, output_labels, class_to_index_mappings,
+                drop_batch_remainder, num_parallel_calls, **kwargs)
+        elif multi_image_mode == MULTI_IMAGE_STACK:
+            dataset = self._decode_stacked(
+                dataset, batch_size, output_labels, class_to_index_mappings,
+                drop_batch_remainder, num_parallel_calls, **kwargs)
+        else:
+            dataset = dataset.apply(
+                  tf.contrib.data.map_and_batch(
+                      lambda *x: self.tfr_decoder(
+                              **self._record_args(x),
+                              output_labels=output_labels,
+                              label_lookup_dict=class_to_index_mappings,
+                              **kwargs),
+                      batch_size=batch_size,
+                      num_parallel_calls=num_parallel_calls,
+                      drop_remainder=drop_batch_remainder))
 
         if not is_train:
             dataset = dataset.repeat(n_repeats)
 
+        if prefetch_batches:
+            dataset = dataset.prefetch(buffer_size=prefetch_batches)
+
         return dataset
 
+    def count_examples(self, tfr_files, record_filter_fun=None,
+                       image_indices_fun=None, compression_type=None):
+        """ Number of records of TFRecord files (for which
+            'record_filter_fun' is True), of images with 'image_indices_fun'
+            (see multi_image_mode 'expand' of get_iterator)
+        """
+        if compression_type is None:
+            compression_types = [detect_tfr_compression_type(x)
+                                 for x in tfr_files]
+        else:
+            compression_types = [compression_type for x in tfr_files]
+
+        n_examples = 0
+        with tf.Graph().as_default():
+            dataset = self._read_records(
+                tfr_files, compression_types, shuffle_files=False,
+                sloppy=True, interleave_cycle_length=len(tfr_files),
+                record_filter_fun=record_filter_fun, prefetch_records=0,
+                image_indices_fun=image_indices_fun)
+            dataset = dataset.batch(4096).map(lambda *x: tf.shape(x[0])[0])
+            iterator = dataset.make_one_shot_iterator()
+            batch_size = iterator.get_next()
+            with tf.Session() as sess:
+                while True:
+                    try:
+                        n_examples += sess.run(batch_size)
+                    except tf.errors.OutOfRangeError:
+                        break
+        return int(n_examples)
+
+    def _read_records(self, tfr_files, compression_types, shuffle_files,
+                      sloppy, interleave_cycle_length, record_filter_fun,
+                      prefetch_records, file_seed=None,
+                      image_indices_fun=None):
+        """ Read the serialized records of TFRecord files, with
+            'image_indices_fun' a (record, image index) pair per image
+        """
+        # Create a tf.Dataset
+        dataset = tf.data.Dataset.from_tensor_slices(
+            (tfr_files, compression_types))
+
+        # Shuffle input files for training
+        if shuffle_files:
+            dataset = dataset.shuffle(buffer_size=len(tfr_files),
+                                      seed=file_seed)
+
+        dataset = dataset.apply(
+            tf.contrib.data.parallel_interleave(
+                lambda filename, compression: tf.data.TFRecordDataset(
+                    filename, compression_type=compression),
+                sloppy=sloppy,
+                cycle_length=interleave_cycle_length))
+
+        if record_filter_fun is not None:
+            dataset = dataset.filter(record_filter_fun)
+
+        if image_indices_fun is not None:
+            dataset = dataset.flat_map(
+                lambda x: tf.data.Dataset.from_tensor_slices(
+                    image_indices_fun(x)).map(lambda index: (x, index)))
+
+        if prefetch_records > 0:
+            dataset = dataset.prefetch(buffer_size=prefetch_records)
+        return dataset
+
+    def _seeded_epochs(self, read_records, n_repeats, buffer_size, seed,
+                       epoch_size, skip_records):
+        """ Training records with a reproducible order: the files and the
+            records of each epoch are shuffled with a seed derived from
+            'seed' and the epoch and the files are read in a deterministic
+            order. Each epoch has 'epoch_size' records (the records are
+            repeated if there are fewer), the first 'skip_records' records
+            are skipped (only read, not decoded).
+        """
+        if epoch_size is not None:
+            start_epoch, skip_records = divmod(skip_records, epoch_size)
+        else:
+            start_epoch = 0
+
+        def epoch_records(epoch):
+            epoch_seed = seed + epoch
+            records = read_records(
+                shuffle_files=True, sloppy=False, file_seed=epoch_seed)
+            records = records.shuffle(buffer_size=buffer_size,
+                                      seed=epoch_seed)
+            if epoch_size is not None:
+                records = records.repeat().take(epoch_size)
+            return records
+
+        n_epochs = n_repeats if n_repeats is not None else 2 ** 62
+        dataset = tf.data.Dataset.range(start_epoch, n_epochs).flat_map(
+            epoch_records)
+        if skip_records > 0:
+            dataset = dataset.skip(skip_records)
+        return dataset
+
+    def _decode_batches(self, dataset, batch_size, output_labels,
+                        class_to_index_mappings, drop_batch_remainder,
+                        num_parallel_calls, **kwargs):
+        """ Batch the serialized records and decode each batch at once """
+        if self.tfr_batch_decoder is None or \
+           not self.tfr_batch_decoder.supports_batch_parse:
+            logger.error("batch_parse needs a tfr_batch_decoder that "
+                         "supports batch parsing")
+            raise ValueError(
+                "batch_parse needs a tfr_batch_decoder that supports "
+                "batch parsing (e.g. FlatTFRecordEncoderDecoder)")
+
+        if drop_batch_remainder:
+            dataset = dataset.apply(
+                tf.contrib.data.batch_and_drop_remainder(batch_size))
+        else:
+            dataset = dataset.batch(batch_size)
+
+        def decode_batch(*x):
+            record_args = self._record_args(x)
+            return self.tfr_batch_decoder.decode_batch(
+                serialized_examples=record_args['serialized_example'],
+                image_index=record_args.get('image_index'),
+                output_labels=output_labels,
+                label_lookup_dict=class_to_index_mappings,
+                num_parallel_calls=num_parallel_calls,
+                **kwargs)
+
+        return dataset.map(decode_batch)
+
+    def _decode_stacked(self, dataset, batch_size, output_labels,
+                        class_to_index_mappings, drop_batch_remainder,
+                        num_parallel_calls, **kwargs):
+        """ Decode all images of each record and batch the records, the
+            images are padded with zeros to the record with the most images
+            ('n_images' is the number of images of each record)
+        """
+        def decode(serialized_example):
+            features, labels = self.tfr_decoder(
+                serialized_example=serialized_example,
+                output_labels=output_labels,
+                label_lookup_dict=class_to_index_mappings,
+                **{**kwargs, 'choose_random_image': False})
+            features['n_images'] = tf.shape(features['images'])[0]
+            return features, labels
+
+        dataset = dataset.map(decode, num_parallel_calls=num_parallel_calls)
+        if drop_batch_remainder:
+            return dataset.apply(
+                tf.contrib.data.padded_batch_and_drop_remainder(
+                    batch_size, dataset.output_shapes))
+        return dataset.padded_batch(batch_size, dataset.output_shapes)
+
+    def _record_args(self, record):
+        """ Decoder arguments of a serialized record or a (record, image
+            index) pair
+        """
+        if len(record) == 1:
+            return {'serialized_example': record[0]}
+        return {'serialized_example': record[0], 'image_index': record[1]}
+
     def _create_hash_table_from_dict(self, mapping, missing_val=-1, name=None):
         """ Create a hash table from a dictionary """
         keys, values = zip(*mapping.items())
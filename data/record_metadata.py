@@ -0,0 +1,67 @@
+""" Record Metadata Sidecar of TFRecord Files
+
+Record formats that store only the data needed for training (flat_example,
+see data/tfr_encoder_decoder.py) keep the remaining data of each record in
+a sidecar file next to each TFRecord file:
+'train_001-of-010.tfrecord' -> 'train_001-of-010.tfrecord.meta.jsonl'
+with one json object per record:
+{"id": "capture_1", "n_images": 2, "n_labels": 1,
+ "image_paths": ["..."], "meta_data": "...", "labelstext": "...",
+ "labels": {"species": ["zebra"]}}
+"""
+import os
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+METADATA_SUFFIX = '.meta.jsonl'
+
+
+def metadata_path(tfr_path):
+    """ Path of the metadata sidecar of a TFRecord file """
+    return tfr_path + METADATA_SUFFIX
+
+
+def record_metadata(record_data):
+    """ Metadata of a record in the tfr format (as created by
+        DatasetInventory.get_tfrecord_dict)
+    """
+    return {
+        'id': record_data['id'],
+        'n_images': record_data['n_images'],
+        'n_labels': record_data['n_labels'],
+        'image_paths': record_data['image_paths'],
+        'meta_data': record_data['meta_data'],
+        'labelstext': record_data['labelstext'],
+        'labels': {k.split('label/', 1)[1]: v
+                   for k, v in record_data.items()
+                   if k.startswith('label/')}}
+
+
+def write_metadata(tfr_path, tfrecord_dict, record_ids):
+    """ Write the metadata of the records 'record_ids' of a TFRecord file
+        in the order they were written (atomically)
+    """
+    path = metadata_path(tfr_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for record_id in record_ids:
+            metadata = record_metadata(tfrecord_dict[record_id])
+            f.write(json.dumps(metadata, sort_keys=True) + '\n')
+    os.replace(tmp_path, path)
+
+
+def read_metadata(tfr_path):
+    """ Read the metadata sidecar of a TFRecord file
+        Returns: {record_id: metadata}
+    """
+    metadata = dict()
+    with open(metadata_path(tfr_path), 'r') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            record = json.loads(line)
+            metadata[record['id']] = record
+    return metadata
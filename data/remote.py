@@ -0,0 +1,308 @@
+""" Fetch Images over HTTP(S) - asyncio HTTP/1.1 Client with a bounded
+    Connection Pool, Retries and ordered Prefetching
+"""
+import ssl
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from urllib.parse import urlsplit, urljoin, quote
+
+from data.stats import NO_STATS, tag_stage
+
+
+logger = logging.getLogger(__name__)
+
+# responses that are retried, other error responses fail immediately
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+REDIRECT_STATUS_CODES = (301, 302, 303, 307, 308)
+
+
+def is_remote_path(path):
+    """ Check whether a path is an http(s) url """
+    return isinstance(path, str) and \
+        path.lower().startswith(('http://', 'https://'))
+
+
+def join_url(root_url, path):
+    """ Append a (relative) path to a root url """
+    return root_url.rstrip('/') + '/' + quote(path.lstrip('/'), safe='/')
+
+
+class HTTPError(IOError):
+    """ Error response of an HTTP server """
+    def __init__(self, url, status, reason=''):
+        super(HTTPError, self).__init__(
+            "HTTP %s %s for %s" % (status, reason, url))
+        self.url = url
+        self.status = status
+        self.reason = reason
+
+    def __reduce__(self):
+        # errors are sent to worker processes with the fetched images
+        return (HTTPError, (self.url, self.status, self.reason),
+                self.__dict__)
+
+
+class _Connection(object):
+    """ Open (keep-alive) connection to a host """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def is_usable(self):
+        return not self.writer.transport.is_closing() and \
+            not self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncHTTPClient(object):
+    """ Minimal asyncio HTTP/1.1 client for GET requests
+
+        At most 'max_connections' connections are open at any time (over
+        all hosts), idle connections are kept alive and re-used. Failed
+        requests (connection errors, timeouts and 408/429/5xx responses)
+        are retried 'max_retries' times with exponential backoff.
+
+        Must be created and used in the same event loop.
+    """
+    def __init__(self, max_connections=16, max_retries=3, timeout=30,
+                 backoff=0.5, max_redirects=5, stats=NO_STATS):
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_redirects = max_redirects
+        self.stats = stats
+        self._slots = asyncio.Semaphore(max_connections)
+        self._idle = dict()
+        self._ssl_context = None
+        self.n_connections_opened = 0
+
+    async def get(self, url):
+        """ Get the body of a url, raises HTTPError or IOError """
+        for attempt in range(0, self.max_retries + 1):
+            try:
+                return await self._get_following_redirects(url)
+            except (HTTPError, OSError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError, ValueError) as e:
+                retry = not isinstance(e, HTTPError) or \
+                    e.status in RETRY_STATUS_CODES
+                if not retry or attempt == self.max_retries:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise IOError("Timeout fetching %s" % url)
+                    raise
+                self.stats.count('fetch_retries')
+                delay = self.backoff * (2 ** attempt) * \
+                    (0.5 + random.random())
+                logger.debug("Failed to fetch %s (%s) - retrying in %.1fs" %
+                             (url, str(e), delay))
+                await asyncio.sleep(delay)
+
+    async def _get_following_redirects(self, url):
+        for _ in range(0, self.max_redirects + 1):
+            status, reason, headers, body = await asyncio.wait_for(
+                self._request(url), self.timeout)
+            if status in REDIRECT_STATUS_CODES and 'location' in headers:
+                url = urljoin(url, headers['location'])
+                continue
+            if status != 200:
+                raise HTTPError(url, status, reason)
+            return body
+        raise HTTPError(url, status, 'too many redirects')
+
+    async def _request(self, url):
+        """ Send a GET request on a pooled connection """
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+
+        async with self._slots:
+            connection = await self._acquire(key)
+            reusable = False
+            try:
+                connection.writer.write((
+                    "GET %s HTTP/1.1\r\n"
+                    "Host: %s\r\n"
+                    "Accept-Encoding: identity\r\n"
+                    "Connection: keep-alive\r\n\r\n" %
+                    (target, parts.netloc)).encode('latin-1'))
+                status, reason, headers, body, reusable = \
+                    await self._read_response(connection.reader)
+                return status, reason, headers, body
+            finally:
+                if reusable:
+                    self._idle.setdefault(key, list()).append(connection)
+                else:
+                    connection.close()
+
+    async def _acquire(self, key):
+        """ Get an idle connection to a host or open a new one """
+        idle = self._idle.get(key, list())
+        while len(idle) > 0:
+            connection = idle.pop()
+            if connection.is_usable():
+                return connection
+            connection.close()
+
+        # an idle connection to another host occupies a slot
+        for connections in self._idle.values():
+            if len(connections) > 0:
+                connections.pop(0).close()
+                break
+
+        scheme, host, port = key
+        if scheme == 'https':
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=self._ssl_context, server_hostname=host)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        self.n_connections_opened += 1
+        return _Connection(reader, writer)
+
+    async def _read_response(self, reader):
+        """ Read status, headers and body of a response """
+        status_line = await reader.readuntil(b'\r\n')
+        version, status, reason = \
+            (status_line.decode('latin-1').strip().split(' ', 2) + [''])[0:3]
+        status = int(status)
+
+        headers = dict()
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and \
+            headers.get('connection', '').lower() != 'close'
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = list()
+            while True:
+                size_line = await reader.readuntil(b'\r\n')
+                size = int(size_line.split(b';')[0], 16)
+                if size == 0:
+                    # skip trailers
+                    while await reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+
+        return status, reason, headers, body, keep_alive
+
+    def close(self):
+        """ Close all idle connections """
+        for connections in self._idle.values():
+            for connection in connections:
+                connection.close()
+        self._idle = dict()
+
+
+class RemoteImageFetcher(object):
+    """ Fetch images with an AsyncHTTPClient that runs in an event loop in
+        a background thread
+
+        Example:
+        fetcher = RemoteImageFetcher(max_connections=16)
+        for images in fetcher.prefetch([[url1, url2], [url3]]):
+            # images: {url: bytes or exception}, in the order of the lists
+        fetcher.close()
+
+        'prefetch_size' lists of urls are fetched ahead of the one that is
+        consumed, the number of simultaneous requests is limited by
+        'max_connections'.
+    """
+    def __init__(self, max_connections=16, max_retries=3, timeout=30,
+                 prefetch_size=64, stats=NO_STATS):
+        self.prefetch_size = prefetch_size
+        self.stats = stats
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+        self.client = self._run(self._create_client(
+            max_connections, max_retries, timeout))
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _run(self, coroutine):
+        """ Run a coroutine in the event loop and wait for the result """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _create_client(self, max_connections, max_retries, timeout):
+        return AsyncHTTPClient(
+            max_connections=max_connections, max_retries=max_retries,
+            timeout=timeout, stats=self.stats)
+
+    async def _get_timed(self, url):
+        """ Fetch a url, errors are returned instead of raised """
+        start = time.perf_counter()
+        try:
+            body = await self.client.get(url)
+        except Exception as e:
+            self.stats.count('fetch_failed')
+            tag_stage(e, 'fetch')
+            return e
+        self.stats.add_time('fetch', time.perf_counter() - start)
+        self.stats.count('bytes_fetched', len(body))
+        return body
+
+    async def _get_all(self, urls):
+        results = await asyncio.gather(*[self._get_timed(x) for x in urls])
+        return dict(zip(urls, results))
+
+    def fetch(self, url):
+        """ Fetch a single url, raises on errors """
+        result = self._run(self._get_timed(url))
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def prefetch(self, url_lists):
+        """ Fetch lists of urls ahead of consuming them, yields
+            {url: bytes or exception} for each list in input order
+        """
+        url_lists = iter(url_lists)
+        pending = deque()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.prefetch_size:
+                try:
+                    urls = next(url_lists)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append(asyncio.run_coroutine_threadsafe(
+                    self._get_all(list(urls)), self.loop))
+            if len(pending) == 0:
+                break
+            yield pending.popleft().result()
+
+    def close(self):
+        """ Close all connections and stop the event loop """
+        async def close_client():
+            self.client.close()
+        self._run(close_client())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
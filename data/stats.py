@@ -0,0 +1,207 @@
+""" Timing Histograms and Counters of the Dataset Creation Pipeline """
+import os
+import json
+import math
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+
+class TimingHistogram(object):
+    """ Histogram of durations with log2-spaced buckets
+
+        Bucket k counts durations in [2^k, 2^(k+1)) microseconds, only
+        non-empty buckets are stored. Histograms of different processes
+        can be merged.
+    """
+    def __init__(self):
+        self.buckets = dict()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        """ Add a duration in seconds """
+        micro_seconds = seconds * 1e6
+        if micro_seconds < 1:
+            bucket = 0
+        else:
+            bucket = int(math.log2(micro_seconds))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """ Add all durations of another histogram """
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q):
+        """ Upper bound (in seconds) of the bucket of the q-quantile """
+        if self.count == 0:
+            return None
+        threshold = q * self.count
+        cumulative = 0
+        for bucket in sorted(self.buckets.keys()):
+            cumulative += self.buckets[bucket]
+            if cumulative >= threshold:
+                return min(2 ** (bucket + 1) / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        """ Summary in milliseconds """
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'total_s': round(self.total, 3),
+            'mean_ms': round(1000 * self.total / self.count, 3),
+            'min_ms': round(1000 * self.min, 3),
+            'max_ms': round(1000 * self.max, 3),
+            'p50_ms': round(1000 * self.quantile(0.5), 3),
+            'p90_ms': round(1000 * self.quantile(0.9), 3),
+            'p99_ms': round(1000 * self.quantile(0.99), 3),
+            'histogram_ms': {
+                '<%s' % (2 ** (k + 1) / 1000): v
+                for k, v in sorted(self.buckets.items())}}
+
+
+class PipelineStats(object):
+    """ Per-stage timing histograms and counters
+
+        Worker processes collect the stats of their records in a fresh
+        PipelineStats that is merged into the stats of the main process.
+        Updates are thread-safe.
+
+        Example:
+        stats = PipelineStats()
+        with stats.time('decode'):
+            img.load()
+        stats.counters['bytes_read'] += n_bytes
+    """
+    def __init__(self):
+        self.timings = dict()
+        self.counters = Counter()
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add_time(self, stage, seconds):
+        """ Add the duration of a stage """
+        with self._lock:
+            if stage not in self.timings:
+                self.timings[stage] = TimingHistogram()
+            self.timings[stage].add(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """ Time the enclosed block as 'stage', exceptions raised in the
+            block are tagged with the (innermost) stage - see failed_stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            tag_stage(e, stage)
+            raise
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def count(self, counter, value=1):
+        """ Increment a counter """
+        with self._lock:
+            self.counters[counter] += value
+
+    def merge(self, other):
+        """ Add the timings and counters of other stats """
+        with self._lock:
+            for stage, histogram in other.timings.items():
+                if stage not in self.timings:
+                    self.timings[stage] = TimingHistogram()
+                self.timings[stage].merge(histogram)
+            self.counters.update(other.counters)
+
+    def report(self):
+        """ Create a report with throughput, counters and stage timings """
+        with self._lock:
+            elapsed = time.time() - self.start_time
+            counters = dict(self.counters)
+            timings = {stage: histogram.to_dict()
+                       for stage, histogram in self.timings.items()}
+
+        def per_second(value):
+            return round(value / max(elapsed, 1e-9), 3)
+
+        return {
+            'elapsed_s': round(elapsed, 3),
+            'throughput': {
+                'records_per_s': per_second(
+                    counters.get('records_written', 0)),
+                'images_per_s': per_second(counters.get('images', 0)),
+                'mb_read_per_s': per_second(
+                    counters.get('bytes_read', 0) / 2**20),
+                'mb_written_per_s': per_second(
+                    counters.get('bytes_written', 0) / 2**20)},
+            'counters': counters,
+            'stages': timings}
+
+    def write_report(self, path):
+        """ Write the report as json (atomically) """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+
+def tag_stage(exception, stage):
+    """ Remember the stage an exception was raised in """
+    if getattr(exception, 'pipeline_stage', None) is None:
+        try:
+            exception.pipeline_stage = stage
+        except AttributeError:
+            pass
+
+
+def failed_stage(exception, default=None):
+    """ Innermost stage an exception was raised in or 'default' """
+    return getattr(exception, 'pipeline_stage', None) or default
+
+
+class _NoStats(object):
+    """ Stand-in for PipelineStats that records nothing """
+    @contextmanager
+    def time(self, stage):
+        try:
+            yield
+        except Exception as e:
+            tag_stage(e, stage)
+            raise
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def count(self, counter, value=1):
+        pass
+
+
+NO_STATS = _NoStats()
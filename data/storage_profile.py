@@ -0,0 +1,92 @@
+""" Storage Profile - Size of the stored Images derived from the Model
+
+Training resizes each image such that its smaller side is sampled from
+[resize_side_min, resize_side_max] (aspect preserving) and randomly crops
+output_height x output_width. Evaluation resizes the smaller side to
+resize_side_min and crops the center. With 'ignore_aspect_ratio' both sides
+are resized to up to 1.2 * resize_side_max during training.
+
+Hence images that are stored with their smaller side at the largest of
+these sizes ('min_side') contain all pixels the model can use. Larger
+images only cost disk space and decoding time.
+"""
+import os
+import logging
+
+from data.manifest import DatasetManifest, MANIFEST_FILE_NAME
+
+
+logger = logging.getLogger(__name__)
+
+
+def required_min_side(image_processing, ignore_aspect_ratio=False):
+    """ Smallest side an image must have to not be enlarged by any of the
+        train and eval pre-processing steps of a model
+    """
+    sizes = [image_processing['output_height'],
+             image_processing['output_width'],
+             image_processing['resize_side_min'],
+             image_processing['resize_side_max']]
+    if ignore_aspect_ratio:
+        # see preprocess_for_train
+        sizes.append(int(1.2 * image_processing['resize_side_max']))
+    return max(sizes)
+
+
+def create_storage_profile(model_name, image_processing,
+                           ignore_aspect_ratio=False):
+    """ Storage profile of a model from its 'image_processing' block in
+        config/models.yaml
+    """
+    return {
+        'model': model_name,
+        'ignore_aspect_ratio': ignore_aspect_ratio,
+        'min_side': required_min_side(image_processing, ignore_aspect_ratio),
+        'image_processing': {
+            k: image_processing[k] for k in
+            ['output_height', 'output_width',
+             'resize_side_min', 'resize_side_max']}}
+
+
+def check_storage_profile(storage_profile, image_processing,
+                          ignore_aspect_ratio=False):
+    """ Check whether images stored with 'storage_profile' are large enough
+        for a model, returns a list of problems (empty if compatible)
+    """
+    needed = required_min_side(image_processing, ignore_aspect_ratio)
+    problems = list()
+    if 'min_side' in storage_profile:
+        if storage_profile['min_side'] < needed:
+            problems.append(
+                "images are stored with a smaller side of %s pixels (for "
+                "model %s) but the model needs %s pixels" %
+                (storage_profile['min_side'], storage_profile.get('model'),
+                 needed))
+    elif storage_profile.get('max_side') is not None:
+        if storage_profile['max_side'] < needed:
+            problems.append(
+                "images are stored with a larger side of at most %s pixels "
+                "but the model needs a smaller side of %s pixels" %
+                (storage_profile['max_side'], needed))
+    return problems
+
+
+def check_tfr_files_storage_profile(tfr_files, image_processing,
+                                    ignore_aspect_ratio=False):
+    """ Check the storage profiles in the dataset manifests of the
+        directories of 'tfr_files', logs and returns all problems
+    """
+    problems = list()
+    tfr_dirs = sorted(set([os.path.dirname(x) for x in tfr_files]))
+    for tfr_dir in tfr_dirs:
+        if not os.path.exists(os.path.join(tfr_dir, MANIFEST_FILE_NAME)):
+            continue
+        storage_profile = DatasetManifest(tfr_dir).get_storage_profile()
+        if storage_profile is None:
+            continue
+        for problem in check_storage_profile(
+                storage_profile, image_processing, ignore_aspect_ratio):
+            logger.warning("TFRecord files in %s do not match the model - %s"
+                           % (tfr_dir, problem))
+            problems.append(problem)
+    return problems
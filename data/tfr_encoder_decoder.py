@@ -1,18 +1,47 @@
 """ Class To Encode and Decode TFRecords"""
+import os
 import logging
 
 import tensorflow as tf
 
 from data.utils import (
         wrap_int64, wrap_bytes, wrap_dict_bytes_list, wrap_dict_int64_list,
-        _bytes_feature_list,
-        _bytes_feature_list_str)
+        _bytes_feature_list, _int64_feature_list,
+        _bytes_feature_list_str, read_json)
+from data.wire_format import (
+        SequenceExampleEncoder, ExampleEncoder, bytes_feature, int64_feature,
+        feature_list)
+from data.manifest import DatasetManifest, MANIFEST_FILE_NAME
+from data.record_metadata import metadata_path
+from data.image import (
+        decode_and_crop_for_train, decode_at_scale, decode_jpeg_scaled)
 
 logger = logging.getLogger(__name__)
 
+# per-image sizes stored by the writer (missing in older TFRecord files)
+IMAGE_SIZE_FEATURES = ['image_heights', 'image_widths', 'image_channels',
+                       'image_n_bytes']
+
+# formats of the records (recorded in the dataset manifest)
+SEQUENCE_EXAMPLE_FORMAT = 'sequence_example'
+FLAT_EXAMPLE_FORMAT = 'flat_example'
+
+# label mapping of a dataset, written next to its TFRecord files
+LABEL_MAPPING_FILE_NAME = 'label_mapping.json'
+
 
 class TFRecordEncoderDecoder(object):
     """ Define Encoder and Decoder for a specific TFRecord file """
+
+    # name of the record format, whether the records contain all data of
+    # a record or the writer has to store the metadata in sidecar files
+    record_format = None
+    stores_metadata = True
+
+    # whether batches of records can be decoded at once (decode_batch,
+    # see DatasetReader.get_iterator)
+    supports_batch_parse = False
+
     def __init__(self):
         logger.info("Initializing TFRecordEncoderDecoder")
 
@@ -22,10 +51,24 @@ class TFRecordEncoderDecoder(object):
     def decode_record(self):
         raise NotImplementedError
 
+    def check_label_mapping(self, label_to_numeric_mapping, output_labels,
+                            tfr_files):
+        """ Check that the labels of 'tfr_files' can be mapped with
+            'label_to_numeric_mapping', string labels can be mapped with
+            any mapping
+        """
+        return
+
 
 class DefaultTFRecordEncoderDecoder(TFRecordEncoderDecoder):
     """ Default TFREncoder / Decoder """
 
+    record_format = SEQUENCE_EXAMPLE_FORMAT
+
+    def __init__(self):
+        super(DefaultTFRecordEncoderDecoder, self).__init__()
+        self._wire_encoder = SequenceExampleEncoder()
+
     def _convert_to_tfr_data_format(self, record):
         """ Convert a record to a tfr format """
 
@@ -53,10 +96,49 @@ class DefaultTFRecordEncoderDecoder(TFRecordEncoderDecoder):
             **label_num_features
         }
 
+        for key in IMAGE_SIZE_FEATURES:
+            if key in record:
+                tfr_data[key] = _int64_feature_list(record[key])
+
         return tfr_data
 
     def encode_record(self, record_data):
-        """ Encode Record to Serialized String """
+        """ Encode Record to Serialized String
+
+            The record is written directly in the protobuf wire format,
+            the output is identical to _encode_record_proto.
+        """
+        context = {
+            'id': bytes_feature([record_data['id']]),
+            'n_images': int64_feature([record_data['n_images']]),
+            'n_labels': int64_feature([record_data['n_labels']]),
+            'meta_data': bytes_feature([record_data['meta_data']]),
+            'labelstext': bytes_feature([record_data['labelstext']])}
+
+        feature_lists = {
+            'image_paths': feature_list(
+                [bytes_feature([x]) for x in record_data['image_paths']]),
+            'images': feature_list(
+                [bytes_feature([x]) for x in record_data['images']])}
+
+        for key, values in record_data.items():
+            if 'label_num/' in key or key in IMAGE_SIZE_FEATURES:
+                wrap = int64_feature
+            elif 'label/' in key:
+                wrap = bytes_feature
+            else:
+                continue
+            assert type(values) is list,\
+                "Input dictionary does not exclusively contain" + \
+                " lists - inspect json format of input file"
+            feature_lists[key] = feature_list([wrap([x]) for x in values])
+
+        return self._wire_encoder.encode(context, feature_lists)
+
+    def _encode_record_proto(self, record_data):
+        """ Encode Record to Serialized String with the tf.train protos
+            (reference implementation of encode_record)
+        """
 
         tfr_data_dict = self._convert_to_tfr_data_format(record_data)
 
@@ -80,8 +162,8 @@ class DefaultTFRecordEncoderDecoder(TFRecordEncoderDecoder):
                 context=feature,
                 feature_lists=feature_lists)
 
-        # Serialize the data.
-        serialized = example.SerializeToString()
+        # Serialize the data (map entries sorted by key)
+        serialized = example.SerializeToString(deterministic=True)
 
         return serialized
 
@@ -95,9 +177,37 @@ class DefaultTFRecordEncoderDecoder(TFRecordEncoderDecoder):
                       decode_images=True,
                       numeric_labels=False,
                       return_only_ml_data=True,
-                      only_return_one_label=True
+                      only_return_one_label=True,
+                      min_image_side=None,
+                      decode_min_side=None,
+                      fused_decode_crop=False,
+                      image_index=None
                       ):
-        """ Decode TFRecord and return dictionary """
+        """ Decode TFRecord and return dictionary
+
+            min_image_side: choose only images whose smaller side has at
+             least that many pixels (if a record has none, any image)
+            decode_min_side: decode JPEGs at 1/2, 1/4 or 1/8 scale if the
+             smaller side still has at least that many pixels (the size
+             is read from the JPEG header if it is not stored)
+            fused_decode_crop: for training pre-processing (with
+             'is_training' in 'image_pre_processing_args') sample the
+             random crop from the stored image size and decode only that
+             region of the JPEG (see data.image.decode_and_crop_for_train),
+             'image_pre_processing_fun' is then called with
+             'is_cropped=True'
+
+            'min_image_side' and 'fused_decode_crop' use the stored image
+            sizes and have no effect on records without them.
+
+            Images of a record:
+            choose_random_image: decode a random image of the record,
+             otherwise all images (with 'min_image_side') are decoded and
+             pre-processed and stacked ([n_images, height, width, channels],
+             needs 'image_pre_processing_fun')
+            image_index: decode the image with that index (a tensor, e.g.
+             from image_indices), overrides 'choose_random_image'
+        """
         # fixed size Features - ID and labels
         if return_only_ml_data:
             context_features = {
@@ -140,6 +250,12 @@ class DefaultTFRecordEncoderDecoder(TFRecordEncoderDecoder):
                 **label_num_features
                 }
 
+        use_image_sizes = decode_images and \
+            (min_image_side is not None or decode_min_side is not None or
+             fused_decode_crop)
+        if use_image_sizes or not return_only_ml_data:
+            sequence_features.update(self._image_size_features())
+
         # Parse the serialized data so we get a dict with our data.
         context, sequence = tf.parse_single_sequence_example(
                 serialized=serialized_example,
@@ -179,27 +295,600 @@ class DefaultTFRecordEncoderDecoder(TFRecordEncoderDecoder):
                        if label_prefix not in k},
                     **parsed_labels}
 
+        image = self._decode_and_preprocess_images(
+            sequence, n_color_channels, min_image_side, decode_min_side,
+            image_pre_processing_fun, image_pre_processing_args,
+            fused_decode_crop, choose_random_image, image_index)
+        return ({'images': image},
+                {**{k: v for k, v in context.items()},
+                 **{k: v for k, v in sequence.items()
+                 if label_prefix not in k and 'images' not in k and
+                 (k not in IMAGE_SIZE_FEATURES or not return_only_ml_data)},
+                **parsed_labels})
+
+    def _decode_random_image(self, sequence, n_color_channels,
+                             min_image_side=None, decode_min_side=None):
+        """ Decode a random image of a record (see decode_record) """
+        rand, n_images = self._random_image_index(sequence, min_image_side)
+        return self._decode_image(
+            sequence, rand, n_images, n_color_channels, decode_min_side)
+
+    def _decode_and_preprocess_images(self, sequence, n_color_channels,
+                                      min_image_side, decode_min_side,
+                                      image_pre_processing_fun,
+                                      image_pre_processing_args,
+                                      fused_decode_crop=False,
+                                      choose_random_image=True,
+                                      image_index=None):
+        """ Decode and pre-process the image at 'image_index', a random
+            image or all images of a record (see decode_record)
+        """
+        if image_index is not None:
+            n_images = tf.shape(sequence['images'])[0]
+            return self._decode_and_preprocess_image(
+                sequence, tf.to_int32(image_index), n_images,
+                n_color_channels, decode_min_side, image_pre_processing_fun,
+                image_pre_processing_args, fused_decode_crop)
+
         if choose_random_image:
-            # number of images in that record
-            n_images = tf.shape(sequence['images'])
+            return self._decode_and_preprocess_random_image(
+                sequence, n_color_channels, min_image_side, decode_min_side,
+                image_pre_processing_fun, image_pre_processing_args,
+                fused_decode_crop)
+
+        if image_pre_processing_fun is None:
+            raise ValueError("Decoding all images of a record needs an "
+                             "image_pre_processing_fun (to stack them)")
+        n_images = tf.shape(sequence['images'])[0]
+        indices = self._image_indices(sequence, n_images, min_image_side)
+        return tf.map_fn(
+            lambda index: self._decode_and_preprocess_image(
+                sequence, index, n_images, n_color_channels,
+                decode_min_side, image_pre_processing_fun,
+                image_pre_processing_args, fused_decode_crop),
+            indices, dtype=tf.float32, back_prop=False)
+
+    def _decode_and_preprocess_random_image(self, sequence, n_color_channels,
+                                            min_image_side, decode_min_side,
+                                            image_pre_processing_fun,
+                                            image_pre_processing_args,
+                                            fused_decode_crop=False):
+        """ Decode and pre-process a random image of a record (see
+            decode_record)
+        """
+        if image_pre_processing_fun is None:
+            return self._decode_random_image(
+                sequence, n_color_channels, min_image_side, decode_min_side)
+
+        rand, n_images = self._random_image_index(sequence, min_image_side)
+        return self._decode_and_preprocess_image(
+            sequence, rand, n_images, n_color_channels, decode_min_side,
+            image_pre_processing_fun, image_pre_processing_args,
+            fused_decode_crop)
+
+    def _decode_and_preprocess_image(self, sequence, index, n_images,
+                                     n_color_channels, decode_min_side,
+                                     image_pre_processing_fun,
+                                     image_pre_processing_args,
+                                     fused_decode_crop=False):
+        """ Decode and pre-process an image of a record, decode only the
+            region the training pre-processing crops if 'fused_decode_crop'
+            (see decode_record)
+        """
+        if image_pre_processing_fun is None:
+            return self._decode_image(
+                sequence, index, n_images, n_color_channels, decode_min_side)
+
+        def pre_process(image, **kwargs):
+            return image_pre_processing_fun(
+                **{**image_pre_processing_args, 'image': image, **kwargs})
+
+        if not fused_decode_crop or \
+           not image_pre_processing_args.get('is_training', False):
+            return pre_process(self._decode_image(
+                sequence, index, n_images, n_color_channels,
+                decode_min_side))
+
+        crop_args = {
+            'output_height': image_pre_processing_args['output_height'],
+            'output_width': image_pre_processing_args['output_width'],
+            'resize_side_min': image_pre_processing_args['resize_side_min'],
+            'resize_side_max': image_pre_processing_args['resize_side_max'],
+            'ignore_aspect_ratio': image_pre_processing_args.get(
+                'ignore_aspect_ratio', False)}
+
+        def decode_and_crop():
+            height = sequence['image_heights'][index]
+            width = sequence['image_widths'][index]
+
+            def decode_crop(ratio):
+                return lambda: decode_and_crop_for_train(
+                    sequence['images'][index], height, width,
+                    n_color_channels=n_color_channels, ratio=ratio,
+                    **crop_args)
+
+            if decode_min_side is None:
+                image = decode_crop(1)()
+            else:
+                image = decode_at_scale(
+                    tf.minimum(height, width), decode_min_side, decode_crop)
+            return pre_process(image, is_cropped=True)
+
+        def decode_and_pre_process():
+            return pre_process(self._decode_image(
+                sequence, index, n_images, n_color_channels,
+                decode_min_side))
+
+        return tf.cond(self._has_image_sizes(sequence, n_images),
+                       decode_and_crop, decode_and_pre_process)
+
+    def _random_image_index(self, sequence, min_image_side=None):
+        """ Index of a random image of a record and the number of images """
+        # number of images in that record
+        n_images = tf.shape(sequence['images'])[0]
 
+        if min_image_side is None:
             # select a random image of the record
-            rand = tf.random_uniform([], minval=0, maxval=n_images[0],
+            rand = tf.random_uniform([], minval=0, maxval=n_images,
                                      dtype=tf.int32)
+        else:
+            candidates = self._images_with_min_side(
+                sequence, n_images, min_image_side)
+            rand = candidates[tf.random_uniform(
+                [], minval=0, maxval=tf.size(candidates),
+                dtype=tf.int32)]
+        return rand, n_images
+
+    def _decode_image(self, sequence, index, n_images, n_color_channels,
+                      decode_min_side=None):
+        """ Decode an image of a record to a tensor """
+        if decode_min_side is None:
+            return tf.image.decode_image(sequence['images'][index],
+                                         channels=n_color_channels)
+        return self._decode_image_scaled(
+            sequence, index, n_images, n_color_channels, decode_min_side)
+
+    def _image_indices(self, sequence, n_images, min_image_side=None):
+        """ Indices of the images of a record to use (with
+            'min_image_side' see _images_with_min_side)
+        """
+        if min_image_side is None:
+            return tf.range(n_images)
+        return self._images_with_min_side(sequence, n_images, min_image_side)
+
+    def _image_size_features(self):
+        """ Stored image sizes, empty for records without them """
+        return {k: tf.FixedLenSequenceFeature([], tf.int64, allow_missing=True)
+                for k in IMAGE_SIZE_FEATURES}
+
+    def _has_image_sizes(self, sequence, n_images):
+        return tf.equal(tf.size(sequence['image_heights']), n_images)
+
+    def _images_with_min_side(self, sequence, n_images, min_side):
+        """ Indices of the images whose smaller side has at least
+            'min_side' pixels, all images if there are none or if the
+            sizes are not stored
+        """
+        all_images = tf.range(n_images)
+
+        def large_images():
+            smaller_side = tf.minimum(sequence['image_heights'],
+                                      sequence['image_widths'])
+            large = tf.to_int32(tf.reshape(
+                tf.where(tf.greater_equal(smaller_side, min_side)), [-1]))
+            return tf.cond(tf.size(large) > 0,
+                           lambda: large, lambda: all_images)
+
+        return tf.cond(self._has_image_sizes(sequence, n_images),
+                       large_images, lambda: all_images)
+
+    def _decode_image_scaled(self, sequence, index, n_images,
+                             n_color_channels, decode_min_side):
+        """ Decode an image at the smallest JPEG scale whose smaller side
+            has at least 'decode_min_side' pixels (a JPEG scaled by 1/r has
+            ceil(side / r) pixels), the size is read from the JPEG header
+            if it is not stored
+        """
+        image_bytes = sequence['images'][index]
+
+        def decode_jpeg(ratio):
+            return lambda: tf.image.decode_jpeg(
+                image_bytes, channels=n_color_channels, ratio=ratio)
+
+        def decode_scaled():
+            smaller_side = tf.minimum(sequence['image_heights'][index],
+                                      sequence['image_widths'][index])
+            return decode_at_scale(
+                smaller_side, decode_min_side, decode_jpeg)
+
+        def decode_from_header():
+            return tf.cond(
+                tf.image.is_jpeg(image_bytes),
+                lambda: decode_jpeg_scaled(
+                    image_bytes, decode_min_side, n_color_channels),
+                lambda: tf.image.decode_image(
+                    image_bytes, channels=n_color_channels))
+
+        return tf.cond(self._has_image_sizes(sequence, n_images),
+                       decode_scaled, decode_from_header)
+
+    def has_image_with_min_side(self, serialized_example, min_side):
+        """ Check whether a record has an image whose smaller side has at
+            least 'min_side' pixels (True for records without stored sizes),
+            e.g. to filter records in DatasetReader.get_iterator
+        """
+        _, sequence = tf.parse_single_sequence_example(
+                serialized=serialized_example,
+                sequence_features={
+                    k: v for k, v in self._image_size_features().items()
+                    if k in ('image_heights', 'image_widths')})
+        return self._has_image_with_min_side(sequence, min_side)
+
+    def image_indices(self, serialized_example, min_image_side=None):
+        """ Indices of the images of a record to use (with 'min_image_side'
+            only images whose smaller side has at least that many pixels,
+            all if there are none), e.g. to create one example per image
+            in DatasetReader.get_iterator
+        """
+        _, sequence = tf.parse_single_sequence_example(
+                serialized=serialized_example,
+                sequence_features={
+                    'images': tf.FixedLenSequenceFeature([], tf.string),
+                    **self._image_size_features()})
+        n_images = tf.shape(sequence['images'])[0]
+        return self._image_indices(sequence, n_images, min_image_side)
 
-            # decode image to tensor
-            image = tf.image.decode_image(sequence['images'][rand],
-                                          channels=n_color_channels)
+    def _has_image_with_min_side(self, sequence, min_side):
+        smaller_side = tf.minimum(sequence['image_heights'],
+                                  sequence['image_widths'])
+        return tf.logical_or(
+            tf.equal(tf.size(smaller_side), 0),
+            tf.reduce_any(tf.greater_equal(smaller_side, min_side)))
 
-            # Pre-Process image
-            if image_pre_processing_fun is not None:
-                image_pre_processing_args['image'] = image
-                image = image_pre_processing_fun(**image_pre_processing_args)
 
+class FlatTFRecordEncoderDecoder(DefaultTFRecordEncoderDecoder):
+    """ TFREncoder / Decoder of flat records that contain only the data
+        needed for training: a tf.train.Example with the id, the images,
+        the numeric labels ('label_num/') and the image sizes
+
+        The other data of a record (image paths, meta data, string labels)
+        is written to a metadata sidecar file by the DatasetWriter
+        (see data/record_metadata.py).
+    """
+
+    record_format = FLAT_EXAMPLE_FORMAT
+    stores_metadata = False
+    supports_batch_parse = True
+
+    def __init__(self):
+        super(FlatTFRecordEncoderDecoder, self).__init__()
+        self._wire_encoder = ExampleEncoder()
+
+    def encode_record(self, record_data):
+        """ Encode Record to Serialized String """
+        features = {
+            'id': bytes_feature([record_data['id']]),
+            'images': bytes_feature(record_data['images'])}
+
+        for key, values in record_data.items():
+            if 'label_num/' in key or key in IMAGE_SIZE_FEATURES:
+                assert type(values) is list,\
+                    "Input dictionary does not exclusively contain" + \
+                    " lists - inspect json format of input file"
+                features[key] = int64_feature(values)
+
+        return self._wire_encoder.encode(features)
+
+    def _encode_record_proto(self, record_data):
+        """ Encode Record to Serialized String with the tf.train protos
+            (reference implementation of encode_record)
+        """
+        feature = {
+            'id': wrap_bytes(tf.compat.as_bytes(record_data['id'])),
+            'images': tf.train.Feature(
+                bytes_list=tf.train.BytesList(value=record_data['images']))}
+        for key, values in record_data.items():
+            if 'label_num/' in key or key in IMAGE_SIZE_FEATURES:
+                feature[key] = tf.train.Feature(
+                    int64_list=tf.train.Int64List(value=values))
+        example = tf.train.Example(
+            features=tf.train.Features(feature=feature))
+        return example.SerializeToString(deterministic=True)
+
+    def check_label_mapping(self, label_to_numeric_mapping, output_labels,
+                            tfr_files):
+        """ Check that 'label_to_numeric_mapping' maps the 'output_labels'
+            like the label mappings of the datasets of 'tfr_files', the
+            labels are stored as numbers and can not be mapped differently
+        """
+        for tfr_dir in sorted(set([os.path.dirname(x) for x in tfr_files])):
+            path = os.path.join(tfr_dir, LABEL_MAPPING_FILE_NAME)
+            if not os.path.exists(path):
+                logger.warning(
+                    "No label mapping %s found - can not check that the "
+                    "numeric labels of the TFRecord files match the label "
+                    "mapping" % path)
+                continue
+            dataset_mapping = read_json(path)
+            for label in output_labels:
+                if label_to_numeric_mapping.get(label) != \
+                   dataset_mapping.get(label):
+                    err_msg = (
+                        "Label mapping of %s differs from the label mapping "
+                        "%s of the dataset - records in the %s format store "
+                        "numeric labels, use the label mapping of the "
+                        "dataset" % (label, path, self.record_format))
+                    logger.error(err_msg)
+                    raise ValueError(err_msg)
+
+    def decode_record(self, serialized_example,
+                      output_labels,
+                      label_lookup_dict=None,
+                      image_pre_processing_fun=None,
+                      image_pre_processing_args=None,
+                      n_color_channels=3,
+                      choose_random_image=True,
+                      decode_images=True,
+                      numeric_labels=False,
+                      return_only_ml_data=True,
+                      only_return_one_label=True,
+                      min_image_side=None,
+                      decode_min_side=None,
+                      fused_decode_crop=False,
+                      image_index=None
+                      ):
+        """ Decode TFRecord and return dictionary, the output has the same
+            structure as DefaultTFRecordEncoderDecoder.decode_record
+
+            The labels are stored as numbers (according to the label
+            mapping of the dataset) and are returned as 'label/<label>'
+            (cast to the type of 'label_lookup_dict') or, with
+            'numeric_labels', as 'label_num/<label>'. They are not mapped,
+            the label mapping has to be the one of the dataset (see
+            check_label_mapping).
+
+            With 'return_only_ml_data=False' the number of images and the
+            image sizes are returned as well, all other data is in the
+            metadata sidecar files.
+        """
+        parsed = tf.parse_single_example(
+            serialized=serialized_example,
+            features=self._features(
+                output_labels, decode_images, return_only_ml_data,
+                min_image_side, decode_min_side, fused_decode_crop))
+
+        parsed_labels = self._labels(
+            parsed, output_labels, label_lookup_dict, numeric_labels,
+            only_return_one_label)
+
+        other = {'id': parsed['id']}
+        if not return_only_ml_data:
+            other['n_images'] = tf.to_int64(tf.size(parsed['images']))
+            other.update({k: parsed[k] for k in IMAGE_SIZE_FEATURES})
+
+        if not decode_images:
+            return {**other, 'images': parsed['images'], **parsed_labels}
+
+        image = self._decode_and_preprocess_images(
+            parsed, n_color_channels, min_image_side, decode_min_side,
+            image_pre_processing_fun, image_pre_processing_args,
+            fused_decode_crop, choose_random_image, image_index)
+        return ({'images': image}, {**other, **parsed_labels})
+
+    def decode_batch(self, serialized_examples,
+                     output_labels,
+                     label_lookup_dict=None,
+                     image_pre_processing_fun=None,
+                     image_pre_processing_args=None,
+                     n_color_channels=3,
+                     choose_random_image=True,
+                     decode_images=True,
+                     numeric_labels=False,
+                     return_only_ml_data=True,
+                     only_return_one_label=True,
+                     min_image_side=None,
+                     decode_min_side=None,
+                     fused_decode_crop=False,
+                     image_index=None,
+                     num_parallel_calls=4
+                     ):
+        """ Decode a batch of TFRecords, the output is the same as the one
+            of decode_record for each record, batched
+
+            The records are parsed at once and the labels of all records
+            are mapped at once, the images are decoded and pre-processed
+            with 'num_parallel_calls' records in parallel. The image sizes
+            (with 'return_only_ml_data=False') are padded with 0 and
+            the labels (with 'only_return_one_label=False') with -1 to
+            the longest record of the batch.
+
+            Only one image per record is decoded: a random one or the one
+            at 'image_index' (a tensor with an index per record). The
+            images are batched, hence 'image_pre_processing_fun' is needed
+            (to resize them to the same size).
+        """
+        parsed = tf.parse_example(
+            serialized=serialized_examples,
+            features=self._features(
+                output_labels, decode_images, return_only_ml_data,
+                min_image_side, decode_min_side, fused_decode_crop,
+                padding_label=-1))
+
+        parsed_labels = self._labels(
+            parsed, output_labels, label_lookup_dict, numeric_labels,
+            only_return_one_label, batched=True)
+
+        # images are padded with '' (stored images are never empty)
+        n_images = tf.reduce_sum(tf.to_int32(
+            tf.not_equal(parsed['images'], '')), axis=1)
+
+        other = {'id': parsed['id']}
+        if not return_only_ml_data:
+            other['n_images'] = tf.to_int64(n_images)
+            other.update({k: parsed[k] for k in IMAGE_SIZE_FEATURES})
+
+        if not decode_images:
+            return {**other, 'images': parsed['images'], **parsed_labels}
+
+        if not choose_random_image and image_index is None:
+            raise ValueError("decode_batch decodes one image per record - "
+                             "use choose_random_image or image_index")
+
+        if image_pre_processing_fun is None:
+            raise ValueError("decode_batch needs an image_pre_processing_fun "
+                             "(to batch images of different sizes)")
+
+        with_sizes = 'image_heights' in parsed
+
+        def decode_record_image(elems):
+            images, n_images, index = elems[0:3]
+            record = {'images': images[:n_images]}
+            if with_sizes:
+                # sizes are padded with 0 and missing in older records
+                sizes = dict(zip(IMAGE_SIZE_FEATURES, elems[3:]))
+                n_sizes = tf.reduce_sum(tf.to_int32(
+                    tf.greater(sizes['image_heights'], 0)))
+                record.update({k: v[:n_sizes] for k, v in sizes.items()})
+            return self._decode_and_preprocess_images(
+                record, n_color_channels, min_image_side, decode_min_side,
+                image_pre_processing_fun, image_pre_processing_args,
+                fused_decode_crop, image_index=(
+                    None if image_index is None else index))
+
+        # the index is ignored without 'image_index'
+        if image_index is None:
+            indices = tf.zeros_like(n_images)
         else:
-            raise NotImplemented("Non-Random Image-Choice not implemented")
-        return ({'images': image},
-                {**{k: v for k, v in context.items()},
-                 **{k: v for k, v in sequence.items()
-                 if label_prefix not in k and 'images' not in k},
-                **parsed_labels})
+            indices = tf.to_int32(image_index)
+        elems = (parsed['images'], n_images, indices)
+        if with_sizes:
+            elems += tuple([parsed[k] for k in IMAGE_SIZE_FEATURES])
+
+        images = tf.map_fn(
+            decode_record_image, elems, dtype=tf.float32,
+            parallel_iterations=num_parallel_calls, back_prop=False)
+
+        return ({'images': images}, {**other, **parsed_labels})
+
+    def _features(self, output_labels, decode_images, return_only_ml_data,
+                  min_image_side, decode_min_side, fused_decode_crop=False,
+                  padding_label=None):
+        """ Features to parse (see decode_record) """
+        features = {
+            'id': tf.FixedLenFeature([], tf.string),
+            'images': tf.FixedLenSequenceFeature(
+                [], tf.string, allow_missing=True),
+            **{'label_num/' + l: tf.FixedLenSequenceFeature(
+                [], tf.int64, allow_missing=True,
+                default_value=padding_label) for l in output_labels}}
+
+        use_image_sizes = decode_images and \
+            (min_image_side is not None or decode_min_side is not None or
+             fused_decode_crop)
+        if use_image_sizes or not return_only_ml_data:
+            features.update(self._image_size_features())
+        return features
+
+    def _labels(self, parsed, output_labels, label_lookup_dict,
+                numeric_labels, only_return_one_label, batched=False):
+        """ Labels as numbers or mapped like string labels would be """
+        if numeric_labels:
+            label_prefix = 'label_num/'
+        else:
+            label_prefix = 'label/'
+
+        parsed_labels = dict()
+        for label in output_labels:
+            key = label_prefix + label
+            values = parsed['label_num/' + label]
+            if batched:
+                first, first_as_list = values[:, 0], values[:, 0:1]
+            else:
+                first, first_as_list = values[0], tf.reshape(values[0], [1])
+            if label_lookup_dict is not None and not numeric_labels:
+                dtype = label_lookup_dict[key].value_dtype
+                if only_return_one_label:
+                    values = first_as_list
+                values = tf.cast(values, dtype)
+            elif only_return_one_label:
+                values = first
+            parsed_labels[key] = values
+        return parsed_labels
+
+    def has_image_with_min_side(self, serialized_example, min_side):
+        """ Check whether a record has an image whose smaller side has at
+            least 'min_side' pixels (True for records without stored sizes)
+        """
+        parsed = tf.parse_single_example(
+                serialized=serialized_example,
+                features={
+                    k: v for k, v in self._image_size_features().items()
+                    if k in ('image_heights', 'image_widths')})
+        return self._has_image_with_min_side(parsed, min_side)
+
+    def image_indices(self, serialized_example, min_image_side=None):
+        """ Indices of the images of a record to use (see
+            DefaultTFRecordEncoderDecoder.image_indices)
+        """
+        parsed = tf.parse_single_example(
+                serialized=serialized_example,
+                features={
+                    'images': tf.FixedLenSequenceFeature(
+                        [], tf.string, allow_missing=True),
+                    **self._image_size_features()})
+        n_images = tf.shape(parsed['images'])[0]
+        return self._image_indices(parsed, n_images, min_image_side)
+
+
+RECORD_FORMATS = {
+    SEQUENCE_EXAMPLE_FORMAT: DefaultTFRecordEncoderDecoder,
+    FLAT_EXAMPLE_FORMAT: FlatTFRecordEncoderDecoder}
+
+
+def create_tfr_encoder_decoder(record_format=SEQUENCE_EXAMPLE_FORMAT):
+    """ Create the encoder / decoder of a record format """
+    if record_format not in RECORD_FORMATS:
+        logger.error("Record format %s not supported - choose one of %s" %
+                     (record_format, sorted(RECORD_FORMATS.keys())))
+        raise ValueError("Record format %s not supported" % record_format)
+    return RECORD_FORMATS[record_format]()
+
+
+def record_format_of_tfr_files(tfr_files):
+    """ Record format of TFRecord files according to the dataset manifests
+        in their directories, files without a recorded format are in the
+        flat_example format if they have a metadata sidecar file and in the
+        sequence_example format otherwise
+    """
+    manifest_formats = dict()
+    record_formats = set()
+    for tfr_file in tfr_files:
+        tfr_dir = os.path.dirname(tfr_file)
+        if tfr_dir not in manifest_formats:
+            manifest_formats[tfr_dir] = None
+            if os.path.exists(os.path.join(tfr_dir, MANIFEST_FILE_NAME)):
+                manifest_formats[tfr_dir] = \
+                    DatasetManifest(tfr_dir).get_record_format()
+        record_format = manifest_formats[tfr_dir]
+        if record_format is None:
+            if os.path.exists(metadata_path(tfr_file)):
+                record_format = FLAT_EXAMPLE_FORMAT
+            else:
+                record_format = SEQUENCE_EXAMPLE_FORMAT
+        record_formats.add(record_format)
+    if len(record_formats) > 1:
+        logger.error("TFRecord files have different record formats: %s" %
+                     sorted(record_formats))
+        raise ValueError("TFRecord files have different record formats")
+    if len(record_formats) == 0:
+        return SEQUENCE_EXAMPLE_FORMAT
+    return record_formats.pop()
+
+
+def tfr_encoder_decoder_of_tfr_files(tfr_files):
+    """ Create the encoder / decoder for the record format of TFRecord
+        files (see record_format_of_tfr_files)
+    """
+    record_format = record_format_of_tfr_files(tfr_files)
+    logger.info("Record format of the TFRecord files: %s" % record_format)
+    return create_tfr_encoder_decoder(record_format)
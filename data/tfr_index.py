@@ -0,0 +1,257 @@
+""" Record Offset Index of TFRecord Files - Random Access by Record Id
+
+Each TFRecord file 'train_001-of-010.tfrecord' gets a sidecar index
+'train_001-of-010.tfrecord.index' with one line per record:
+<offset>\t<length>\t<record id>
+'offset' is the position of the record's framing (length field) in the
+uncompressed TFRecord stream, 'length' the size of the serialized record.
+"""
+import os
+import gzip
+import zlib
+import struct
+import logging
+from multiprocessing import Pool
+
+import tensorflow as tf
+
+from data.utils import detect_tfr_compression_type, masked_crc32c
+from data.tfr_encoder_decoder import (
+    record_format_of_tfr_files, SEQUENCE_EXAMPLE_FORMAT, FLAT_EXAMPLE_FORMAT)
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.index'
+
+# TFRecord framing: length (8), crc of length (4), data, crc of data (4)
+_HEADER_SIZE = 12
+_FOOTER_SIZE = 4
+
+
+def index_path(tfr_path):
+    """ Path of the index of a TFRecord file """
+    return tfr_path + INDEX_SUFFIX
+
+
+def write_index(tfr_path, index_entries):
+    """ Write the index [(record_id, offset, length), ...] of a TFRecord
+        file (atomically)
+    """
+    path = index_path(tfr_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for record_id, offset, length in index_entries:
+            f.write('%s\t%s\t%s\n' % (offset, length, record_id))
+    os.replace(tmp_path, path)
+
+
+def read_index(tfr_path):
+    """ Read the index of a TFRecord file
+        Returns: {record_id: (offset, length)}
+    """
+    index = dict()
+    with open(index_path(tfr_path), 'r') as f:
+        for line in f:
+            offset, length, record_id = line.rstrip('\n').split('\t', 2)
+            index[record_id] = (int(offset), int(length))
+    return index
+
+
+class _ZlibReader(object):
+    """ Minimal file-like reader of a zlib compressed file """
+    def __init__(self, path, block_size=2**20):
+        self.file = open(path, 'rb')
+        self.decompressor = zlib.decompressobj()
+        self.block_size = block_size
+        self.buffer = b''
+        self.position = 0
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            block = self.file.read(self.block_size)
+            if len(block) == 0:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(block)
+        data = self.buffer[0:n]
+        self.buffer = self.buffer[n:]
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset):
+        """ Seek forward by decompressing (no backward seeks) """
+        if offset < self.position:
+            raise ValueError("_ZlibReader can only seek forward")
+        while self.position < offset:
+            if len(self.read(min(offset - self.position, 2**20))) == 0:
+                break
+
+    def close(self):
+        self.file.close()
+
+
+def _open_tfr_stream(tfr_path):
+    """ Open a TFRecord file as an uncompressed stream """
+    compression_type = detect_tfr_compression_type(tfr_path)
+    if compression_type == 'GZIP':
+        return gzip.open(tfr_path, 'rb')
+    if compression_type == 'ZLIB':
+        return _ZlibReader(tfr_path)
+    return open(tfr_path, 'rb')
+
+
+def _read_record_at(stream, offset, length, tfr_path, verify_crc=False):
+    """ Read the serialized record at 'offset' of the uncompressed stream """
+    stream.seek(offset)
+    header = stream.read(_HEADER_SIZE)
+    record_length, length_crc = struct.unpack('<QI', header)
+    if record_length != length or length_crc != masked_crc32c(header[0:8]):
+        raise ValueError(
+            "Index of %s does not match the file at offset %s - re-create "
+            "the index" % (tfr_path, offset))
+    data = stream.read(length)
+    if verify_crc:
+        data_crc, = struct.unpack('<I', stream.read(_FOOTER_SIZE))
+        if data_crc != masked_crc32c(data):
+            raise ValueError("Corrupt record in %s at offset %s" %
+                             (tfr_path, offset))
+    return data
+
+
+def record_id_of_sequence_example(serialized_record):
+    """ Extract the record id of a serialized SequenceExample """
+    example = tf.train.SequenceExample.FromString(serialized_record)
+    return example.context.feature['id'].bytes_list.value[0].decode('utf-8')
+
+
+def record_id_of_example(serialized_record):
+    """ Extract the record id of a serialized Example (flat_example) """
+    example = tf.train.Example.FromString(serialized_record)
+    return example.features.feature['id'].bytes_list.value[0].decode('utf-8')
+
+
+# protos and record id functions of the record formats
+# (see data/tfr_encoder_decoder.py)
+RECORD_PROTOS = {
+    SEQUENCE_EXAMPLE_FORMAT: tf.train.SequenceExample,
+    FLAT_EXAMPLE_FORMAT: tf.train.Example}
+
+RECORD_ID_FUNS = {
+    SEQUENCE_EXAMPLE_FORMAT: record_id_of_sequence_example,
+    FLAT_EXAMPLE_FORMAT: record_id_of_example}
+
+
+def iterate_records(tfr_path):
+    """ Iterate over the serialized records of a (compressed) TFRecord
+        file, yields (offset, serialized record)
+    """
+    stream = _open_tfr_stream(tfr_path)
+    try:
+        offset = 0
+        while True:
+            header = stream.read(_HEADER_SIZE)
+            if len(header) == 0:
+                break
+            if len(header) < _HEADER_SIZE:
+                raise ValueError("Truncated record in %s at offset %s" %
+                                 (tfr_path, offset))
+            length, = struct.unpack('<Q', header[0:8])
+            data = stream.read(length)
+            stream.read(_FOOTER_SIZE)
+            if len(data) < length:
+                raise ValueError("Truncated record in %s at offset %s" %
+                                 (tfr_path, offset))
+            yield offset, data
+            offset += _HEADER_SIZE + length + _FOOTER_SIZE
+    finally:
+        stream.close()
+
+
+def create_index(tfr_path, record_id_fun=None):
+    """ Create the index of an existing TFRecord file by scanning it, the
+        record ids are extracted with 'record_id_fun' (default: according
+        to the record format of the file)
+        Returns: number of indexed records
+    """
+    if record_id_fun is None:
+        record_id_fun = RECORD_ID_FUNS[record_format_of_tfr_files([tfr_path])]
+    index_entries = [(record_id_fun(data), offset, len(data))
+                     for offset, data in iterate_records(tfr_path)]
+    write_index(tfr_path, index_entries)
+    return len(index_entries)
+
+
+def create_indexes_parallel(tfr_paths, n_processes=4):
+    """ Create the indexes of existing TFRecord files in parallel
+        Returns: number of indexed records
+    """
+    if n_processes <= 1:
+        return sum([create_index(x) for x in tfr_paths])
+    pool = Pool(processes=n_processes)
+    counts = list(pool.imap_unordered(create_index, tfr_paths))
+    pool.close()
+    pool.join()
+    return sum(counts)
+
+
+class IndexedTFRecordReader(object):
+    """ Read single records from TFRecord files by record id using the
+        sidecar indexes
+
+        Example:
+        reader = IndexedTFRecordReader(find_tfr_files('./tfr_files/'))
+        example = reader.get_record('id_123')
+
+        Records are decoded with 'decode_fun' (default: parse as
+        tf.train.SequenceExample or tf.train.Example according to the record
+        format of the files). Compressed files can not be seeked, they are
+        decompressed up to the requested records.
+    """
+    def __init__(self, tfr_paths, decode_fun=None, verify_crc=False):
+        record_format = record_format_of_tfr_files(tfr_paths)
+        if decode_fun is None:
+            decode_fun = RECORD_PROTOS[record_format].FromString
+        self.decode_fun = decode_fun
+        self.verify_crc = verify_crc
+        self.locations = dict()
+        for tfr_path in tfr_paths:
+            if not os.path.exists(index_path(tfr_path)):
+                logger.warning("No index for %s - creating it" % tfr_path)
+                create_index(tfr_path, RECORD_ID_FUNS[record_format])
+            for record_id, (offset, length) in read_index(tfr_path).items():
+                self.locations[record_id] = (tfr_path, offset, length)
+
+    def get_serialized_records(self, record_ids):
+        """ Read serialized records {record_id: serialized_record} """
+        # read the records of each file in order of their offsets
+        by_file = dict()
+        for record_id in record_ids:
+            if record_id not in self.locations:
+                raise KeyError("Record %s not found in any index" % record_id)
+            tfr_path, offset, length = self.locations[record_id]
+            by_file.setdefault(tfr_path, list()).append(
+                (offset, length, record_id))
+
+        serialized_records = dict()
+        for tfr_path, locations in by_file.items():
+            stream = _open_tfr_stream(tfr_path)
+            try:
+                for offset, length, record_id in sorted(locations):
+                    serialized_records[record_id] = _read_record_at(
+                        stream, offset, length, tfr_path, self.verify_crc)
+            finally:
+                stream.close()
+        return serialized_records
+
+    def get_records(self, record_ids):
+        """ Read and decode records, in the order of 'record_ids' """
+        serialized_records = self.get_serialized_records(record_ids)
+        return [self.decode_fun(serialized_records[x]) for x in record_ids]
+
+    def get_record(self, record_id):
+        """ Read and decode a single record """
+        return self.get_records([record_id])[0]
@@ -8,6 +8,7 @@ from collections import Counter, OrderedDict
 from hashlib import md5
 import random
 import time
+import struct
 from multiprocessing import Pool
 
 import tensorflow as tf
@@ -81,9 +82,12 @@ def randomly_split_dataset(
         split_names,
         split_percent,
         balanced_sampling_min=False,
-        balanced_sampling_id_to_label=None):
+        balanced_sampling_id_to_label=None,
+        split_keys=None):
     """ Randomly split 'split_ids' into 'split_names' by preserving
         'split_percent' and optional balanced_sampling to min. label
+        'split_keys' ({'id1': 'key1'}) assigns ids with the same key to
+        the same split (e.g. duplicates), by default the id is the key
         Returns dict: {'id1': 'test', 'id2': 'train'}
     """
 
@@ -104,7 +108,9 @@ def randomly_split_dataset(
     # assign each record id a split value between 0 and 1
     # derived from a hash function to ensure consistency
     # based on the capture_id
-    split_vals = {x: id_to_zero_one(x) for x in split_ids}
+    if split_keys is None:
+        split_keys = dict()
+    split_vals = {x: id_to_zero_one(split_keys.get(x, x)) for x in split_ids}
 
     # assign each id into different splits based on split value
     split_assignments = list()
@@ -135,6 +141,44 @@ def randomly_split_dataset(
     return final_split_assignments
 
 
+def stratified_order(record_ids, id_to_stratum, random_seed=123):
+    """ Order 'record_ids' such that each stratum (e.g. a label value) is
+        spread evenly over the order, hence each contiguous slice contains
+        about the same proportion of every stratum as all records
+        (+/- 1 record). Deterministic for the same input.
+        Args: id_to_stratum (dict), key: id, value: stratum (str)
+    """
+    strata = dict()
+    for record_id in sorted(record_ids):
+        strata.setdefault(id_to_stratum[record_id], list()).append(record_id)
+
+    rand = random.Random(random_seed)
+    positions = list()
+    for stratum in sorted(strata.keys()):
+        stratum_ids = strata[stratum]
+        rand.shuffle(stratum_ids)
+        n = len(stratum_ids)
+        # the i-th record of a stratum is placed at (i + 0.5) / n
+        positions += [((i + 0.5) / n, record_id)
+                      for i, record_id in enumerate(stratum_ids)]
+    positions.sort()
+    return [record_id for _, record_id in positions]
+
+
+def label_histograms(tfrecord_dict, record_ids):
+    """ Number of records per value of each label (first observation)
+        Returns: {'species': {'zebra': 10, 'lion': 2}}
+    """
+    histograms = dict()
+    for record_id in record_ids:
+        for key, values in tfrecord_dict[record_id].items():
+            if not key.startswith('label/') or len(values) == 0:
+                continue
+            histogram = histograms.setdefault(key[len('label/'):], dict())
+            histogram[values[0]] = histogram.get(values[0], 0) + 1
+    return histograms
+
+
 def slice_generator(sequence_length, n_blocks):
     """ Creates a generator to get start/end indexes for dividing a
         sequence_length into n blocks
@@ -268,12 +312,85 @@ def rename_files_cats_dogs(path):
         os.rename(os.path.join(path, file), os.path.join(path,  new_file_name))
 
 
+def _make_crc32c_table():
+    """ Lookup table of the CRC-32C (Castagnoli) polynomial """
+    table = list()
+    for i in range(0, 256):
+        crc = i
+        for _ in range(0, 8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x82F63B78
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def crc32c(data):
+    """ CRC-32C checksum as used by the TFRecord format """
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    """ Masked CRC-32C of the TFRecord format """
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xFFFFFFFF
+
+
+TFR_COMPRESSION_TYPES = ('GZIP', 'ZLIB')
+
+
+def detect_tfr_compression_type(tfr_path):
+    """ Detect the compression of a TFRecord file from its first bytes
+        Returns: '' (uncompressed), 'GZIP' or 'ZLIB'
+    """
+    with open(tfr_path, 'rb') as f:
+        header = f.read(12)
+    # empty file
+    if len(header) == 0:
+        return ''
+    # uncompressed: 8 bytes length followed by the masked crc of the length
+    if len(header) == 12 and \
+       struct.unpack('<I', header[8:12])[0] == masked_crc32c(header[0:8]):
+        return ''
+    if header[0:2] == b'\x1f\x8b':
+        return 'GZIP'
+    # zlib header: deflate method and header checksum
+    if len(header) >= 2 and (header[0] & 0x0F) == 8 and \
+       ((header[0] << 8) + header[1]) % 31 == 0:
+        return 'ZLIB'
+    raise ValueError("Unknown TFRecord format of %s" % tfr_path)
+
+
+def tfr_options(compression_type):
+    """ TFRecordOptions for tf.python_io of a compression type """
+    if compression_type is None or compression_type == '':
+        return None
+    if compression_type not in TFR_COMPRESSION_TYPES:
+        raise ValueError("compression_type must be one of %s" %
+                         (TFR_COMPRESSION_TYPES, ))
+    return tf.python_io.TFRecordOptions(
+        getattr(tf.python_io.TFRecordCompressionType, compression_type))
+
+
+def tfr_record_iterator(tfr_path):
+    """ Iterate over all records of a (compressed) TFRecord file """
+    options = tfr_options(detect_tfr_compression_type(tfr_path))
+    return tf.python_io.tf_record_iterator(tfr_path, options=options)
+
+
 def n_records_in_tfr(tfr_path):
     if not isinstance(tfr_path, list):
         tfr_path = [tfr_path]
     total = 0
     for path in tfr_path:
-        total += sum(1 for _ in tf.python_io.tf_record_iterator(path))
+        total += sum(1 for _ in tfr_record_iterator(path))
     return total
 
 
@@ -292,7 +409,7 @@ def n_records_in_tfr_parallel(tfr_path, n_processes=4):
 
 
 def check_tfrecord_contents(path_to_tfr):
-    record_iterator = tf.python_io.tf_record_iterator(path_to_tfr)
+    record_iterator = tfr_record_iterator(path_to_tfr)
     for record in record_iterator:
         example = tf.train.Example()
         example.ParseFromString(record)
@@ -0,0 +1,159 @@
+""" Encode tf.train.SequenceExample and tf.train.Example Protos directly
+    in the Protobuf Wire Format
+
+The output is byte-identical to building the protos with tf.train.* and
+serializing them with SerializeToString(deterministic=True), i.e. map
+entries are sorted by key.
+
+Wire format of the messages (tensorflow/core/example/feature.proto):
+    SequenceExample: context (Features) = 1, feature_lists = 2
+    Example: features (Features) = 1
+    Features: map<string, Feature> feature = 1
+    FeatureLists: map<string, FeatureList> feature_list = 1
+    FeatureList: repeated Feature feature = 1
+    Feature: bytes_list = 1, float_list = 2, int64_list = 3
+    BytesList: repeated bytes value = 1
+    Int64List: repeated int64 value = 1 (packed)
+A map entry is a message with key = 1 and value = 2.
+
+Encoded messages are kept as (size, list of byte strings) and are joined
+only once, hence large values (images) are copied only once.
+
+Example:
+encoder = SequenceExampleEncoder()
+serialized = encoder.encode(
+    context={'id': bytes_feature([b'record_1'])},
+    feature_lists={'images': feature_list(
+        [bytes_feature([image]) for image in images])})
+"""
+
+_UINT64_MASK = (1 << 64) - 1
+
+# field tags (field number << 3 | wire type 2 - length delimited)
+_TAG_1 = b'\x0a'
+_TAG_2 = b'\x12'
+_TAG_3 = b'\x1a'
+
+# varints of small values are looked up
+_SMALL_VARINTS = [bytes([i]) for i in range(0, 128)]
+
+
+def varint(value):
+    """ Encode a non-negative integer as varint """
+    if value < 128:
+        return _SMALL_VARINTS[value]
+    parts = bytearray()
+    while value > 127:
+        parts.append((value & 0x7F) | 0x80)
+        value >>= 7
+    parts.append(value)
+    return bytes(parts)
+
+
+def _length_delimited(tag, payload):
+    return tag + varint(len(payload)) + payload
+
+
+def _field(tag, encoded):
+    """ Length delimited field of an encoded message """
+    size, parts = encoded
+    header = tag + varint(size)
+    return len(header) + size, [header] + parts
+
+
+def as_bytes(value):
+    """ Bytes of a str (utf-8) or bytes value, as tf.compat.as_bytes """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    raise TypeError("Expected binary or unicode string, got %r" % (value, ))
+
+
+def to_bytes(encoded):
+    """ Bytes of an encoded message """
+    return b''.join(encoded[1])
+
+
+def bytes_feature(values):
+    """ Feature with a BytesList of 'values' (str or bytes) """
+    parts = list()
+    size = 0
+    for value in values:
+        value = as_bytes(value)
+        header = _TAG_1 + varint(len(value))
+        parts += [header, value]
+        size += len(header) + len(value)
+    return _field(_TAG_1, (size, parts))
+
+
+def int64_feature(values):
+    """ Feature with an Int64List of 'values' """
+    if len(values) == 0:
+        return _field(_TAG_3, (0, []))
+    packed = b''.join([varint(int(x) & _UINT64_MASK) for x in values])
+    return _field(_TAG_3, _field(_TAG_1, (len(packed), [packed])))
+
+
+def feature_list(features):
+    """ FeatureList of encoded features """
+    parts = list()
+    size = 0
+    for feature in features:
+        feature_size, feature_parts = _field(_TAG_1, feature)
+        parts += feature_parts
+        size += feature_size
+    return size, parts
+
+
+class _FeatureMapEncoder(object):
+    """ Encode maps of features, the encodings of the keys are cached """
+    def __init__(self):
+        self._keys = dict()
+
+    def _key(self, key):
+        encoded = self._keys.get(key)
+        if encoded is None:
+            encoded = _length_delimited(_TAG_1, as_bytes(key))
+            self._keys[key] = encoded
+        return encoded
+
+    def _map(self, entries):
+        """ Map field (number 1) with the entries sorted by key """
+        parts = list()
+        size = 0
+        for key, value in sorted(entries.items()):
+            value_size, value_parts = _field(_TAG_2, value)
+            key_bytes = self._key(key)
+            entry_size, entry_parts = _field(
+                _TAG_1, (len(key_bytes) + value_size,
+                         [key_bytes] + value_parts))
+            parts += entry_parts
+            size += entry_size
+        return size, parts
+
+
+class SequenceExampleEncoder(_FeatureMapEncoder):
+    """ Encode SequenceExamples from encoded features / feature lists """
+
+    def encode(self, context, feature_lists):
+        """ Serialized SequenceExample
+            context: {key: encoded Feature}
+            feature_lists: {key: encoded FeatureList}
+        """
+        _, context_parts = _field(_TAG_1, self._map(context))
+        _, lists_parts = _field(_TAG_2, self._map(feature_lists))
+        return b''.join(context_parts + lists_parts)
+
+
+class ExampleEncoder(_FeatureMapEncoder):
+    """ Encode Examples from encoded features """
+
+    def encode(self, features):
+        """ Serialized Example
+            features: {key: encoded Feature}
+        """
+        _, parts = _field(_TAG_1, self._map(features))
+        return b''.join(parts)
@@ -0,0 +1,116 @@
+""" Long-lived Process Pool that streams Results in Input Order """
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+
+
+logger = logging.getLogger(__name__)
+
+
+class OrderedProcessPool(object):
+    """ Process pool that is kept alive over many calls to 'imap' and
+        yields results in the order of the inputs
+
+        At most 'max_pending' tasks are in flight at any time. This keeps all
+        workers busy without materializing the whole input. If a worker
+        process dies (e.g. a segfault while decoding a corrupt image) the
+        pool is restarted and the pending tasks are re-run one at a time to
+        isolate the task that killed the worker. That task returns
+        'crash_result', all other tasks are unaffected.
+
+        'initializer(*initargs)' is run once in every worker process, use it
+        to send state that is shared by all tasks instead of pickling it with
+        every task.
+    """
+    def __init__(self, n_processes=4, max_pending=None, initializer=None,
+                 initargs=()):
+        self.n_processes = n_processes
+        self.initializer = initializer
+        self.initargs = initargs
+        if max_pending is None:
+            max_pending = 4 * n_processes
+        self.max_pending = max(max_pending, n_processes)
+        self.n_crashed = 0
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Shut down all worker processes """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _restart(self):
+        """ Replace a broken executor """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._executor = None
+
+    def _submit(self, fun, fun_args, item):
+        """ Submit a task, a broken pool is reported through the future """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.n_processes, initializer=self.initializer,
+                initargs=self.initargs)
+        try:
+            return self._executor.submit(fun, *fun_args, item)
+        except BrokenProcessPool as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+
+    def _run_isolated(self, fun, fun_args, item, crash_result):
+        """ Run a single task without any other task in flight """
+        future = self._submit(fun, fun_args, item)
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self.n_crashed += 1
+            logger.error("Worker process crashed - discarding task")
+            self._restart()
+            return crash_result
+
+    def imap(self, fun, iterable, fun_args=(), crash_result=None):
+        """ Apply fun(*fun_args, item) to all items and yield the results
+            in input order
+        """
+        items = iter(iterable)
+        pending = deque()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.max_pending:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((item, self._submit(fun, fun_args, item)))
+
+            if len(pending) == 0:
+                break
+
+            item, future = pending.popleft()
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                logger.warning(
+                    "Worker process died - restarting pool and re-running "
+                    "%s pending tasks one by one" % (len(pending) + 1))
+                self._restart()
+                to_retry = [(item, future)] + list(pending)
+                pending.clear()
+                for retry_item, retry_future in to_retry:
+                    if retry_future.done() and not isinstance(
+                            retry_future.exception(), BrokenProcessPool):
+                        yield retry_future.result()
+                    else:
+                        yield self._run_isolated(
+                            fun, fun_args, retry_item, crash_result)
+                continue
+            yield result
@@ -3,65 +3,490 @@ import random
 import os
 import math
 import time
+import copy
+import queue
+import inspect
 import logging
-from multiprocessing import Process, Manager
+import threading
+from collections import deque
+from collections.abc import Mapping
 
 import tensorflow as tf
 
-from data.image import read_jpeg
-from data.utils import slice_generator, estimate_remaining_time
+from data.image import (
+    read_jpeg, is_jpeg_within_size, read_image_bytes, image_dimensions)
+from data.utils import (
+    slice_generator, estimate_remaining_time, tfr_options,
+    stratified_order, label_histograms)
+from data.worker_pool import OrderedProcessPool
+from data.manifest import DatasetManifest, file_md5, hash_record_ids
+from data.stats import PipelineStats, failed_stage
+from data.remote import RemoteImageFetcher, is_remote_path, join_url
+from data.tfr_index import write_index, read_index, index_path
+from data.record_metadata import write_metadata, metadata_path
+from data.tfr_encoder_decoder import RECORD_FORMATS, SEQUENCE_EXAMPLE_FORMAT
+from data.failure_ledger import (
+    FAILURE_LEDGER_FILE_NAME, failure_entry, read_failure_ledger,
+    write_failure_ledger, dropped_record_ids)
 
 logger = logging.getLogger(__name__)
 
 
+STATS_FILE_NAME = 'dataset_stats.json'
+
+
+# writer of a worker process of the image pool, set by '_init_worker'
+_worker_writer = None
+
+
+def _init_worker(writer):
+    """ Store the writer in a worker process of the image pool """
+    global _worker_writer
+    _worker_writer = writer
+
+
+def _serialize_record_in_worker(record_data):
+    """ Serialize a record in a worker process of the image pool, returns
+        the serialized record, the stats and the failures of that record
+    """
+    writer = _worker_writer
+    writer.stats = PipelineStats()
+    failures = list()
+    try:
+        serialized_record = writer._serialize_record(record_data, failures)
+    except Exception as e:
+        logger.warning("Failed to serialize record %s, error %s" %
+                       (record_data['id'], str(e)))
+        failures.append(failure_entry(None, e, failed_stage(e, 'serialize')))
+        serialized_record = None
+    return serialized_record, writer.stats, failures
+
+
+class _TFRecordShard(object):
+    """ TFRecord file that is written to a temporary path and keeps track
+        of the records written to it and their offsets
+    """
+    def __init__(self, tmp_path, compression_type=None):
+        self.tmp_path = tmp_path
+        self.compression_type = compression_type
+        self.writer = tf.python_io.TFRecordWriter(
+            tmp_path, options=tfr_options(compression_type))
+        self.record_ids = list()
+        self.index_entries = list()
+        self.n_bytes = 0
+        self._offset = 0
+        self._file_size = 0
+        self._n_bytes_buffered = 0
+
+    def write(self, record_id, serialized_record):
+        """ Write a serialized record """
+        self.writer.write(serialized_record)
+        self.record_ids.append(record_id)
+        self.index_entries.append(
+            (record_id, self._offset, len(serialized_record)))
+        # TFRecord framing: length (8), crc of length (4), data, crc (4)
+        record_size = len(serialized_record) + 16
+        self._offset += record_size
+        if self.compression_type:
+            # the compressor buffers data before writing it to the file,
+            # data since the file last grew is counted uncompressed
+            file_size = os.path.getsize(self.tmp_path)
+            if file_size > self._file_size:
+                self._file_size = file_size
+                self._n_bytes_buffered = 0
+            self._n_bytes_buffered += record_size
+            self.n_bytes = self._file_size + self._n_bytes_buffered
+        else:
+            self.n_bytes += record_size
+
+    def close(self):
+        self.writer.close()
+
+
+class _FileJob(object):
+    """ Records of a split that are written to one TFRecord file """
+    def __init__(self, split_name, tfrecord_dict, output_file, record_ids,
+                 compression_type=None, delta=False):
+        self.split_name = split_name
+        self.tfrecord_dict = tfrecord_dict
+        self.output_file = output_file
+        self.record_ids = record_ids
+        self.compression_type = compression_type
+        self.delta = delta
+        self.shard = None
+
+    def start(self):
+        logger.info("Start Writing %s" % self.output_file)
+        self.shard = _TFRecordShard(
+            self.output_file + '.tmp', self.compression_type)
+
+    def write(self, record_id, serialized_record):
+        self.shard.write(record_id, serialized_record)
+
+    def abort(self):
+        self.shard.close()
+
+    def finish(self, writer):
+        self.shard.close()
+        if self.delta and len(self.shard.record_ids) == 0:
+            logger.info("No record of %s could be written - removing it" %
+                        self.output_file)
+            os.remove(self.shard.tmp_path)
+            return
+        writer._finish_file(self.split_name, self.shard, self.output_file,
+                            self.record_ids, self.delta, self.tfrecord_dict)
+        if self.delta:
+            writer.files[self.split_name].append(self.output_file)
+        logger.info(
+            "Finished Writing Records to %s - Wrote %s/%s" %
+            (self.output_file, len(self.shard.record_ids),
+             len(self.record_ids)))
+
+
+class _SizeLimitedJob(object):
+    """ Records of a split that are written to files of about
+        'max_bytes_per_file' bytes
+
+        The number of files is only known at the end, hence the files
+        are written to temporary files and renamed once all records
+        have been written. With 'shuffle_files' the records of each file
+        are shuffled once the file is complete.
+    """
+    def __init__(self, split_name, tfrecord_dict, output_dir, record_ids,
+                 sharding, shuffle_files=False):
+        self.split_name = split_name
+        self.tfrecord_dict = tfrecord_dict
+        self.output_dir = output_dir
+        self.record_ids = record_ids
+        self.sharding = sharding
+        self.shuffle_files = shuffle_files
+        self.shards = list()
+        self.shard = None
+        self.shard_records = list()
+
+    def start(self):
+        logger.info("Start Writing Records of %s" % self.split_name)
+
+    def write(self, record_id, serialized_record):
+        if self.shard is None:
+            tmp_file = os.path.join(
+                self.output_dir, '%s_%03d.tfrecord.tmp' % (
+                    self.split_name, len(self.shards) + 1))
+            logger.info("Start Writing %s" % tmp_file)
+            self.shard = _TFRecordShard(
+                tmp_file, self.sharding['compression_type'])
+            self.shards.append(self.shard)
+
+        self.shard.write(record_id, serialized_record)
+        if self.shuffle_files:
+            self.shard_records.append((record_id, serialized_record))
+
+        # continue with a new file once the max size is reached
+        if self.shard.n_bytes >= self.sharding['max_bytes_per_file']:
+            self._close_shard()
+
+    def _close_shard(self):
+        """ Close the current file, with 'shuffle_files' it is rewritten
+            with its records in random order (the records of a file are
+            kept in memory until then)
+        """
+        self.shard.close()
+        if self.shuffle_files:
+            random.Random(123).shuffle(self.shard_records)
+            shard = _TFRecordShard(
+                self.shard.tmp_path, self.sharding['compression_type'])
+            for record_id, serialized_record in self.shard_records:
+                shard.write(record_id, serialized_record)
+            shard.close()
+            self.shards[-1] = shard
+            self.shard_records = list()
+        self.shard = None
+
+    def abort(self):
+        if self.shard is not None:
+            self.shard.close()
+
+    def finish(self, writer):
+        if self.shard is not None:
+            self._close_shard()
+
+        # rename all files to their final names
+        n_files = len(self.shards)
+        file_names = list()
+        for i, shard in enumerate(self.shards):
+            file_name = '%s_%03d-of-%03d.tfrecord' % (
+                self.split_name, i+1, n_files)
+            output_file = os.path.join(self.output_dir, file_name)
+            writer._finish_file(
+                self.split_name, shard, output_file, shard.record_ids,
+                tfrecord_dict=self.tfrecord_dict)
+            file_names.append(file_name)
+            writer.files[self.split_name].append(output_file)
+
+        writer.manifest.update_split(
+            self.split_name, {**self.sharding, 'file_names': file_names})
+
+        logger.info(
+            "Finished Writing Records of %s to %s files - Wrote %s/%s" %
+            (self.split_name, n_files,
+             sum([len(x.record_ids) for x in self.shards]),
+             len(self.record_ids)))
+
+
 class DatasetWriter(object):
-    def __init__(self, tfr_encoder):
+    """ Write records to TFRecord files with 'tfr_encoder'
+
+        'record_format' is the format of the records 'tfr_encoder' creates
+        (see RECORD_FORMATS in data/tfr_encoder_decoder.py) and is
+        recorded in the manifest. For formats that do not store all data of
+        a record (e.g. 'flat_example') a metadata sidecar file is written
+        next to each TFRecord file (see data/record_metadata.py).
+    """
+    def __init__(self, tfr_encoder, record_format=SEQUENCE_EXAMPLE_FORMAT):
+        if record_format not in RECORD_FORMATS:
+            raise ValueError("Record format %s not supported" % record_format)
         self.tfr_encoder = tfr_encoder
+        self.record_format = record_format
+        self.write_metadata = not RECORD_FORMATS[record_format].stores_metadata
         self.files = dict()
+        self.failures = list()
+        self._image_pool = None
+        self._remote_fetcher = None
+        self.stats = PipelineStats()
+
+    def encode_to_tfr(self, tfrecord_dict, output_dir, file_prefix,
+                      **kwargs):
+        """ Export TFRecord Dict to TFRecord files with names starting
+            with 'file_prefix' - see encode_splits_to_tfr for the options
+        """
+        self.encode_splits_to_tfr(
+            {file_prefix: tfrecord_dict}, output_dir, **kwargs)
 
-    def encode_to_tfr(
-         self, tfrecord_dict,
+    def encode_splits_to_tfr(
+         self, split_dicts,
          output_dir,
-         file_prefix,
          image_root_path=None,
          image_pre_processing_fun=None,
          image_pre_processing_args=None,
          random_shuffle_before_save=True,
          overwrite_existing_files=True,
          max_records_per_file=None,
+         max_bytes_per_file=None,
          write_tfr_in_parallel=False,
          process_images_in_parallel=False,
          process_images_in_parallel_size=100,
-         processes_images_in_parallel_n_processes=4):
-        """ Export TFRecord Dict to a TFRecord file """
+         processes_images_in_parallel_n_processes=4,
+         write_queue_size=1000,
+         image_cache=None,
+         jpeg_passthrough=False,
+         stats_report_interval=60,
+         compression_type=None,
+         retry_failed_records=False,
+         remote_max_connections=16,
+         remote_max_retries=3,
+         storage_profile=None,
+         stratify_by_labels=None):
+        """ Export TFRecord Dicts of several splits to TFRecord files
+            e.g. {'train': tfrecord_dict, 'val': tfrecord_dict}
 
-        self.tfrecord_dict = tfrecord_dict
+            A tfrecord_dict can be any Mapping of record ids to records,
+            e.g. a TFRecordView of an inventory that converts the records
+            only when they are read. Records are read one at a time in the
+            order they are written and are not kept in memory.
+
+            All files of all splits are written through one bounded
+            pipeline: with 'process_images_in_parallel'
+            'processes_images_in_parallel_n_processes' worker processes
+            read, process and serialize the records, with at most
+            'process_images_in_parallel_size' records in flight. A writer
+            thread writes the serialized records to the files, at most
+            'write_queue_size' records are buffered for it.
+            'write_tfr_in_parallel' is kept for compatibility and
+            uses the same pipeline.
+
+            Files are first written to a temporary file and renamed once
+            complete. Each completed file is registered in the dataset
+            manifest in 'output_dir'. If 'overwrite_existing_files' is
+            False only files that are missing or incomplete are written.
+            If an 'image_cache' (ImageCache) is specified, processed images
+            are read from / stored in it instead of re-processing them.
+            With 'jpeg_passthrough' JPEGs that do not exceed the 'max_side'
+            (or 'min_side') of 'image_pre_processing_args' are stored
+            without re-encoding.
+            If 'max_bytes_per_file' is specified, a new file is started
+            once a file reaches that size (instead of using
+            'max_records_per_file').
+
+            Timings of all stages (read, open, decode, resize, encode,
+            serialize, write) and throughput counters are written to
+            'dataset_stats.json' in 'output_dir' every
+            'stats_report_interval' seconds and at the end.
+
+            With 'compression_type' ('GZIP' or 'ZLIB') compressed TFRecord
+            files are written, the readers detect the compression.
+
+            Images that can not be processed are listed in the failure
+            ledger 'failed_images.jsonl' in 'output_dir' (see
+            data/failure_ledger.py). With 'retry_failed_records' only the
+            records that were dropped are processed again and written to
+            new files ('<split>_retry001_001-of-001.tfrecord'), existing
+            files are not changed. A run with 'overwrite_existing_files'
+            removes these files, otherwise records in them are not written
+            again.
+
+            If 'image_root_path' is an http(s) url the images are fetched
+            with up to 'remote_max_connections' simultaneous requests (each
+            retried up to 'remote_max_retries' times). The images of the
+            next records are fetched ahead of processing them, except for
+            images in the 'image_cache'. Such images that are evicted
+            before they are read are fetched when they are read.
+
+            'storage_profile' (see data/storage_profile.py) describes how
+            the images are stored and is recorded in the manifest. Files
+            with a different profile can not be resumed or retried.
+
+            Records are assigned to the files of a split in the order of
+            their ids. With 'stratify_by_labels' (e.g. ['species']) they
+            are assigned such that each value of these labels is spread
+            evenly over all files. The number of records per label value
+            of each file is recorded in the manifest ('label_histograms').
+        """
         self.image_pre_processing_fun = image_pre_processing_fun
         self.image_pre_processing_args = image_pre_processing_args
         self.random_shuffle_before_save = random_shuffle_before_save
-        self.file_prefix = file_prefix
         self.image_root_path = image_root_path
-        self.files[file_prefix] = list()
-        self.write_tfr_in_parallel = write_tfr_in_parallel
-        self.process_images_in_parallel = process_images_in_parallel
-        self.process_images_in_parallel_size = process_images_in_parallel_size
-        self.processes_images_in_parallel_n_processes = \
-            processes_images_in_parallel_n_processes
+        self.write_queue_size = write_queue_size
+        self.image_cache = image_cache
+        self.jpeg_passthrough = jpeg_passthrough
+        self.remote_max_retries = remote_max_retries
+        self.compression_type = compression_type or None
+        self.stratify_by_labels = stratify_by_labels
+        self.stats = PipelineStats()
+        self.stats_report_interval = stats_report_interval
+        self.stats_path = os.path.join(output_dir, STATS_FILE_NAME)
+        self.manifest = DatasetManifest(output_dir)
+        self.ledger_path = os.path.join(output_dir, FAILURE_LEDGER_FILE_NAME)
+        self._fun_accepts_stats = \
+            image_pre_processing_fun is not None and 'stats' in \
+            inspect.signature(image_pre_processing_fun).parameters
 
         logger.info("Starting to Encode Dict")
 
-        if not isinstance(tfrecord_dict, dict):
-            logger.error("tfrecord_dict must be a dictionary")
-            raise ValueError("tfrecord_dict must be a dictionary")
+        self._set_record_format(
+            overwrite_existing_files and not retry_failed_records)
+
+        if storage_profile is not None:
+            self._set_storage_profile(
+                storage_profile, overwrite_existing_files and
+                not retry_failed_records)
+
+        previous_failures = read_failure_ledger(self.ledger_path)
+        self._delta_record_ids = dict()
+
+        jobs = list()
+        for split_name, tfrecord_dict in split_dicts.items():
+            if not isinstance(tfrecord_dict, Mapping):
+                logger.error("tfrecord_dict must be a dictionary (Mapping)")
+                raise ValueError(
+                    "tfrecord_dict must be a dictionary (Mapping)")
+            self.files[split_name] = list()
+            if overwrite_existing_files and not retry_failed_records:
+                self._remove_delta_files(split_name, output_dir)
+            delta_files = self._find_delta_files(split_name, output_dir)
+            self._delta_record_ids[split_name] = {
+                record_id for delta_file in delta_files
+                for record_id in read_index(delta_file).keys()}
+            if retry_failed_records:
+                jobs += self._plan_retry(
+                    split_name, tfrecord_dict, output_dir,
+                    dropped_record_ids(previous_failures, split_name),
+                    max_records_per_file)
+            elif max_bytes_per_file is not None:
+                jobs += self._plan_split_by_size(
+                    split_name, tfrecord_dict, output_dir,
+                    max_bytes_per_file, overwrite_existing_files)
+            else:
+                jobs += self._plan_split_by_count(
+                    split_name, tfrecord_dict, output_dir,
+                    max_records_per_file, overwrite_existing_files)
+            if not retry_failed_records:
+                self.files[split_name] += delta_files
+
+        # keep the failures of records that are not processed again
+        processed = {(job.split_name, record_id) for job in jobs
+                     for record_id in job.record_ids}
+        self.failures = [
+            x for x in previous_failures
+            if (x['split'], x['record_id']) not in processed and
+            (x['split'] not in split_dicts or
+             x['record_id'] in split_dicts[x['split']])]
+
+        if process_images_in_parallel or write_tfr_in_parallel:
+            self._image_pool = OrderedProcessPool(
+                n_processes=processes_images_in_parallel_n_processes,
+                max_pending=process_images_in_parallel_size,
+                initializer=_init_worker,
+                initargs=(self._worker_copy(), ))
+
+        if is_remote_path(image_root_path):
+            self._remote_fetcher = RemoteImageFetcher(
+                max_connections=remote_max_connections,
+                max_retries=remote_max_retries,
+                prefetch_size=2 * remote_max_connections,
+                stats=self.stats)
+
+        try:
+            self._write_jobs(jobs)
+        finally:
+            self._close_image_pool()
+            if self.image_cache is not None:
+                self.image_cache.evict()
+            self._close_remote_fetcher()
+            self._write_failure_ledger()
+
+        self._log_stats()
 
+    def _set_record_format(self, overwrite):
+        """ Record the record format, existing files must have the same
+            format unless they are overwritten
+        """
+        existing_format = self.manifest.get_record_format()
+        if not overwrite and existing_format is not None and \
+           existing_format != self.record_format:
+            logger.error("Record format %s does not match the format %s "
+                         "of the existing files" %
+                         (self.record_format, existing_format))
+            raise ValueError(
+                "Record format does not match the existing files - "
+                "overwrite them or use the same format")
+        logger.info("Record format: %s" % self.record_format)
+        self.manifest.set_record_format(self.record_format)
+
+    def _set_storage_profile(self, storage_profile, overwrite):
+        """ Record the storage profile, existing files must have the same
+            profile unless they are overwritten
+        """
+        existing_profile = self.manifest.get_storage_profile()
+        if not overwrite and existing_profile is not None and \
+           existing_profile != storage_profile:
+            logger.error("Storage profile %s does not match the profile %s "
+                         "of the existing files" %
+                         (storage_profile, existing_profile))
+            raise ValueError(
+                "Storage profile does not match the existing files - "
+                "overwrite them or use the same profile")
+        logger.info("Storage profile: %s" % storage_profile)
+        self.manifest.set_storage_profile(storage_profile)
+
+    def _plan_split_by_count(self, split_name, tfrecord_dict, output_dir,
+                             max_records_per_file, overwrite_existing_files):
+        """ Create a job for each file of a split that has to be written """
         # Sort records to ensure the records are split into files
         # equally each time
-        record_ids = list(tfrecord_dict.keys())
-        record_ids.sort()
-        n_records = len(tfrecord_dict.keys())
+        record_ids = self._ordered_record_ids(tfrecord_dict)
+        n_records = len(record_ids)
 
-        logger.info("Start Writing Records to TFRecord-File - Total %s" %
-                    n_records)
+        logger.info("Split %s - Total Records %s" % (split_name, n_records))
 
         # Generate output file names
         if max_records_per_file is None:
@@ -69,80 +494,296 @@ class DatasetWriter(object):
         else:
             n_files = math.ceil(n_records / max_records_per_file)
 
-        output_paths = list()
-        for i in range(0, n_files):
-            file_name = '%s_%03d-of-%03d.tfrecord' % (file_prefix, i+1, n_files)
-            output_paths.append(os.path.join(*[output_dir, file_name]))
-
-        # processes list if parallel processing is enabled
-        if self.write_tfr_in_parallel:
-            processes_list = list()
-
+        jobs = list()
         slices = slice_generator(n_records, n_files)
-
-        # Write each file
-        for f_id, (start_i, end_i) in enumerate(slices):
-            output_file = output_paths[f_id]
+        for i, (start_i, end_i) in enumerate(slices):
+            file_name = '%s_%03d-of-%03d.tfrecord' % (split_name, i+1, n_files)
+            output_file = os.path.join(*[output_dir, file_name])
             # generate record slices for each file
             file_record_ids = record_ids[start_i:end_i]
+            self.files[split_name].append(output_file)
 
-            # check if file already exists
-            file_exists = os.path.exists(output_file)
+            # check if file has already been completed
+            file_complete = not overwrite_existing_files and \
+                self.manifest.is_file_complete(
+                    split_name, output_file, hash_record_ids(file_record_ids),
+                    {'compression_type': self.compression_type})
 
-            if file_exists and not overwrite_existing_files:
-                logger.info("File: %s exists - not gonna overwrite" %
+            if file_complete:
+                logger.info("File: %s is complete - not gonna overwrite" %
                             output_file)
-                self.files[file_prefix].append(output_file)
-            else:
-                if self.write_tfr_in_parallel:
-                    pr = Process(target=self._write_to_file,
-                                 args=(output_file, file_record_ids))
-                    pr.start()
-                    processes_list.append(pr)
-                else:
-                    if self.process_images_in_parallel:
-                        self._write_to_file_parallel(output_file,
-                                                     file_record_ids)
-                    else:
-                        self._write_to_file(output_file, file_record_ids)
-            self.files[self.file_prefix].append(output_file)
-        # start all processes
-        if self.write_tfr_in_parallel:
-            for p in processes_list:
-                p.join()
-
-    def _serialize_record_batch(self, record_batch, outlist):
-        """ Serialize a list of records """
-        for record_data in record_batch:
-            serialized_record = self._serialize_record(record_data)
-            if serialized_record is not None:
-                outlist.append(serialized_record)
-
-    def _serialize_record(self, record_data):
-        """ Serialize a single record """
+                continue
+            if os.path.exists(output_file) and not overwrite_existing_files:
+                logger.info("File: %s is incomplete - rewriting" %
+                            output_file)
+            jobs.append(_FileJob(
+                split_name, tfrecord_dict, output_file,
+                self._shuffle_record_ids(file_record_ids),
+                self.compression_type))
+        return jobs
+
+    def _plan_split_by_size(self, split_name, tfrecord_dict, output_dir,
+                            max_bytes_per_file, overwrite_existing_files):
+        """ Create a job that writes a split to files of limited size,
+            for the same records and settings the file names and contents
+            are deterministic
+        """
+        record_ids = self._ordered_record_ids(tfrecord_dict)
+
+        logger.info("Split %s - Total Records %s" %
+                    (split_name, len(record_ids)))
+
+        sharding = {
+            'max_bytes_per_file': max_bytes_per_file,
+            'compression_type': self.compression_type,
+            'stratify_by_labels': self.stratify_by_labels,
+            'record_ids_hash': hash_record_ids(record_ids)}
+
+        if not overwrite_existing_files and \
+           self.manifest.is_split_complete(split_name, output_dir, sharding):
+            logger.info("Files of %s are complete - not gonna overwrite" %
+                        split_name)
+            self.files[split_name] = [
+                os.path.join(output_dir, x) for x in
+                self.manifest.get_split(split_name)['file_names']]
+            return []
+
+        if len(record_ids) == 0:
+            return []
+
+        if self.stratify_by_labels is None:
+            record_ids = self._shuffle_record_ids(record_ids)
+            shuffle_files = False
+        else:
+            # shuffling all records would lose the stratification, the
+            # records are shuffled within each file instead
+            shuffle_files = self.random_shuffle_before_save
+
+        return [_SizeLimitedJob(
+            split_name, tfrecord_dict, output_dir, record_ids, sharding,
+            shuffle_files)]
+
+    def _ordered_record_ids(self, tfrecord_dict):
+        """ Order in which records are assigned to the files of a split,
+            sorted by id or stratified by 'stratify_by_labels'
+        """
+        if self.stratify_by_labels is None:
+            return sorted(tfrecord_dict.keys())
+        id_to_stratum = {
+            record_id: '|'.join([
+                (record.get('label/' + label) or [''])[0]
+                for label in self.stratify_by_labels])
+            for record_id, record in tfrecord_dict.items()}
+        return stratified_order(list(tfrecord_dict.keys()), id_to_stratum)
+
+    def _plan_retry(self, split_name, tfrecord_dict, output_dir, record_ids,
+                    max_records_per_file):
+        """ Create jobs that write the dropped records of a split to new
+            (delta) files, the existing files are not changed
+        """
+        record_ids = sorted([
+            x for x in record_ids if x in tfrecord_dict and
+            x not in self._delta_record_ids[split_name]])
+
+        logger.info("Split %s - Retrying %s dropped records" %
+                    (split_name, len(record_ids)))
+
+        if len(record_ids) == 0:
+            return []
+
+        # each retry writes its own set of files
+        existing_files = self.manifest.get_files(split_name).keys()
+        retry_round = 1
+        while any([x.startswith('%s_retry%03d_' % (split_name, retry_round))
+                   for x in existing_files]):
+            retry_round += 1
+
+        if max_records_per_file is None:
+            n_files = 1
+        else:
+            n_files = math.ceil(len(record_ids) / max_records_per_file)
+
+        jobs = list()
+        slices = slice_generator(len(record_ids), n_files)
+        for i, (start_i, end_i) in enumerate(slices):
+            file_name = '%s_retry%03d_%03d-of-%03d.tfrecord' % (
+                split_name, retry_round, i+1, n_files)
+            jobs.append(_FileJob(
+                split_name, tfrecord_dict,
+                os.path.join(output_dir, file_name),
+                self._shuffle_record_ids(record_ids[start_i:end_i]),
+                self.compression_type, delta=True))
+        return jobs
+
+    def _find_delta_files(self, split_name, output_dir):
+        """ Files of a split that were written by retries """
+        files = self.manifest.get_files(split_name)
+        return [os.path.join(output_dir, file_name)
+                for file_name in sorted(files.keys())
+                if files[file_name].get('delta') and
+                os.path.exists(os.path.join(output_dir, file_name))]
+
+    def _remove_delta_files(self, split_name, output_dir):
+        """ Remove the files of a split that were written by retries """
+        for file_path in self._find_delta_files(split_name, output_dir):
+            logger.info("Removing %s" % file_path)
+            os.remove(file_path)
+            for sidecar_path in [index_path(file_path),
+                                 metadata_path(file_path)]:
+                if os.path.exists(sidecar_path):
+                    os.remove(sidecar_path)
+            self.manifest.remove_file(
+                split_name, os.path.basename(file_path))
+
+    def _write_failure_ledger(self):
+        """ Write the failures of this and previous runs to the ledger """
+        write_failure_ledger(self.ledger_path, self.failures)
+        n_dropped = len({(x['split'], x['record_id']) for x in self.failures
+                         if x['record_dropped']})
+        if len(self.failures) > 0:
+            logger.warning(
+                "Failed to process %s images / records, %s records were "
+                "dropped - see %s" %
+                (len(self.failures), n_dropped, self.ledger_path))
+
+    def _add_failures(self, split_name, record_id, record_dropped,
+                      failures):
+        """ Add the failures of a record to the ledger """
+        for failure in failures:
+            self.failures.append({
+                **failure, 'split': split_name, 'record_id': record_id,
+                'record_dropped': record_dropped})
+
+    def _log_stats(self):
+        """ Log image processing statistics and write the stats report """
+        counters = self.stats.counters
+        if self.jpeg_passthrough:
+            logger.info("Images stored as is: %s re-encoded: %s" %
+                        (counters['images_passthrough'],
+                         counters['images_reencoded']))
+        if self.image_cache is not None:
+            logger.info("Image cache hits: %s misses: %s" %
+                        (counters['image_cache_hits'],
+                         counters['image_cache_misses']))
+        report = self.stats.report()
+        logger.info("Records/s: %s Images/s: %s MB read/s: %s MB written/s: %s"
+                    % (report['throughput']['records_per_s'],
+                       report['throughput']['images_per_s'],
+                       report['throughput']['mb_read_per_s'],
+                       report['throughput']['mb_written_per_s']))
+        for stage, timing in sorted(report['stages'].items()):
+            if timing['count'] > 0:
+                logger.info("Stage %s - n: %s mean: %s ms p90: %s ms "
+                            "total: %s s" %
+                            (stage, timing['count'], timing['mean_ms'],
+                             timing['p90_ms'], timing['total_s']))
+        self.stats.write_report(self.stats_path)
+        logger.info("Wrote stats report to %s" % self.stats_path)
+
+    def _close_image_pool(self):
+        """ Shut down the worker pool of parallel image processing """
+        if self._image_pool is None:
+            return
+        if self._image_pool.n_crashed > 0:
+            logger.warning(
+                "Discarded %s records due to crashed worker processes" %
+                self._image_pool.n_crashed)
+        self._image_pool.close()
+        self._image_pool = None
+
+    def _close_remote_fetcher(self):
+        """ Close the connections to the remote image source """
+        if self._remote_fetcher is None:
+            return
+        self._remote_fetcher.close()
+        self._remote_fetcher = None
+
+    def _image_location(self, image_path):
+        """ Full path (or url) of an image of a record """
+        if self.image_root_path is None:
+            return image_path
+        if is_remote_path(self.image_root_path):
+            return join_url(self.image_root_path, image_path)
+        return os.path.join(self.image_root_path, image_path.lstrip(os.sep))
+
+    def _prefetch_remote_images(self, records_data):
+        """ Fetch the images of the next records ahead of processing them,
+            yields copies of the records with the 'fetched_images'
+        """
+        records = deque()
+
+        def url_lists():
+            for record_data in records_data:
+                records.append(record_data)
+                urls = [self._image_location(x)
+                        for x in record_data['image_paths']]
+                yield [x for x in urls if is_remote_path(x) and
+                       not self._is_cached(x)]
+
+        for fetched_images in self._remote_fetcher.prefetch(url_lists()):
+            yield dict(records.popleft(), fetched_images=fetched_images)
+
+    def _is_cached(self, image_path):
+        """ Check whether the processed image is in the image cache, the
+            entry is marked as recently used such that it is evicted last
+        """
+        if self.image_cache is None or self.jpeg_passthrough:
+            return False
+        return self.image_cache.touch(self.image_cache.key(
+            image_path, self._image_processing_params()))
+
+    def _image_source(self, image_path, fetched_images):
+        """ Path of a local image or the bytes of a fetched remote image,
+            remote images that were not prefetched (e.g. cached images that
+            were evicted since) are fetched now
+        """
+        if not is_remote_path(image_path):
+            return image_path
+        image = (fetched_images or dict()).get(image_path)
+        if image is None:
+            self.stats.count('images_fetched_late')
+            return self._get_remote_fetcher().fetch(image_path)
+        if isinstance(image, Exception):
+            raise image
+        return image
+
+    def _get_remote_fetcher(self):
+        """ Fetcher of remote images of this process, worker processes of
+            the image pool create their own one when needed
+        """
+        if self._remote_fetcher is None:
+            self._remote_fetcher = RemoteImageFetcher(
+                max_connections=1, max_retries=self.remote_max_retries,
+                prefetch_size=1)
+        return self._remote_fetcher
+
+    def _serialize_record(self, record_data, failures=None):
+        """ Serialize a single record, failed images are added to
+            'failures'
+        """
+        # the images are added to a copy, the record may be an entry of
+        # the tfrecord_dict which would keep all images in memory
+        record_data = dict(record_data)
+
         # Process all images in a record
         raw_images = list()
         for image_path in record_data['image_paths']:
-            # Create image path
-            if self.image_root_path is not None:
-                image_path_full = os.path.join(self.image_root_path,
-                                               image_path.lstrip(os.sep))
-            else:
-                image_path_full = image_path
+            image_path_full = self._image_location(image_path)
             try:
-                if self.image_pre_processing_fun is not None:
-                    self.image_pre_processing_args['image'] = \
-                        image_path_full
-                    image_raw = self.image_pre_processing_fun(
-                         **self.image_pre_processing_args)
-                else:
-                    image_raw = read_jpeg(image_path_full)
-
+                with self.stats.time('image'):
+                    image_raw = self._read_image(
+                        image_path_full, record_data.get('fetched_images'))
             except Exception as e:
                 logger.debug("Failed to read image: %s , error %s" %
                              (image_path_full, str(e)))
+                self.stats.count('images_failed')
+                if failures is not None:
+                    failures.append(failure_entry(
+                        image_path_full, e, failed_stage(e, 'image')))
                 continue
 
+            self.stats.count('images')
+
             raw_images.append(image_raw)
 
         # check if at least one image is available
@@ -151,111 +792,297 @@ class DatasetWriter(object):
 
         record_data['images'] = raw_images
 
-        serialized_record = self.tfr_encoder(record_data)
+        # sizes of the stored images, the reader uses them to choose images
+        # and how to decode them without decoding them first
+        with self.stats.time('image_size'):
+            dimensions = [image_dimensions(x) for x in raw_images]
+        record_data['image_heights'] = [x[0] for x in dimensions]
+        record_data['image_widths'] = [x[1] for x in dimensions]
+        record_data['image_channels'] = [x[2] for x in dimensions]
+        record_data['image_n_bytes'] = [len(x) for x in raw_images]
+
+        with self.stats.time('serialize'):
+            serialized_record = self.tfr_encoder(record_data)
 
         return serialized_record
 
-    def _write_to_file(self, output_file, record_ids):
-        """ Write a TFR File """
+    def _read_image(self, image_path, fetched_images=None):
+        """ Read and process an image, use the image cache if available """
+        if self.jpeg_passthrough:
+            image = self._image_source(image_path, fetched_images)
+            if self.image_pre_processing_fun is None:
+                max_side, min_side = None, None
+            else:
+                max_side = self.image_pre_processing_args.get('max_side')
+                min_side = self.image_pre_processing_args.get('min_side')
+            if is_jpeg_within_size(image, max_side, min_side):
+                self.stats.count('images_passthrough')
+                with self.stats.time('read'):
+                    image_raw = read_image_bytes(image)
+                self.stats.count('bytes_read', len(image_raw))
+                return image_raw
 
-        # Create and Write Records to TFRecord file
-        logger.info("Start Writing %s" % output_file)
-        n_records = len(record_ids)
-        successfull_writes = 0
-        start_time = time.time()
+        if self.image_cache is not None:
+            cache_key = self.image_cache.key(
+                image_path, self._image_processing_params())
+            with self.stats.time('cache_read'):
+                image_raw = self.image_cache.get(cache_key)
+            if image_raw is not None:
+                self.stats.count('image_cache_hits')
+                return image_raw
+            self.stats.count('image_cache_misses')
 
-        # Randomly shuffle records before saving, this is better for
-        # model training
+        image = self._image_source(image_path, fetched_images)
+        if self.image_pre_processing_fun is not None:
+            self.image_pre_processing_args['image'] = image
+            if self._fun_accepts_stats:
+                image_raw = self.image_pre_processing_fun(
+                     stats=self.stats, **self.image_pre_processing_args)
+            else:
+                image_raw = self.image_pre_processing_fun(
+                     **self.image_pre_processing_args)
+        else:
+            image_raw = read_jpeg(image, stats=self.stats)
+
+        self.stats.count('images_reencoded')
+
+        if self.image_cache is not None:
+            # the size of the cache is checked by the main process
+            self.image_cache.put(cache_key, image_raw, check_size=False)
+            self.stats.count('image_cache_bytes_written', len(image_raw))
+        return image_raw
+
+    def _image_processing_params(self):
+        """ Parameters that define how an image is processed """
+        if self.image_pre_processing_fun is None:
+            return {'fun': read_jpeg.__name__}
+        params = {k: v for k, v in self.image_pre_processing_args.items()
+                  if k != 'image'}
+        params['fun'] = self.image_pre_processing_fun.__name__
+        return params
+
+    def _shuffle_record_ids(self, record_ids):
+        """ Randomly shuffle records before saving, this is better for
+            model training
+        """
         if self.random_shuffle_before_save:
             random.seed(123)
             random.shuffle(record_ids)
+        return record_ids
 
-        with tf.python_io.TFRecordWriter(output_file) as writer:
+    def _serialize_records(self, records_data):
+        """ Serialize records in the given order, images are processed in
+            the worker pool if it is available
 
-            for i, record_id in enumerate(record_ids):
+            Records are streamed through the long-lived worker pool in
+            order, hence the result is the same as without the pool.
+        """
+        if self._image_pool is None:
+            return (self._serialize_record_with_failures(record_data)
+                    for record_data in records_data)
 
-                if i % 1000 == 0:
-                    est_t = estimate_remaining_time(start_time, n_records, i)
-                    logger.debug(
-                        "Wrote %s / %s records (estimated time remaining: %s)"
-                        % (i, n_records, est_t))
+        results = self._image_pool.imap(
+            _serialize_record_in_worker,
+            records_data,
+            crash_result=(None, PipelineStats(), [{
+                'path': None, 'stage': 'worker',
+                'exception': 'WorkerCrashed',
+                'message': 'worker process died'}]))
+        return self._merge_stats(results)
 
-                record_data = self.tfrecord_dict[record_id]
+    def _worker_copy(self):
+        """ Copy of the writer without the state of the run, it is sent
+            once to every worker process of the image pool
+        """
+        worker_writer = copy.copy(self)
+        worker_writer._image_pool = None
+        worker_writer.manifest = None
+        worker_writer.files = None
+        worker_writer.stats = None
+        worker_writer.failures = None
+        worker_writer._remote_fetcher = None
+        worker_writer._delta_record_ids = None
+        return worker_writer
 
-                serialized_record = self._serialize_record(record_data)
+    def _serialize_record_with_failures(self, record_data):
+        """ Serialize a record, returns the record and its failures """
+        failures = list()
+        return self._serialize_record(record_data, failures), failures
 
-                if serialized_record is None:
-                    logger.debug("Discarding record %s - no image avail" %
-                                 record_id)
-                    continue
+    def _merge_stats(self, results):
+        """ Add stats of worker results and yield serialized records and
+            their failures
+        """
+        for serialized_record, stats, failures in results:
+            self.stats.merge(stats)
+            yield serialized_record, failures
 
-                # Write the serialized data to the TFRecords file.
-                writer.write(serialized_record)
-                successfull_writes += 1
+    def _write_jobs(self, jobs):
+        """ Serialize the records of all jobs in one stream and hand them
+            to the writer thread through a bounded queue
+        """
+        # records that were written by a retry are not written again
+        record_refs = [(job, record_id) for job in jobs
+                       for record_id in job.record_ids
+                       if record_id not in
+                       self._delta_record_ids.get(job.split_name, ())]
+        records_data = (job.tfrecord_dict[record_id]
+                        for job, record_id in record_refs)
+        if self._remote_fetcher is not None:
+            records_data = self._prefetch_remote_images(records_data)
+        serialized_records = self._serialize_records(records_data)
 
-            logger.info(
-                "Finished Writing Records to %s - Wrote %s/%s" %
-                (output_file, successfull_writes, n_records))
+        write_queue = queue.Queue(maxsize=self.write_queue_size)
+        aborted = threading.Event()
+        errors = list()
+        writer_thread = threading.Thread(
+            target=self._write_from_queue,
+            args=(write_queue, jobs, len(record_refs), aborted, errors))
+        writer_thread.start()
 
-    def _write_to_file_parallel(self, output_file, record_ids):
-        """ Write a TFR File with parallel image processing """
+        cache_bytes_seen = self.stats.counters['image_cache_bytes_written']
+        try:
+            for (job, record_id), (serialized_record, failures) in zip(
+                    record_refs, serialized_records):
+                self._add_failures(job.split_name, record_id,
+                                   serialized_record is None, failures)
+                cache_bytes_seen = self._check_image_cache_size(
+                    cache_bytes_seen)
+                self._put_to_queue(
+                    write_queue, (job, record_id, serialized_record),
+                    writer_thread, errors)
+        except BaseException:
+            aborted.set()
+            raise
+        finally:
+            if writer_thread.is_alive():
+                write_queue.put(None)
+            writer_thread.join()
 
-        # Create and Write Records to TFRecord file
-        logger.info("Start Writing %s" % output_file)
-        n_records = len(record_ids)
-        successfull_writes = 0
-        start_time = time.time()
+        if len(errors) > 0:
+            raise errors[0]
 
-        # Randomly shuffle records before saving, this is better for
-        # model training
-        if self.random_shuffle_before_save:
-            random.seed(123)
-            random.shuffle(record_ids)
+    def _check_image_cache_size(self, cache_bytes_seen):
+        """ Account for images added to the cache since 'cache_bytes_seen'
+            bytes, the workers add images without checking the cache size
+        """
+        if self.image_cache is None:
+            return cache_bytes_seen
+        cache_bytes = self.stats.counters['image_cache_bytes_written']
+        if cache_bytes > cache_bytes_seen:
+            self.image_cache.add_written(cache_bytes - cache_bytes_seen)
+        return cache_bytes
 
-        # divide writes into batches
-        max_batch_size = min(self.process_images_in_parallel_size, n_records)
-        n_batches = (n_records // max_batch_size) \
-            + min(n_records % max_batch_size, 1)
-        slices = slice_generator(n_records, n_batches)
+    def _put_to_queue(self, write_queue, item, writer_thread, errors):
+        """ Put an item into the write queue, fail if the writer died """
+        while True:
+            try:
+                write_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not writer_thread.is_alive():
+                    if len(errors) > 0:
+                        raise errors[0]
+                    raise RuntimeError("TFRecord writer thread stopped")
 
-        with tf.python_io.TFRecordWriter(output_file) as writer:
+    def _write_from_queue(self, write_queue, jobs, n_records, aborted,
+                          errors):
+        """ Write serialized records from the queue to the files of their
+            jobs, a job is finished once the records of the next job arrive
 
-            for batch_i, (start_i, end_i) in enumerate(slices):
+            Jobs without records in the queue (all records were written by
+            a retry) are started and finished in between, so that all
+            planned files are written.
+        """
+        start_time = time.time()
+        last_report_time = start_time
+        jobs_to_start = deque(jobs)
+        job = None
+        i = 0
+        try:
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    break
+                next_job, record_id, serialized_record = item
 
-                # Divide current batch to multiple processes
-                record_batch = [self.tfrecord_dict[x] for x in
-                                record_ids[start_i: end_i]]
-                n_records_in_batch = len(record_batch)
+                if i % 1000 == 0:
+                    est_t = estimate_remaining_time(start_time, n_records, i)
+                    logger.debug(
+                        "Wrote %s / %s records (estimated time remaining: %s)"
+                        % (i, n_records, est_t))
+                i += 1
 
-                process_slices = slice_generator(
-                    n_records_in_batch,
-                    self.processes_images_in_parallel_n_processes)
+                if self.stats_report_interval is not None and \
+                   (time.time() - last_report_time) > \
+                   self.stats_report_interval:
+                    self.stats.write_report(self.stats_path)
+                    last_report_time = time.time()
 
-                manager = Manager()
-                serialized_records = manager.list()
+                if next_job is not job:
+                    if job is not None:
+                        job.finish(self)
+                    job = self._start_next_job(jobs_to_start, next_job)
 
-                processes_list = list()
+                if serialized_record is None:
+                    logger.debug("Discarding record %s - no image avail" %
+                                 record_id)
+                    self.stats.count('records_discarded')
+                    continue
 
-                for p_i, (batch_start_i, batch_end_i) in enumerate(process_slices):
+                # Write the serialized data to the TFRecords file.
+                with self.stats.time('write'):
+                    job.write(record_id, serialized_record)
+                self.stats.count('records_written')
+                self.stats.count('bytes_written', len(serialized_record) + 16)
+
+            if job is not None:
+                if aborted.is_set():
+                    job.abort()
+                else:
+                    job.finish(self)
+            if not aborted.is_set():
+                self._start_next_job(jobs_to_start, None)
+        except Exception as e:
+            logger.error("Failed to write TFRecord files, error %s" % str(e))
+            if job is not None:
+                job.abort()
+            errors.append(e)
 
-                    process_batch = record_batch[batch_start_i: batch_end_i]
-                    pr = Process(target=self._serialize_record_batch,
-                                 args=(process_batch, serialized_records))
-                    pr.start()
-                    processes_list.append(pr)
+    def _start_next_job(self, jobs_to_start, next_job):
+        """ Start 'next_job', the jobs before it have no records to write
+            and are finished right away
+        """
+        while len(jobs_to_start) > 0:
+            job = jobs_to_start.popleft()
+            job.start()
+            if job is next_job:
+                return job
+            job.finish(self)
+        return None
 
-                for p in processes_list:
-                    p.join()
+    def _finish_file(self, split_name, shard, output_file, record_ids,
+                     delta=False, tfrecord_dict=None):
+        """ Write the record index (and metadata) of a completely written
+            file, move the file to its final path and register it in the
+            manifest
+        """
+        file_info = {
+            'n_records': len(shard.record_ids),
+            'n_records_planned': len(record_ids),
+            'size': os.path.getsize(shard.tmp_path),
+            'md5': file_md5(shard.tmp_path),
+            'compression_type': shard.compression_type,
+            'record_ids_hash': hash_record_ids(record_ids)}
+        if delta:
+            file_info['delta'] = True
+        if tfrecord_dict is not None:
+            file_info['label_histograms'] = label_histograms(
+                tfrecord_dict, shard.record_ids)
 
-                # Write the serialized data to the TFRecords file.
-                for serialized_record in serialized_records:
-                    writer.write(serialized_record)
-                    successfull_writes += 1
-                est_t = estimate_remaining_time(start_time, n_records,
-                                                successfull_writes)
-                logger.debug("Wrote %s / %s records - estimated time remaining: %s - file: %s)" %
-                            (successfull_writes, n_records, est_t, output_file))
-
-            logger.info(
-                "Finished Writing Records to %s - Wrote %s/%s" %
-                (output_file, successfull_writes, n_records))
+        write_index(output_file, shard.index_entries)
+        if self.write_metadata:
+            write_metadata(output_file, tfrecord_dict, shard.record_ids)
+        os.replace(shard.tmp_path, output_file)
+        self.manifest.add_file(
+            split_name, os.path.basename(output_file), file_info)
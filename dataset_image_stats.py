@@ -0,0 +1,80 @@
+""" Report the Size Distributions of the Images in TFRecord Files
+
+Reads the image sizes stored in each record (height, width, channels and
+bytes per image) - the images are not decoded.
+
+Example Usage:
+--------------
+python dataset_image_stats.py -tfr_dir ./test_big/cats_vs_dogs/tfr_files/ \
+-model ResNet18 \
+-output_json ./test_big/cats_vs_dogs/tfr_files/image_stats.json
+"""
+import json
+import argparse
+import logging
+
+from config.config import ConfigLoader
+from config.config_logging import setup_logging
+from data.utils import find_tfr_files_pattern_subdir, export_dict_to_json
+from data.storage_profile import required_min_side
+from data.image_size_stats import image_size_stats_parallel
+
+# Configure Logging
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(prog='DATASET IMAGE STATS')
+    parser.add_argument("-tfr_dir", type=str, required=True,
+                        help="Directory with TFRecord files (including \
+                              sub-directories)")
+    parser.add_argument("-tfr_pattern", type=str, nargs='+', default=None,
+                        required=False,
+                        help="only use files whose names contain all of \
+                              these strings, e.g. 'train'")
+    parser.add_argument("-model", type=str, default=None, required=False,
+                        help="count the images that are too small for this \
+                              model (from config/models.yaml)")
+    parser.add_argument("-ignore_aspect_ratio", default=False,
+                        action='store_true', required=False,
+                        help="whether the model is trained with \
+                              -ignore_aspect_ratio (see train.py)")
+    parser.add_argument("-n_processes", type=int, default=4,
+                        required=False,
+                        help="number of files to read in parallel \
+                              (default 4)")
+    parser.add_argument("-output_json", type=str, default=None,
+                        required=False,
+                        help="write the report to this json file")
+    args = vars(parser.parse_args())
+
+    tfr_files = find_tfr_files_pattern_subdir(
+        args['tfr_dir'], args['tfr_pattern'])
+
+    logger.info("Reading image sizes of %s TFRecord files" % len(tfr_files))
+
+    stats = image_size_stats_parallel(tfr_files, args['n_processes'])
+
+    if args['model'] is not None:
+        model_cfg = ConfigLoader('./config/models.yaml')
+        image_processing = \
+            model_cfg.cfg['models'][args['model']]['image_processing']
+        min_side = required_min_side(
+            image_processing, args['ignore_aspect_ratio'])
+    else:
+        min_side = None
+
+    report = stats.report(min_side=min_side)
+
+    if stats.n_records_without_sizes > 0:
+        logger.info("%s records have no stored image sizes - the sizes "
+                    "were read from the JPEG headers" %
+                    stats.n_records_without_sizes)
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args['output_json'] is not None:
+        export_dict_to_json(report, args['output_json'])
@@ -18,6 +18,9 @@
     -batch_size (optional, default 128): the number of images once at a time
         to predict before writing results to disk
 
+    -scaled_decode (optional): decode JPEGs at 1/2, 1/4 or 1/8 scale if they
+        are still large enough for the model instead of at full size
+
     Usage example:
 
     python3 predict.py -image_dir /user/images/ \
@@ -61,6 +64,11 @@ if __name__ == '__main__':
         "-batch_size", default=128, type=int, required=False,
         help="the number of images once at a time \
               to predict before writing results to disk (default 128)")
+    parser.add_argument(
+        "-scaled_decode", default=False, action='store_true',
+        help="Decode JPEGs at 1/2, 1/4 or 1/8 scale if they are still \
+              large enough for the model. By default images are decoded \
+              at full size.")
 
     args = vars(parser.parse_args())
 
@@ -72,7 +80,8 @@ if __name__ == '__main__':
         model_path=args['model_path'],
         class_mapping_json=args['class_mapping_json'],
         pre_processing_json=args['pre_processing_json'],
-        batch_size=args['batch_size'])
+        batch_size=args['batch_size'],
+        scaled_decode=args['scaled_decode'])
 
     pred.predict_from_image_dir(
         image_dir=args['image_dir'],
@@ -5,11 +5,13 @@ import csv
 from collections import OrderedDict
 import traceback
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.keras import backend as K
 
 from training.prepare_model import load_model_from_disk
-from data.image import preprocess_image
+from data.image import preprocess_image, decode_jpeg_scaled
+from data.storage_profile import required_min_side
 from data.utils import (
     print_progress, export_dict_to_json, list_pictures,
     clean_input_path)
@@ -19,12 +21,16 @@ class Predictor(object):
     """ Class to Predict Images """
 
     def __init__(self, model_path, class_mapping_json, pre_processing_json,
-                 batch_size=128):
+                 batch_size=128, scaled_decode=False):
         """ Args:
             model_path: full path to a trained Keras model
             class_mapping_json: full path to json class mapping file
             pre_processing_json: full path to pre processing json file
             batch_size: numer of images to process once at a time
+            scaled_decode: decode JPEGs at 1/2, 1/4 or 1/8 scale if they
+             are still large enough for the pre-processing (the size is
+             read from the JPEG header), off by default as its effect on
+             the accuracy has not been measured yet
         """
         self.model_path = model_path
         self.class_mapping_json = class_mapping_json
@@ -32,6 +38,7 @@ class Predictor(object):
         self.batch_size = batch_size
         self.class_mapping = None
         self.pre_processing = None
+        self.decode_min_side = None
 
         # check file existence
         path_names = ['model_path', 'class_mapping_json',
@@ -62,6 +69,14 @@ class Predictor(object):
         print("Read following pre processing options:")
         self._log_cfg(self.pre_processing)
 
+        # decode images only as large as the pre-processing needs them
+        if scaled_decode:
+            self.decode_min_side = required_min_side(
+                self.pre_processing,
+                self.pre_processing.get('ignore_aspect_ratio', False))
+            print("Decoding images with a smaller side of at least %s" %
+                  self.decode_min_side)
+
         self.model = load_model_from_disk(self.model_path)
 
     def _log_cfg(self, cfg):
@@ -77,7 +92,9 @@ class Predictor(object):
     def predict_from_dataset(self, dataset, export_type, output_file):
         """  Predict from Dataset
         Args:
-        - dataset: a dataset object
+        - dataset: a dataset object, with stacked images of each record
+          (multi_image_mode 'stack' in DatasetReader.get_iterator) the
+          predictions are averaged over the images of a record
         - export_type: csv or json
         - output_file: path to write export file to
         """
@@ -140,7 +157,11 @@ class Predictor(object):
 
                 # Calculate Predictions
                 images = feat['images']
-                preds_list = self.model.predict_on_batch(images)
+                if 'n_images' in feat:
+                    preds_list = self._predict_stacked_images(
+                        images, feat['n_images'])
+                else:
+                    preds_list = self.model.predict_on_batch(images)
 
                 if not isinstance(preds_list, list):
                     preds_list = [preds_list]
@@ -229,6 +250,21 @@ class Predictor(object):
 
         self.predictions = all_predictions
 
+    def _predict_stacked_images(self, images, n_images):
+        """ Predict the stacked images of records (padded to the record
+            with the most images) and average the predictions of the
+            images of each record
+        """
+        record_images = np.concatenate(
+            [images[i, :n] for i, n in enumerate(n_images)])
+        preds_list = self.model.predict_on_batch(record_images)
+        if not isinstance(preds_list, list):
+            preds_list = [preds_list]
+        record_of_image = np.repeat(np.arange(len(n_images)), n_images)
+        return [np.stack([preds[record_of_image == i].mean(axis=0)
+                          for i in range(0, len(n_images))])
+                for preds in preds_list]
+
     def _create_dataset_from_paths(self, image_paths, batch_size):
         """ Creates a dataset from image_paths """
         dataset = tf.data.Dataset.from_tensor_slices(image_paths)
@@ -242,8 +278,13 @@ class Predictor(object):
     def _get_and_transform_image(self, image_path, pre_proc_args):
         """ Returns a processed image """
         image_raw = tf.read_file(image_path)
-        image_decoded = tf.image.decode_jpeg(image_raw, channels=3,
-                                             try_recover_truncated=True)
+        if self.decode_min_side is None:
+            image_decoded = tf.image.decode_jpeg(image_raw, channels=3,
+                                                 try_recover_truncated=True)
+        else:
+            image_decoded = decode_jpeg_scaled(image_raw,
+                                               self.decode_min_side,
+                                               try_recover_truncated=True)
         image_processed = preprocess_image(image_decoded, **pre_proc_args)
         return {'images': image_processed}, {'file_paths': image_path}
 
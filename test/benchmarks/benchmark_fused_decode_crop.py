@@ -0,0 +1,179 @@
+""" Benchmark the fused decode-and-crop training path
+
+Writes the test images as records the way create_dataset.py stores them
+for a model (smaller side resized to the storage profile of the model,
+image sizes stored) and measures the images per second per core of the
+training input pipeline (decoding and pre-processing, JPEGs are decoded
+at a reduced scale if they are large enough as in train.py):
+- full decode: decode the whole JPEG, resize and randomly crop
+- fused decode-and-crop: sample the crop from the stored image size and
+  decode only that region (fused_decode_crop in DatasetReader.get_iterator)
+The mean and standard deviation of the output pixels are reported to
+compare the augmentation of both paths. The test images are small, hence
+they are upscaled to camera-trap size first (-source_side_max).
+
+Example Usage:
+--------------
+PYTHONPATH=. python test/benchmarks/benchmark_fused_decode_crop.py \
+-image_dir ./test/test_images/ \
+-model ResNet18 \
+-n_repeats 80
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from config.config import ConfigLoader
+from data.reader import DatasetReader
+from data.image import preprocess_image, resize_jpeg, image_dimensions
+from data.storage_profile import required_min_side
+from data.tfr_encoder_decoder import DefaultTFRecordEncoderDecoder
+from data.utils import list_pictures
+
+
+def large_jpeg(image_path, source_side_max):
+    """ Upscale an image to simulate a large camera trap image """
+    img = Image.open(image_path).convert('RGB')
+    if source_side_max > 0:
+        scale = source_side_max / max(img.size)
+        size = (int(img.size[0] * scale), int(img.size[1] * scale))
+        img = img.resize(size, Image.BICUBIC)
+    b = io.BytesIO()
+    img.save(b, 'JPEG', quality=90)
+    return b.getvalue()
+
+
+def write_tfr_file(image_paths, output_dir, source_side_max, stored_min_side):
+    """ Write one record per image, stored as create_dataset.py would """
+    encoder_decoder = DefaultTFRecordEncoderDecoder()
+    tfr_file = os.path.join(output_dir, 'train_001.tfrecord')
+    with tf.python_io.TFRecordWriter(tfr_file) as writer:
+        for i, image_path in enumerate(image_paths):
+            image = resize_jpeg(large_jpeg(image_path, source_side_max),
+                                min_side=stored_min_side)
+            height, width, channels = image_dimensions(image)
+            writer.write(encoder_decoder.encode_record({
+                'id': 'record_%s' % i,
+                'n_images': 1,
+                'n_labels': 1,
+                'image_paths': [image_path],
+                'images': [image],
+                'meta_data': '',
+                'labelstext': '#species:cat',
+                'label/species': ['cat'],
+                'label_num/species': [0],
+                'image_heights': [height],
+                'image_widths': [width],
+                'image_channels': [channels],
+                'image_n_bytes': [len(image)]}))
+    return tfr_file
+
+
+def train_images_per_s(tfr_file, image_processing, n_repeats, batch_size,
+                       fused_decode_crop):
+    """ Images per second of the training pipeline on one core, and the
+        mean and standard deviation of the output pixels
+    """
+    encoder_decoder = DefaultTFRecordEncoderDecoder()
+    reader = DatasetReader(encoder_decoder.decode_record)
+    config = tf.ConfigProto(intra_op_parallelism_threads=1,
+                            inter_op_parallelism_threads=1)
+    with tf.Graph().as_default():
+        dataset = reader.get_iterator(
+            tfr_files=[tfr_file],
+            batch_size=batch_size,
+            is_train=True,
+            n_repeats=n_repeats,
+            output_labels=['species'],
+            image_pre_processing_fun=preprocess_image,
+            image_pre_processing_args={
+                **image_processing,
+                'is_training': True},
+            buffer_size=batch_size,
+            num_parallel_calls=1,
+            interleave_cycle_length=1,
+            decode_min_side=required_min_side(image_processing),
+            fused_decode_crop=fused_decode_crop)
+        iterator = dataset.make_initializable_iterator()
+        next_batch = iterator.get_next()
+        n_images, n_pixels = 0, 0
+        pixel_sum, pixel_sq_sum = 0.0, 0.0
+        with tf.Session(config=config) as sess:
+            sess.run(iterator.initializer)
+            # do not time the first batch (initialization)
+            sess.run(next_batch)
+            start_time = time.time()
+            while True:
+                try:
+                    images = sess.run(next_batch)[0]['images']
+                except tf.errors.OutOfRangeError:
+                    break
+                n_images += images.shape[0]
+                pixel_sum += images.sum(dtype=np.float64)
+                pixel_sq_sum += (images.astype(np.float64) ** 2).sum()
+                n_pixels += images.size
+            duration = time.time() - start_time
+    mean = pixel_sum / n_pixels
+    stdev = np.sqrt(pixel_sq_sum / n_pixels - mean ** 2)
+    return n_images / duration, mean, stdev
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='BENCHMARK FUSED DECODE CROP')
+    parser.add_argument("-image_dir", type=str,
+                        default='./test/test_images/')
+    parser.add_argument("-model", type=str, default='ResNet18')
+    parser.add_argument("-n_images", type=int, default=20)
+    parser.add_argument("-source_side_max", type=int, default=2048,
+                        help="upscale images to this size before storing \
+                              them (0 to use images as they are)")
+    parser.add_argument("-stored_min_side", type=int, default=None,
+                        help="smaller side of the stored images (default: \
+                              storage profile of the model)")
+    parser.add_argument("-batch_size", type=int, default=32)
+    parser.add_argument("-n_repeats", type=int, default=80)
+    parser.add_argument("-n_trials", type=int, default=3)
+    args = vars(parser.parse_args())
+
+    model_cfg = ConfigLoader('./config/models.yaml')
+    image_processing = \
+        model_cfg.cfg['models'][args['model']]['image_processing']
+    stored_min_side = args['stored_min_side'] or \
+        required_min_side(image_processing)
+
+    image_paths = list_pictures(args['image_dir'])[0:args['n_images']]
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        tfr_file = write_tfr_file(image_paths, tmp_dir,
+                                  args['source_side_max'], stored_min_side)
+
+        # best of n_trials (alternating the paths)
+        results = {False: list(), True: list()}
+        for _ in range(0, args['n_trials']):
+            for fused_decode_crop in [False, True]:
+                results[fused_decode_crop].append(train_images_per_s(
+                    tfr_file, image_processing, args['n_repeats'],
+                    args['batch_size'], fused_decode_crop))
+        full_per_s, full_mean, full_stdev = max(results[False])
+        fused_per_s, fused_mean, fused_stdev = max(results[True])
+
+        print("Model: %s Images: %s Stored smaller side: %s" %
+              (args['model'], len(image_paths), stored_min_side))
+        print("Full decode:           %.1f images / s / core "
+              "(pixels: mean %.2f stdev %.2f)" %
+              (full_per_s, full_mean, full_stdev))
+        print("Fused decode-and-crop: %.1f images / s / core "
+              "(pixels: mean %.2f stdev %.2f)" %
+              (fused_per_s, fused_mean, fused_stdev))
+        print("Speedup:               %.2fx" % (fused_per_s / full_per_s))
+    finally:
+        shutil.rmtree(tmp_dir)
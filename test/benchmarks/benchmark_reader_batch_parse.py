@@ -0,0 +1,183 @@
+""" Benchmark parsing records one at a time against batch parsing
+
+Writes synthetic records (random JPEGs) as sequence_example and as
+flat_example TFRecord files and measures the records per second of the
+DatasetReader (label lookup, decoding and pre-processing included):
+- sequence_example: current pipeline (baseline)
+- flat_example: records parsed one at a time
+- flat_example + batch_parse: batches parsed at once
+Use -skip_images to measure parsing and label lookups only.
+
+Example Usage:
+--------------
+PYTHONPATH=. python test/benchmarks/benchmark_reader_batch_parse.py \
+-n_records 2000 \
+-batch_size 128 \
+-num_parallel_calls 4
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from data.reader import DatasetReader
+from data.image import preprocess_image
+from data.tfr_encoder_decoder import (
+    create_tfr_encoder_decoder, SEQUENCE_EXAMPLE_FORMAT, FLAT_EXAMPLE_FORMAT)
+
+
+LABEL_MAPPING = {'species': {'species_%s' % i: i for i in range(0, 10)},
+                 'count': {str(i): i for i in range(0, 5)}}
+
+
+def random_jpeg(width, height, random_state):
+    image = random_state.randint(0, 255, (height, width, 3), dtype=np.uint8)
+    b = io.BytesIO()
+    Image.fromarray(image).save(b, 'JPEG')
+    return b.getvalue()
+
+
+def create_tfrecord_dict(n_records, image_side, max_images_per_record=3):
+    """ Records with one to 'max_images_per_record' images and two
+        labels
+    """
+    random_state = np.random.RandomState(123)
+    images = [random_jpeg(image_side, int(image_side * 0.75), random_state)
+              for _ in range(0, 20)]
+    tfrecord_dict = dict()
+    for i in range(0, n_records):
+        record_id = 'record_%s' % i
+        n_images = 1 + i % max_images_per_record
+        species = 'species_%s' % (i % 10)
+        count = str(i % 5)
+        tfrecord_dict[record_id] = {
+            'id': record_id,
+            'n_images': n_images,
+            'n_labels': 1,
+            'image_paths': ['%s_%s' % (i, j) for j in range(0, n_images)],
+            'images': [images[(i + j) % len(images)]
+                       for j in range(0, n_images)],
+            'meta_data': '',
+            'labelstext': '#species:%s#count:%s' % (species, count),
+            'label/species': [species],
+            'label/count': [count],
+            'label_num/species': [LABEL_MAPPING['species'][species]],
+            'label_num/count': [LABEL_MAPPING['count'][count]]}
+    return tfrecord_dict
+
+
+def write_tfr_files(tfrecord_dict, encoder_decoder, output_dir,
+                    records_per_file=500):
+    """ Write the records with the encoder of a record format """
+    record_ids = sorted(tfrecord_dict.keys())
+    tfr_files = list()
+    for start in range(0, len(record_ids), records_per_file):
+        tfr_file = os.path.join(
+            output_dir, 'train_%03d.tfrecord' % (len(tfr_files) + 1))
+        with tf.python_io.TFRecordWriter(tfr_file) as writer:
+            for record_id in record_ids[start:start + records_per_file]:
+                writer.write(encoder_decoder.encode_record(
+                    tfrecord_dict[record_id]))
+        tfr_files.append(tfr_file)
+    return tfr_files
+
+
+def read_records_per_s(reader, tfr_files, args, batch_parse):
+    """ Records per second of reading all records with the reader """
+    with tf.Graph().as_default():
+        dataset = reader.get_iterator(
+            tfr_files=tfr_files,
+            batch_size=args['batch_size'],
+            is_train=False,
+            n_repeats=args['n_repeats'],
+            output_labels=['species', 'count'],
+            label_to_numeric_mapping=LABEL_MAPPING,
+            image_pre_processing_fun=preprocess_image,
+            image_pre_processing_args={
+                'output_height': args['output_side'],
+                'output_width': args['output_side'],
+                'resize_side_min': args['output_side'],
+                'resize_side_max': args['output_side'],
+                'is_training': False},
+            num_parallel_calls=args['num_parallel_calls'],
+            decode_images=not args['skip_images'],
+            batch_parse=batch_parse)
+        iterator = dataset.make_initializable_iterator()
+        next_batch = iterator.get_next()
+        n_records = 0
+        with tf.Session() as sess:
+            tf.tables_initializer().run()
+            sess.run(iterator.initializer)
+            # do not time the first batch (initialization)
+            sess.run(next_batch)
+            start_time = time.time()
+            while True:
+                try:
+                    batch = sess.run(next_batch)
+                    if not args['skip_images']:
+                        batch = batch[1]
+                    n_records += batch['id'].shape[0]
+                except tf.errors.OutOfRangeError:
+                    break
+            duration = time.time() - start_time
+    return n_records / duration
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='BENCHMARK READER BATCH PARSE')
+    parser.add_argument("-n_records", type=int, default=2000)
+    parser.add_argument("-image_side", type=int, default=64)
+    parser.add_argument("-output_side", type=int, default=32)
+    parser.add_argument("-batch_size", type=int, default=128)
+    parser.add_argument("-num_parallel_calls", type=int, default=4)
+    parser.add_argument("-n_repeats", type=int, default=3)
+    parser.add_argument("-skip_images", default=False, action='store_true',
+                        help="do not decode the images (measure parsing and \
+                              label lookups only)")
+    args = vars(parser.parse_args())
+
+    # records without decoded images can only be batched if they have the
+    # same number of images
+    tfrecord_dict = create_tfrecord_dict(
+        args['n_records'], args['image_side'],
+        1 if args['skip_images'] else 3)
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        tfr_files = dict()
+        encoder_decoders = dict()
+        for record_format in [SEQUENCE_EXAMPLE_FORMAT, FLAT_EXAMPLE_FORMAT]:
+            output_dir = os.path.join(tmp_dir, record_format)
+            os.makedirs(output_dir)
+            encoder_decoder = create_tfr_encoder_decoder(record_format)
+            tfr_files[record_format] = write_tfr_files(
+                tfrecord_dict, encoder_decoder, output_dir)
+            encoder_decoders[record_format] = encoder_decoder
+
+        results = list()
+        for name, record_format, batch_parse in [
+                ('sequence_example', SEQUENCE_EXAMPLE_FORMAT, False),
+                ('flat_example', FLAT_EXAMPLE_FORMAT, False),
+                ('flat_example batch_parse', FLAT_EXAMPLE_FORMAT, True)]:
+            encoder_decoder = encoder_decoders[record_format]
+            reader = DatasetReader(encoder_decoder.decode_record,
+                                   encoder_decoder)
+            results.append((name, read_records_per_s(
+                reader, tfr_files[record_format], args, batch_parse)))
+
+        print("Records: %s Batch size: %s Parallel calls: %s" %
+              (args['n_records'], args['batch_size'],
+               args['num_parallel_calls']))
+        baseline = results[0][1]
+        for name, records_per_s in results:
+            print("%-26s %10.1f records/s %6.2fx" %
+                  (name, records_per_s, records_per_s / baseline))
+    finally:
+        shutil.rmtree(tmp_dir)
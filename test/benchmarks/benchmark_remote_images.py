@@ -0,0 +1,109 @@
+""" Benchmark fetching images from an HTTP server
+
+Serves the test images from a local HTTP server that adds a fixed latency
+to each request (to simulate an object store) and compares fetching them
+one by one (urllib) with the RemoteImageFetcher using different numbers of
+connections.
+
+Example Usage:
+--------------
+PYTHONPATH=. python test/benchmarks/benchmark_remote_images.py \
+-image_dir ./test/test_images/ \
+-latency_ms 20 \
+-max_connections 1 4 16 32
+"""
+import argparse
+import functools
+import os
+import threading
+import time
+import urllib.request
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from data.remote import RemoteImageFetcher, join_url
+from data.utils import list_pictures
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _SlowHandler(SimpleHTTPRequestHandler):
+    """ Serve files with an additional latency per request """
+    protocol_version = 'HTTP/1.1'
+    # send responses immediately on keep-alive connections
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        SimpleHTTPRequestHandler.do_GET(self)
+
+
+def fetch_sequential(urls):
+    """ Images and bytes per second fetching one image after the other """
+    start_time = time.time()
+    n_bytes = 0
+    for url in urls:
+        with urllib.request.urlopen(url) as response:
+            n_bytes += len(response.read())
+    duration = time.time() - start_time
+    return len(urls) / duration, n_bytes / duration
+
+
+def fetch_with_fetcher(urls, max_connections):
+    """ Images and bytes per second with the RemoteImageFetcher """
+    fetcher = RemoteImageFetcher(
+        max_connections=max_connections,
+        prefetch_size=2 * max_connections)
+    start_time = time.time()
+    n_bytes = 0
+    for fetched in fetcher.prefetch([[x] for x in urls]):
+        for image in fetched.values():
+            if isinstance(image, Exception):
+                raise image
+            n_bytes += len(image)
+    duration = time.time() - start_time
+    fetcher.close()
+    return len(urls) / duration, n_bytes / duration
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='BENCHMARK REMOTE IMAGES')
+    parser.add_argument("-image_dir", type=str,
+                        default='./test/test_images/')
+    parser.add_argument("-latency_ms", type=float, default=20)
+    parser.add_argument("-max_connections", type=int, nargs='+',
+                        default=[1, 4, 16, 32])
+    args = vars(parser.parse_args())
+
+    image_dir = os.path.abspath(args['image_dir'])
+    _SlowHandler.latency = args['latency_ms'] / 1000
+    server = _ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        functools.partial(_SlowHandler, directory=image_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    root_url = 'http://127.0.0.1:%s/' % server.server_address[1]
+
+    urls = [join_url(root_url, os.path.relpath(x, image_dir))
+            for x in list_pictures(image_dir)]
+
+    print("Images: %s Latency: %s ms" % (len(urls), args['latency_ms']))
+    print("%-24s %10s %10s" % ('Client', 'Images/s', 'MB/s'))
+    images_per_s, bytes_per_s = fetch_sequential(urls)
+    print("%-24s %10.1f %10.2f" % (
+          'sequential (urllib)', images_per_s, bytes_per_s / 2**20))
+    for max_connections in args['max_connections']:
+        images_per_s, bytes_per_s = fetch_with_fetcher(urls, max_connections)
+        print("%-24s %10.1f %10.2f" % (
+              'fetcher %s connections' % max_connections, images_per_s,
+              bytes_per_s / 2**20))
+
+    server.shutdown()
+    server.server_close()
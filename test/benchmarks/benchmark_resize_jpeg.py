@@ -0,0 +1,116 @@
+""" Benchmark reduced (DCT-domain) JPEG decoding in resize_jpeg
+
+Compares the decode + resize time and the similarity of the output of
+resize_jpeg with reduced decoding against a full resolution decode.
+The test images are small, hence they are upscaled to camera-trap size
+first (-source_side_max).
+
+Example Usage:
+--------------
+PYTHONPATH=. python test/benchmarks/benchmark_resize_jpeg.py \
+-image_dir ./test/test_images/ \
+-source_side_max 4000 \
+-max_side 500
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from data.image import resize_jpeg
+from data.utils import list_pictures
+
+
+def resize_jpeg_full_decode(image, max_side):
+    """ Resize path before reduced decoding: decode at full resolution """
+    img = Image.open(image)
+    img.load()
+    img.thumbnail([max_side, max_side], Image.ANTIALIAS)
+    b = io.BytesIO()
+    img.save(b, 'JPEG')
+    return b.getvalue()
+
+
+def create_large_images(image_paths, output_dir, source_side_max):
+    """ Upscale images to simulate large camera trap images """
+    large_paths = list()
+    for i, image_path in enumerate(image_paths):
+        img = Image.open(image_path).convert('RGB')
+        scale = source_side_max / max(img.size)
+        size = (int(img.size[0] * scale), int(img.size[1] * scale))
+        large_path = os.path.join(output_dir, 'large_%s.jpg' % i)
+        img.resize(size, Image.BICUBIC).save(large_path, 'JPEG', quality=90)
+        large_paths.append(large_path)
+    return large_paths
+
+
+def psnr(image_bytes_a, image_bytes_b):
+    """ Peak signal to noise ratio of two encoded images """
+    img_a = Image.open(io.BytesIO(image_bytes_a)).convert('RGB')
+    img_b = Image.open(io.BytesIO(image_bytes_b)).convert('RGB')
+    if img_a.size != img_b.size:
+        img_b = img_b.resize(img_a.size, Image.BICUBIC)
+    a = np.asarray(img_a, dtype=np.float64)
+    b = np.asarray(img_b, dtype=np.float64)
+    mse = np.mean((a - b) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(255.0 ** 2 / mse)
+
+
+def time_fun(fun, image_paths, n_repeats):
+    """ Average seconds per image """
+    start_time = time.time()
+    for _ in range(0, n_repeats):
+        for image_path in image_paths:
+            fun(image_path)
+    return (time.time() - start_time) / (n_repeats * len(image_paths))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='BENCHMARK RESIZE JPEG')
+    parser.add_argument("-image_dir", type=str,
+                        default='./test/test_images/')
+    parser.add_argument("-n_images", type=int, default=20)
+    parser.add_argument("-source_side_max", type=int, default=4000,
+                        help="upscale images to this size before the \
+                              benchmark (0 to use images as they are)")
+    parser.add_argument("-max_side", type=int, default=500)
+    parser.add_argument("-n_repeats", type=int, default=3)
+    args = vars(parser.parse_args())
+
+    image_paths = list_pictures(args['image_dir'])[0:args['n_images']]
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        if args['source_side_max'] > 0:
+            image_paths = create_large_images(
+                image_paths, tmp_dir, args['source_side_max'])
+
+        max_side = args['max_side']
+
+        def reduced(x):
+            return resize_jpeg(x, max_side, reduced_decode=True)
+
+        def full(x):
+            return resize_jpeg_full_decode(x, max_side)
+
+        t_full = time_fun(full, image_paths, args['n_repeats'])
+        t_reduced = time_fun(reduced, image_paths, args['n_repeats'])
+        similarities = [psnr(full(x), reduced(x)) for x in image_paths]
+
+        print("Images: %s Source side max: %s Target side max: %s" %
+              (len(image_paths), args['source_side_max'], max_side))
+        print("Full decode:    %.1f ms / image" % (t_full * 1000))
+        print("Reduced decode: %.1f ms / image" % (t_reduced * 1000))
+        print("Speedup:        %.2fx" % (t_full / t_reduced))
+        print("PSNR reduced vs full decode: mean %.2f dB min %.2f dB" %
+              (np.mean(similarities), np.min(similarities)))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,186 @@
+""" Benchmark scaled JPEG decoding of the Predictor
+
+Compares decoding images at full size against decoding them at 1/2, 1/4
+or 1/8 scale (the scale is chosen from the JPEG header and the size the
+pre-processing needs) as in Predictor._get_and_transform_image:
+- throughput: images per second of decoding and pre-processing
+- difference: mean absolute difference of the pre-processed images
+The test images are small, hence they are upscaled to camera-trap size
+first (-source_side_max).
+
+With a trained model (-model_path, -class_mapping_json,
+-pre_processing_json) the accuracy of both decodings is compared on a
+held-out image directory with class sub-directories (see README, option 1
+of the data preparation), the directory names are the ground truth.
+
+Example Usage:
+--------------
+PYTHONPATH=. python test/benchmarks/benchmark_scaled_decode_predictor.py \
+-image_dir ./test/test_images/ \
+-model ResNet18 \
+-source_side_max 3000
+
+PYTHONPATH=. python test/benchmarks/benchmark_scaled_decode_predictor.py \
+-image_dir /my_images/held_out/ \
+-source_side_max 0 \
+-model_path /my_model/save1/best_model.hdf5 \
+-class_mapping_json /my_model/save1/label_mappings.json \
+-pre_processing_json /my_model/save1/image_processing.json
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from config.config import ConfigLoader
+from data.image import preprocess_image, decode_jpeg_scaled
+from data.storage_profile import required_min_side
+from data.utils import list_pictures
+from benchmark_resize_jpeg import create_large_images
+
+
+def preprocessed_images(image_paths, pre_processing, decode_min_side,
+                        batch_size, n_repeats):
+    """ Images per second of decoding and pre-processing the images on
+        one core, and the pre-processed images of the first repeat
+    """
+    def get_and_transform_image(image_path):
+        image_raw = tf.read_file(image_path)
+        if decode_min_side is None:
+            image = tf.image.decode_jpeg(image_raw, channels=3,
+                                         try_recover_truncated=True)
+        else:
+            image = decode_jpeg_scaled(image_raw, decode_min_side,
+                                       try_recover_truncated=True)
+        return preprocess_image(image, **pre_processing)
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=1,
+                            inter_op_parallelism_threads=1)
+    with tf.Graph().as_default():
+        dataset = tf.data.Dataset.from_tensor_slices(image_paths)
+        dataset = dataset.map(get_and_transform_image)
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.repeat(n_repeats)
+        iterator = dataset.make_initializable_iterator()
+        next_batch = iterator.get_next()
+        images = list()
+        with tf.Session(config=config) as sess:
+            sess.run(iterator.initializer)
+            start_time = time.time()
+            while True:
+                try:
+                    batch = sess.run(next_batch)
+                except tf.errors.OutOfRangeError:
+                    break
+                if len(images) < len(image_paths):
+                    images += list(batch)
+            duration = time.time() - start_time
+    return len(image_paths) * n_repeats / duration, np.stack(images)
+
+
+def accuracy_on_image_dir(image_dir, args, scaled_decode):
+    """ Predictions of a trained model on a held-out image directory
+        Returns: {image_path: (ground truth, top prediction)}
+    """
+    from tensorflow.python.keras import backend as K
+    from predicting.predictor import Predictor
+
+    K.clear_session()
+    pred = Predictor(
+        model_path=args['model_path'],
+        class_mapping_json=args['class_mapping_json'],
+        pre_processing_json=args['pre_processing_json'],
+        batch_size=args['batch_size'],
+        scaled_decode=scaled_decode)
+    output_file = os.path.join(tempfile.mkdtemp(), 'preds.csv')
+    pred.predict_from_image_dir(image_dir, 'csv', output_file)
+    shutil.rmtree(os.path.dirname(output_file))
+    results = dict()
+    for image_path, outputs in pred.predictions.items():
+        ground_truth = os.path.basename(os.path.dirname(image_path))
+        top = outputs[args['label']]['prediction_top']
+        results[image_path] = (ground_truth, top)
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='BENCHMARK SCALED DECODE')
+    parser.add_argument("-image_dir", type=str,
+                        default='./test/test_images/')
+    parser.add_argument("-model", type=str, default='ResNet18',
+                        help="model in config/models.yaml whose \
+                              pre-processing is used (if no \
+                              -pre_processing_json is specified)")
+    parser.add_argument("-n_images", type=int, default=20)
+    parser.add_argument("-source_side_max", type=int, default=3000,
+                        help="upscale images to this size before the \
+                              benchmark (0 to use images as they are)")
+    parser.add_argument("-batch_size", type=int, default=20)
+    parser.add_argument("-n_repeats", type=int, default=5)
+    parser.add_argument("-n_trials", type=int, default=3)
+    parser.add_argument("-model_path", type=str, default=None)
+    parser.add_argument("-class_mapping_json", type=str, default=None)
+    parser.add_argument("-pre_processing_json", type=str, default=None)
+    parser.add_argument("-label", type=str, default='species',
+                        help="label to compare the accuracy of")
+    args = vars(parser.parse_args())
+
+    if args['pre_processing_json'] is not None:
+        with open(args['pre_processing_json'], 'r') as f:
+            pre_processing = json.load(f)
+    else:
+        model_cfg = ConfigLoader('./config/models.yaml')
+        pre_processing = {
+            **model_cfg.cfg['models'][args['model']]['image_processing'],
+            'is_training': False}
+    decode_min_side = required_min_side(
+        pre_processing, pre_processing.get('ignore_aspect_ratio', False))
+
+    image_paths = list_pictures(args['image_dir'],
+                                ext='jpg|jpeg')[0:args['n_images']]
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        if args['source_side_max'] > 0:
+            image_paths = create_large_images(
+                image_paths, tmp_dir, args['source_side_max'])
+
+        # best of n_trials (alternating full and scaled decoding)
+        results = {None: list(), decode_min_side: list()}
+        for _ in range(0, args['n_trials']):
+            for min_side in results.keys():
+                results[min_side].append(preprocessed_images(
+                    image_paths, pre_processing, min_side,
+                    args['batch_size'], args['n_repeats']))
+        full_per_s = max([x[0] for x in results[None]])
+        scaled_per_s = max([x[0] for x in results[decode_min_side]])
+        difference = np.mean(np.abs(
+            results[None][0][1] - results[decode_min_side][0][1]))
+
+        print("Images: %s Source side max: %s Decode min side: %s" %
+              (len(image_paths), args['source_side_max'], decode_min_side))
+        print("Full decode:   %.1f images / s / core" % full_per_s)
+        print("Scaled decode: %.1f images / s / core" % scaled_per_s)
+        print("Speedup:       %.2fx" % (scaled_per_s / full_per_s))
+        print("Mean absolute difference of the pre-processed images: %.4f" %
+              difference)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args['model_path'] is not None:
+        full = accuracy_on_image_dir(args['image_dir'], args, False)
+        scaled = accuracy_on_image_dir(args['image_dir'], args, True)
+        ids = sorted(set(full.keys()) & set(scaled.keys()))
+        print("Held-out images: %s" % len(ids))
+        print("Accuracy full decode:   %.4f" %
+              np.mean([full[x][0] == full[x][1] for x in ids]))
+        print("Accuracy scaled decode: %.4f" %
+              np.mean([scaled[x][0] == scaled[x][1] for x in ids]))
+        print("Same top prediction:    %.4f" %
+              np.mean([full[x][1] == scaled[x][1] for x in ids]))
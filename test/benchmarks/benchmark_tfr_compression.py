@@ -0,0 +1,139 @@
+""" Benchmark compressed TFRecord files
+
+Writes the test images as TFRecord files without compression, with GZIP
+and with ZLIB and compares the file size and the read throughput (raw
+records and the tf.data pipeline of the DatasetReader).
+
+Example Usage:
+--------------
+PYTHONPATH=. python test/benchmarks/benchmark_tfr_compression.py \
+-image_dir ./test/test_images/ \
+-n_repeats 5
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import tensorflow as tf
+
+from data.writer import DatasetWriter
+from data.tfr_encoder_decoder import DefaultTFRecordEncoderDecoder
+from data.image import resize_jpeg
+from data.utils import (
+    list_pictures, find_tfr_files, tfr_record_iterator,
+    detect_tfr_compression_type)
+
+
+def create_tfrecord_dict(image_paths):
+    """ Records with one image and a label """
+    tfrecord_dict = dict()
+    for i, image_path in enumerate(image_paths):
+        record_id = 'record_%s' % i
+        label = os.path.basename(os.path.dirname(image_path))
+        tfrecord_dict[record_id] = {
+            'id': record_id,
+            'n_images': 1,
+            'n_labels': 1,
+            'image_paths': [image_path],
+            'meta_data': '{"path": "%s"}' % image_path,
+            'labelstext': '#class:%s' % label,
+            'label/class': [label],
+            'label_num/class': [0]}
+    return tfrecord_dict
+
+
+def read_raw(tfr_files, n_repeats):
+    """ Records and bytes per second of reading the raw records """
+    start_time = time.time()
+    n_records = 0
+    n_bytes = 0
+    for _ in range(0, n_repeats):
+        for tfr_file in tfr_files:
+            for record in tfr_record_iterator(tfr_file):
+                n_records += 1
+                n_bytes += len(record)
+    duration = time.time() - start_time
+    return n_records / duration, n_bytes / duration
+
+
+def read_tf_data(tfr_files, n_repeats):
+    """ Records per second of reading through tf.data """
+    compression_types = [detect_tfr_compression_type(x) for x in tfr_files]
+    with tf.Graph().as_default():
+        dataset = tf.data.Dataset.from_tensor_slices(
+            (tfr_files, compression_types))
+        dataset = dataset.apply(
+            tf.contrib.data.parallel_interleave(
+                lambda filename, compression: tf.data.TFRecordDataset(
+                    filename, compression_type=compression),
+                cycle_length=4))
+        dataset = dataset.repeat(n_repeats).batch(64)
+        next_batch = dataset.make_one_shot_iterator().get_next()
+        n_records = 0
+        with tf.Session() as sess:
+            start_time = time.time()
+            while True:
+                try:
+                    n_records += sess.run(next_batch).shape[0]
+                except tf.errors.OutOfRangeError:
+                    break
+            duration = time.time() - start_time
+    return n_records / duration
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='BENCHMARK TFRECORD COMPRESSION')
+    parser.add_argument("-image_dir", type=str,
+                        default='./test/test_images/')
+    parser.add_argument("-image_save_side_max", type=int, default=500)
+    parser.add_argument("-n_repeats", type=int, default=5)
+    args = vars(parser.parse_args())
+
+    image_paths = list_pictures(args['image_dir'])
+    tfrecord_dict = create_tfrecord_dict(image_paths)
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        results = list()
+        for compression_type in [None, 'GZIP', 'ZLIB']:
+            output_dir = os.path.join(tmp_dir, str(compression_type))
+            os.makedirs(output_dir)
+            writer = DatasetWriter(
+                DefaultTFRecordEncoderDecoder().encode_record)
+            start_time = time.time()
+            writer.encode_to_tfr(
+                tfrecord_dict, output_dir, 'train',
+                image_pre_processing_fun=resize_jpeg,
+                image_pre_processing_args={
+                    'max_side': args['image_save_side_max']},
+                max_records_per_file=50,
+                stats_report_interval=None,
+                compression_type=compression_type)
+            write_time = time.time() - start_time
+            tfr_files = find_tfr_files(output_dir)
+            size = sum([os.path.getsize(x) for x in tfr_files])
+            raw_records_per_s, raw_bytes_per_s = read_raw(
+                tfr_files, args['n_repeats'])
+            tf_data_records_per_s = read_tf_data(
+                tfr_files, args['n_repeats'])
+            results.append((compression_type, size, write_time,
+                            raw_records_per_s, raw_bytes_per_s,
+                            tf_data_records_per_s))
+
+        size_uncompressed = results[0][1]
+        print("Records: %s Image side max: %s" %
+              (len(tfrecord_dict), args['image_save_side_max']))
+        print("%-6s %10s %7s %9s %14s %14s %16s" % (
+              'Type', 'Size (KB)', 'Ratio', 'Write (s)', 'Raw records/s',
+              'Raw MB/s', 'tf.data records/s'))
+        for (compression_type, size, write_time, raw_records_per_s,
+             raw_bytes_per_s, tf_data_records_per_s) in results:
+            print("%-6s %10.1f %7.3f %9.2f %14.1f %14.1f %16.1f" % (
+                  compression_type or 'NONE', size / 1024,
+                  size / size_uncompressed, write_time, raw_records_per_s,
+                  raw_bytes_per_s / 2**20, tf_data_records_per_s))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,89 @@
+""" Benchmark encoding records in the protobuf wire format
+
+Compares encode_record (wire format) against building the tf.train protos
+(_encode_record_proto) for synthetic records and checks that both create
+identical bytes.
+
+Example Usage:
+--------------
+PYTHONPATH=. python test/benchmarks/benchmark_tfr_encoder.py \
+-n_records 5000 \
+-n_images 3 \
+-image_kb 40
+"""
+import argparse
+import os
+import time
+
+from data.tfr_encoder_decoder import DefaultTFRecordEncoderDecoder
+
+
+def create_records(n_records, n_images, image_kb, n_labels):
+    """ Records as created by DatasetInventory.get_tfrecord_dict """
+    images = [os.urandom(image_kb * 1024) for _ in range(0, n_images)]
+    records = list()
+    for i in range(0, n_records):
+        record = {
+            'id': 'capture_%s' % i,
+            'n_images': n_images,
+            'n_labels': 1,
+            'image_paths': ['/data/site_A/capture_%s_%s.jpg' % (i, j)
+                            for j in range(0, n_images)],
+            'meta_data': '{"site": "A", "roll": "%s"}' % i,
+            'labelstext': '#species:zebra#count:2',
+            'images': images,
+            'image_heights': [375] * n_images,
+            'image_widths': [500] * n_images,
+            'image_channels': [3] * n_images,
+            'image_n_bytes': [len(x) for x in images]}
+        for j in range(0, n_labels):
+            record['label/label_%s' % j] = ['value_%s' % (i % 7)]
+            record['label_num/label_%s' % j] = [i % 7]
+        records.append(record)
+    return records
+
+
+def time_fun(fun, records, n_repeats):
+    """ Records per second (best of n_repeats) """
+    best = None
+    for _ in range(0, n_repeats):
+        start_time = time.perf_counter()
+        for record in records:
+            fun(record)
+        elapsed = time.perf_counter() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(records) / best
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='BENCHMARK TFR ENCODER')
+    parser.add_argument("-n_records", type=int, default=5000)
+    parser.add_argument("-n_images", type=int, default=3)
+    parser.add_argument("-image_kb", type=int, default=40)
+    parser.add_argument("-n_labels", type=int, default=2)
+    parser.add_argument("-n_repeats", type=int, default=3)
+    args = vars(parser.parse_args())
+
+    encoder_decoder = DefaultTFRecordEncoderDecoder()
+    records = create_records(
+        args['n_records'], args['n_images'], args['image_kb'],
+        args['n_labels'])
+
+    identical = all([encoder_decoder.encode_record(x) ==
+                     encoder_decoder._encode_record_proto(x)
+                     for x in records])
+
+    proto_per_s = time_fun(encoder_decoder._encode_record_proto, records,
+                           args['n_repeats'])
+    wire_per_s = time_fun(encoder_decoder.encode_record, records,
+                          args['n_repeats'])
+
+    print("Records: %s Images per record: %s Image size: %s KB Labels: %s" %
+          (args['n_records'], args['n_images'], args['image_kb'],
+           args['n_labels']))
+    print("Identical output: %s" % identical)
+    print("tf.train protos: %.0f records / s" % proto_per_s)
+    print("Wire format:     %.0f records / s" % wire_per_s)
+    print("Speedup:         %.2fx" % (wire_per_s / proto_per_s))
@@ -0,0 +1,105 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image, ImageEnhance
+
+from data.dedup import (
+    ImageHashIndex, find_duplicate_groups, hamming_distance,
+    _near_duplicate_pairs)
+from data.utils import randomly_split_dataset
+from data.inventory import DatasetInventoryMaster
+
+
+class DuplicateDetectionTests(unittest.TestCase):
+    """ Test Exact and Perceptual Duplicate Detection """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        image_dir = './test/test_images/Cats/'
+        self.cat = os.path.join(image_dir, 'cat0.jpg')
+        self.other_cat = os.path.join(image_dir, 'cat10.jpg')
+        # exact copy and a slightly brighter version of the same image
+        self.copy = os.path.join(self.tmp_dir, 'copy.jpg')
+        shutil.copyfile(self.cat, self.copy)
+        self.brighter = os.path.join(self.tmp_dir, 'brighter.jpg')
+        img = Image.open(self.cat)
+        ImageEnhance.Brightness(img).enhance(1.05).save(
+            self.brighter, 'JPEG', quality=80)
+        self.record_images = {
+            'a': [self.cat],
+            'b': [self.copy],
+            'c': [self.brighter],
+            'd': [self.other_cat]}
+        self.all_paths = [x[0] for x in self.record_images.values()]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testExactDuplicates(self):
+        index = ImageHashIndex(os.path.join(self.tmp_dir, 'hashes.sqlite'))
+        hashes = index.get_hashes(self.all_paths, n_processes=1)
+        groups = find_duplicate_groups(self.record_images, hashes)
+        self.assertEqual(groups, [{'record_ids': ['a', 'b'],
+                                   'type': 'exact'}])
+
+    def testPerceptualDuplicates(self):
+        index = ImageHashIndex(os.path.join(self.tmp_dir, 'hashes.sqlite'))
+        hashes = index.get_hashes(
+            self.all_paths, perceptual=True, n_processes=1)
+        groups = find_duplicate_groups(
+            self.record_images, hashes, max_hamming_distance=6)
+        self.assertEqual(groups, [{'record_ids': ['a', 'b', 'c'],
+                                   'type': 'perceptual'}])
+
+    def testHashIndexIsPersistent(self):
+        db_path = os.path.join(self.tmp_dir, 'hashes.sqlite')
+        index = ImageHashIndex(db_path)
+        hashes = index.get_hashes(
+            self.all_paths, perceptual=True, n_processes=1)
+        index.close()
+        index = ImageHashIndex(db_path)
+        self.assertEqual(index._lookup(self.all_paths), hashes)
+        # a modified image is hashed again
+        shutil.copyfile(self.other_cat, self.copy)
+        self.assertNotIn(self.copy, index._lookup(self.all_paths))
+
+    def testNearDuplicatePairsMatchBruteForce(self):
+        random.seed(1)
+        base = random.getrandbits(64)
+        hashes = dict()
+        for i in range(0, 200):
+            value = base
+            for _ in range(0, random.randint(0, 12)):
+                value ^= 1 << random.randint(0, 63)
+            hashes[i] = value
+        for max_distance in [0, 3, 6]:
+            expected = set(
+                (a, b) for a in hashes for b in hashes if a < b and
+                hamming_distance(hashes[a], hashes[b]) <= max_distance)
+            found = set(tuple(sorted(x)) for x in
+                        _near_duplicate_pairs(hashes, max_distance))
+            self.assertEqual(found, expected)
+
+    def testRemoteImagesAreRejected(self):
+        dinv = DatasetInventoryMaster()
+        dinv.create_from_source(
+            'json', {'path': './test/test_files/json_data_file.json'})
+        index = ImageHashIndex(os.path.join(self.tmp_dir, 'hashes.sqlite'))
+        with self.assertRaises(ValueError):
+            dinv.find_duplicates(
+                index, image_root_path='https://images.example.org/')
+        index.close()
+
+    def testSplitKeysKeepGroupsTogether(self):
+        ids = [str(i) for i in range(0, 100)]
+        split_keys = {x: '0' for x in ids[0:20]}
+        splits = randomly_split_dataset(
+            ids, ['train', 'test'], [0.5, 0.5], split_keys=split_keys)
+        self.assertEqual(len(set(splits[x] for x in ids[0:20])), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
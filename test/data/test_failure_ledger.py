@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from data.failure_ledger import (
+    failure_entry, read_failure_ledger, write_failure_ledger,
+    dropped_record_ids)
+
+
+class FailureLedgerTests(unittest.TestCase):
+    """ Test Writing and Reading the Failure Ledger """
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.output_dir, 'failed_images.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def testMissingLedgerIsEmpty(self):
+        self.assertEqual(read_failure_ledger(self.path), [])
+
+    def testWriteAndRead(self):
+        entry = failure_entry('a.jpg', OSError("truncated"), 'decode')
+        entries = [
+            {**entry, 'split': 'train', 'record_id': 'a',
+             'record_dropped': True},
+            {**entry, 'split': 'train', 'record_id': 'b',
+             'record_dropped': False},
+            {**entry, 'split': 'val', 'record_id': 'c',
+             'record_dropped': True}]
+        write_failure_ledger(self.path, entries)
+        read_entries = read_failure_ledger(self.path)
+        self.assertEqual(read_entries, entries)
+        self.assertEqual(read_entries[0]['exception'], 'OSError')
+        self.assertEqual(read_entries[0]['stage'], 'decode')
+        self.assertEqual(dropped_record_ids(read_entries, 'train'), {'a'})
+        self.assertEqual(dropped_record_ids(read_entries, 'test'), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,302 @@
+import io
+import math
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from data.image import (
+    decode_jpeg_scaled, is_jpeg_within_size, resize_jpeg, JPEG_DECODE_RATIOS,
+    random_train_crop_window, decode_and_crop_for_train, preprocess_image,
+    preprocess_for_train)
+from data.tfr_encoder_decoder import DefaultTFRecordEncoderDecoder
+
+
+MIN_SIDE = 100
+
+
+def jpeg_bytes(height, width, image_format='JPEG', mode='RGB'):
+    pixels = np.random.RandomState(height).randint(
+        0, 255, size=(height, width, 3))
+    b = io.BytesIO()
+    Image.fromarray(pixels.astype(np.uint8)).convert(mode).save(
+        b, image_format)
+    return b.getvalue()
+
+
+def threshold_cases():
+    """ (smaller side, expected ratio) just above and below the threshold
+        of each ratio: a JPEG is decoded at 1/r scale if
+        ceil(side / r) >= MIN_SIDE, i.e. side > (MIN_SIDE - 1) * r
+    """
+    cases = list()
+    for i, ratio in enumerate(JPEG_DECODE_RATIOS):
+        next_ratio = JPEG_DECODE_RATIOS[i + 1] \
+            if i + 1 < len(JPEG_DECODE_RATIOS) else 1
+        threshold = (MIN_SIDE - 1) * ratio
+        cases.append((threshold + 1, ratio))
+        cases.append((threshold, next_ratio))
+    return cases
+
+
+@unittest.skipIf(not hasattr(tf, 'Session'), "needs TensorFlow 1.x")
+class ScaledDecodeTests(unittest.TestCase):
+    """ Test the Choice of the JPEG Decode Scale at the Thresholds """
+
+    def setUp(self):
+        tf.reset_default_graph()
+        self.sess = tf.Session()
+
+    def tearDown(self):
+        self.sess.close()
+
+    def assertDecodedAtRatio(self, image, image_bytes, height, width, ratio):
+        expected = self.sess.run(
+            tf.image.decode_jpeg(image_bytes, channels=3, ratio=ratio))
+        self.assertEqual(
+            image.shape,
+            (math.ceil(height / ratio), math.ceil(width / ratio), 3))
+        self.assertGreaterEqual(min(image.shape[0:2]), MIN_SIDE)
+        np.testing.assert_array_equal(image, expected)
+
+    def testThresholdCases(self):
+        self.assertEqual(
+            threshold_cases(),
+            [(793, 8), (792, 4), (397, 4), (396, 2), (199, 2), (198, 1)])
+
+    def testDecodeJpegScaled(self):
+        image_bytes = tf.placeholder(tf.string)
+        decoded = decode_jpeg_scaled(image_bytes, MIN_SIDE)
+        for smaller_side, ratio in threshold_cases():
+            # the smaller side is the height or the width
+            for height, width in [(smaller_side, smaller_side + 37),
+                                  (smaller_side + 37, smaller_side)]:
+                jpeg = jpeg_bytes(height, width)
+                image = self.sess.run(decoded, {image_bytes: jpeg})
+                self.assertDecodedAtRatio(image, jpeg, height, width, ratio)
+
+    def testDecodeJpegScaledPng(self):
+        image_bytes = tf.placeholder(tf.string)
+        decoded = decode_jpeg_scaled(image_bytes, MIN_SIDE)
+        # large enough to be decoded at 1/8 scale if it were a JPEG
+        image = jpeg_bytes(800, 837, 'PNG')
+        expected = np.asarray(Image.open(io.BytesIO(image)))
+        np.testing.assert_array_equal(
+            self.sess.run(decoded, {image_bytes: image}), expected)
+
+    def testDecodeScaledWithStoredAndHeaderSizes(self):
+        image_bytes = tf.placeholder(tf.string)
+        heights = tf.placeholder(tf.int64, [None])
+        widths = tf.placeholder(tf.int64, [None])
+        sequence = {'images': tf.reshape(image_bytes, [1]),
+                    'image_heights': heights, 'image_widths': widths}
+        decoded = DefaultTFRecordEncoderDecoder()._decode_image_scaled(
+            sequence, 0, 1, 3, MIN_SIDE)
+        for smaller_side, ratio in threshold_cases():
+            height, width = smaller_side, smaller_side + 37
+            jpeg = jpeg_bytes(height, width)
+            # sizes stored in the record and read from the JPEG header
+            for sizes in [([height], [width]), ([], [])]:
+                image = self.sess.run(decoded, {
+                    image_bytes: jpeg, heights: sizes[0], widths: sizes[1]})
+                self.assertDecodedAtRatio(image, jpeg, height, width, ratio)
+
+
+# output size and resize range of the training pre-processing
+CROP_ARGS = {'output_height': 32, 'output_width': 24, 'resize_side_min': 40,
+             'resize_side_max': 80}
+
+# (height, width) with extreme aspect ratios
+CROP_IMAGE_SIZES = [(40, 40), (41, 900), (900, 41), (120, 180), (803, 1601)]
+
+
+@unittest.skipIf(not hasattr(tf, 'Session'), "needs TensorFlow 1.x")
+class FusedDecodeCropTests(unittest.TestCase):
+    """ Test the Crop Window and Output of the Fused Decode-and-Crop Path """
+
+    def setUp(self):
+        tf.reset_default_graph()
+        tf.set_random_seed(123)
+        self.sess = tf.Session()
+
+    def tearDown(self):
+        self.sess.close()
+
+    def testWindowIsInsideImage(self):
+        height = tf.placeholder(tf.int32, [])
+        width = tf.placeholder(tf.int32, [])
+        for ignore_aspect_ratio in [False, True]:
+            window = random_train_crop_window(
+                height, width, ignore_aspect_ratio=ignore_aspect_ratio,
+                **CROP_ARGS)
+            for image_height, image_width in CROP_IMAGE_SIZES:
+                for ratio in JPEG_DECODE_RATIOS + [1]:
+                    # the window is sampled on the image decoded at 1/ratio
+                    scaled_height = math.ceil(image_height / ratio)
+                    scaled_width = math.ceil(image_width / ratio)
+                    for _ in range(0, 50):
+                        offset_height, offset_width, crop_height, \
+                            crop_width = self.sess.run(window, {
+                                height: scaled_height, width: scaled_width})
+                        self.assertGreaterEqual(offset_height, 0)
+                        self.assertGreaterEqual(offset_width, 0)
+                        self.assertGreaterEqual(crop_height, 1)
+                        self.assertGreaterEqual(crop_width, 1)
+                        self.assertLessEqual(offset_height + crop_height,
+                                             scaled_height)
+                        self.assertLessEqual(offset_width + crop_width,
+                                             scaled_width)
+
+    def testDecodeAndCropOutputShape(self):
+        image_bytes = tf.placeholder(tf.string)
+        height = tf.placeholder(tf.int32, [])
+        width = tf.placeholder(tf.int32, [])
+        for ignore_aspect_ratio in [False, True]:
+            images = [decode_and_crop_for_train(
+                image_bytes, height, width, ratio=ratio,
+                ignore_aspect_ratio=ignore_aspect_ratio, **CROP_ARGS)
+                for ratio in JPEG_DECODE_RATIOS + [1]]
+            for image_height, image_width in CROP_IMAGE_SIZES:
+                jpeg = jpeg_bytes(image_height, image_width)
+                for _ in range(0, 5):
+                    for image in self.sess.run(images, {
+                            image_bytes: jpeg, height: image_height,
+                            width: image_width}):
+                        self.assertEqual(image.shape, (32, 24, 3))
+
+    def testFusedDecodeCropBranch(self):
+        image_bytes = tf.placeholder(tf.string)
+        heights = tf.placeholder(tf.int64, [None])
+        widths = tf.placeholder(tf.int64, [None])
+        sequence = {'images': tf.reshape(image_bytes, [1]),
+                    'image_heights': heights, 'image_widths': widths}
+        args = {**CROP_ARGS, 'is_training': True}
+        image = DefaultTFRecordEncoderDecoder()._decode_and_preprocess_image(
+            sequence, 0, 1, 3, 40, preprocess_image, args,
+            fused_decode_crop=True)
+        self.assertEqual(image.shape.as_list(), [32, 24, 3])
+        for image_height, image_width in CROP_IMAGE_SIZES:
+            jpeg = jpeg_bytes(image_height, image_width)
+            # cropped from the stored sizes or fully decoded without them
+            for sizes in [([image_height], [image_width]), ([], [])]:
+                output = self.sess.run(image, {
+                    image_bytes: jpeg, heights: sizes[0],
+                    widths: sizes[1]})
+                self.assertEqual(output.shape, (32, 24, 3))
+                self.assertEqual(output.dtype, np.float32)
+
+    def cropsOfPreprocessForTrain(self, image_height, image_width, n):
+        """ Offset and size of the crops of preprocess_for_train relative
+            to the image size, the pixels of the image are their row and
+            column indices
+        """
+        rows, cols = np.mgrid[0:image_height, 0:image_width]
+        pixels = np.stack([rows, cols, np.zeros_like(rows)], axis=-1)
+        image = preprocess_for_train(
+            tf.constant(pixels.astype(np.uint8)), image_means=[0, 0, 0],
+            image_stdevs=[1, 1, 1], color_augmentation=None,
+            ignore_aspect_ratio=False, **CROP_ARGS) * 255.0
+        crops = list()
+        for _ in range(0, n):
+            output = self.sess.run(image)
+            rows, cols = output[:, 0, 0], output[0, :, 1]
+            # the image is flipped at random
+            cols = np.sort(cols)
+            crops.append([
+                rows[0] / image_height, cols[0] / image_width,
+                (rows[-1] - rows[0]) * len(rows) / (len(rows) - 1) /
+                image_height,
+                (cols[-1] - cols[0]) * len(cols) / (len(cols) - 1) /
+                image_width])
+        return np.array(crops)
+
+    def cropsOfWindow(self, image_height, image_width, n):
+        """ Offset and size of the windows of random_train_crop_window
+            relative to the image size
+        """
+        window = random_train_crop_window(
+            image_height, image_width, **CROP_ARGS)
+        crops = np.array([self.sess.run(window) for _ in range(0, n)])
+        return crops / np.array(
+            [image_height, image_width, image_height, image_width])
+
+    def testCropDistributionEqualsPreprocessForTrain(self):
+        image_height, image_width = 120, 180
+        expected = self.cropsOfPreprocessForTrain(
+            image_height, image_width, 2000)
+        crops = self.cropsOfWindow(image_height, image_width, 2000)
+        # offset and size of height and width: mean, std and quantiles
+        np.testing.assert_allclose(
+            crops.mean(axis=0), expected.mean(axis=0), atol=0.025)
+        np.testing.assert_allclose(
+            crops.std(axis=0), expected.std(axis=0), atol=0.02)
+        np.testing.assert_allclose(
+            np.percentile(crops, [10, 50, 90], axis=0),
+            np.percentile(expected, [10, 50, 90], axis=0), atol=0.05)
+        # the crop size is 32x24 pixels of an image resized to 40 to 80
+        # pixels (smaller side)
+        self.assertAlmostEqual(crops[:, 2].min(), 32 / 80, delta=0.02)
+        self.assertAlmostEqual(crops[:, 2].max(), 32 / 40, delta=0.02)
+
+
+class JpegWithinSizeTests(unittest.TestCase):
+    """ Test which Images are Stored without Re-Encoding """
+
+    def testMaxSide(self):
+        image = jpeg_bytes(40, 60)
+        self.assertTrue(is_jpeg_within_size(image))
+        self.assertTrue(is_jpeg_within_size(image, max_side=60))
+        self.assertTrue(is_jpeg_within_size(image, max_side=100))
+        self.assertFalse(is_jpeg_within_size(image, max_side=59))
+        # the larger side counts, also for portrait images
+        self.assertFalse(is_jpeg_within_size(jpeg_bytes(60, 40), max_side=50))
+
+    def testMinSide(self):
+        image = jpeg_bytes(40, 60)
+        self.assertTrue(is_jpeg_within_size(image, min_side=40))
+        self.assertFalse(is_jpeg_within_size(image, min_side=39))
+        # min_side takes precedence over max_side
+        self.assertTrue(is_jpeg_within_size(image, max_side=10, min_side=50))
+
+    def testGrayscaleJpeg(self):
+        image = jpeg_bytes(40, 60, mode='L')
+        self.assertTrue(is_jpeg_within_size(image, max_side=60))
+
+    def testOtherImagesAreRejected(self):
+        for image_format, mode in [('PNG', 'RGB'), ('BMP', 'RGB'),
+                                   ('JPEG', 'CMYK')]:
+            image = jpeg_bytes(40, 60, image_format, mode)
+            self.assertFalse(is_jpeg_within_size(image))
+            self.assertFalse(is_jpeg_within_size(image, max_side=100))
+            self.assertFalse(is_jpeg_within_size(image, min_side=100))
+
+    def testImagePath(self):
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
+            f.write(jpeg_bytes(40, 60))
+            f.flush()
+            self.assertTrue(is_jpeg_within_size(f.name, max_side=60))
+            self.assertFalse(is_jpeg_within_size(f.name, max_side=59))
+
+    def testResizeJpegPassthrough(self):
+        image = jpeg_bytes(40, 60)
+        self.assertEqual(resize_jpeg(image, 60, passthrough=True), image)
+        self.assertEqual(
+            resize_jpeg(image, min_side=40, passthrough=True), image)
+
+    @unittest.skipIf(not hasattr(Image, 'ANTIALIAS'), "needs Pillow < 10")
+    def testResizeJpegReEncodes(self):
+        image = jpeg_bytes(40, 60)
+        self.assertNotEqual(resize_jpeg(image, 60), image)
+        resized = resize_jpeg(image, 30, passthrough=True)
+        with Image.open(io.BytesIO(resized)) as img:
+            self.assertEqual(img.size, (30, 20))
+        png = jpeg_bytes(40, 60, 'PNG')
+        with Image.open(io.BytesIO(
+                resize_jpeg(png, 60, passthrough=True))) as img:
+            self.assertEqual(img.format, 'JPEG')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from data.image_cache import ImageCache
+from data.image import resize_jpeg
+from data.writer import DatasetWriter
+from data.tfr_encoder_decoder import DefaultTFRecordEncoderDecoder
+
+
+class CountingImageCache(ImageCache):
+    """ Image cache that counts the size checks """
+    def __init__(self, *args, **kwargs):
+        super(CountingImageCache, self).__init__(*args, **kwargs)
+        self.n_evict_calls = 0
+
+    def evict(self):
+        self.n_evict_calls += 1
+        super(CountingImageCache, self).evict()
+
+
+class ImageCacheTests(unittest.TestCase):
+    """ Test Keys, Hits and LRU Eviction of the Image Cache """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = ImageCache(os.path.join(self.tmp_dir, 'cache'),
+                                max_size_bytes=1000)
+        self.image_path = os.path.join(self.tmp_dir, 'image.jpg')
+        with open(self.image_path, 'wb') as f:
+            f.write(b'image')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testKeyDependsOnParams(self):
+        key_a = self.cache.key(self.image_path, {'max_side': 500})
+        key_b = self.cache.key(self.image_path, {'max_side': 300})
+        self.assertNotEqual(key_a, key_b)
+        self.assertEqual(key_a, self.cache.key(self.image_path,
+                                               {'max_side': 500}))
+
+    def testKeyDependsOnSourceFile(self):
+        key_a = self.cache.key(self.image_path, {'max_side': 500})
+        with open(self.image_path, 'wb') as f:
+            f.write(b'changed image')
+        key_b = self.cache.key(self.image_path, {'max_side': 500})
+        self.assertNotEqual(key_a, key_b)
+
+    def testGetAndPut(self):
+        key = self.cache.key(self.image_path, {'max_side': 500})
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, b'resized')
+        self.assertEqual(self.cache.get(key), b'resized')
+
+    def testTouchMarksEntryAsUsed(self):
+        self.assertFalse(self.cache.touch('a' * 32))
+        self.cache.put('a' * 32, b'x' * 400)
+        past = time.time() - 100
+        os.utime(self.cache._entry_path('a' * 32), (past, past))
+        self.assertTrue(self.cache.touch('a' * 32))
+        self.assertGreater(
+            os.path.getmtime(self.cache._entry_path('a' * 32)), past + 50)
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        self.cache.put('a' * 32, b'x' * 400)
+        self.cache.put('b' * 32, b'x' * 400)
+        past = time.time() - 100
+        os.utime(self.cache._entry_path('b' * 32), (past, past))
+        os.utime(self.cache._entry_path('a' * 32), (past + 1, past + 1))
+        self.cache.put('c' * 32, b'x' * 400)
+        self.assertIsNone(self.cache.get('b' * 32))
+        self.assertIsNotNone(self.cache.get('a' * 32))
+        self.assertIsNotNone(self.cache.get('c' * 32))
+        self.assertLessEqual(self.cache.size(), 1000)
+
+
+@unittest.skipIf(not hasattr(tf, 'python_io'), "needs TensorFlow 1.x")
+class ImageCacheWriterTests(unittest.TestCase):
+    """ Test the Size of the Cache when Images are processed in Workers """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random_state = np.random.RandomState(123)
+        self.records = dict()
+        for i in range(40):
+            image_path = os.path.join(self.tmp_dir, 'image_%s.jpg' % i)
+            pixels = random_state.randint(0, 255, size=(64, 64, 3))
+            Image.fromarray(pixels.astype(np.uint8)).save(
+                image_path, quality=95)
+            record_id = 'record_%s' % i
+            self.records[record_id] = {
+                'id': record_id, 'n_images': 1, 'n_labels': 1,
+                'image_paths': [image_path], 'meta_data': '',
+                'labelstext': '', 'label/class': ['cat'],
+                'label_num/class': [0]}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testCacheStaysWithinMaxSizeWithProcessPool(self):
+        cache = CountingImageCache(
+            os.path.join(self.tmp_dir, 'cache'), max_size_bytes=20000)
+        output_dir = os.path.join(self.tmp_dir, 'tfr')
+        os.makedirs(output_dir)
+        writer = DatasetWriter(DefaultTFRecordEncoderDecoder().encode_record)
+        writer.encode_to_tfr(
+            self.records, output_dir, 'train',
+            image_pre_processing_fun=resize_jpeg,
+            image_pre_processing_args={'max_side': 48},
+            process_images_in_parallel=True,
+            processes_images_in_parallel_n_processes=2,
+            image_cache=cache)
+        n_bytes_written = writer.stats.counters['image_cache_bytes_written']
+        self.assertGreater(n_bytes_written, 2 * cache.max_size_bytes)
+        # the size is checked while writing, not only at the end
+        self.assertGreater(cache.n_evict_calls, 1)
+        self.assertGreater(cache.size(), 0)
+        self.assertLessEqual(cache.size(), cache.max_size_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from PIL import Image
+
+from data.utils import masked_crc32c
+from data.image import image_dimensions
+from data.manifest import DatasetManifest
+from data.tfr_encoder_decoder import (
+    DefaultTFRecordEncoderDecoder, FlatTFRecordEncoderDecoder,
+    FLAT_EXAMPLE_FORMAT)
+from data.image_size_stats import (
+    ValueDistribution, image_sizes_of_record, image_size_stats_parallel)
+
+
+def frame_record(data):
+    """ TFRecord framing of a serialized record """
+    length = struct.pack('<Q', len(data))
+    return length + struct.pack('<I', masked_crc32c(length)) + \
+        data + struct.pack('<I', masked_crc32c(data))
+
+
+def jpeg_bytes(width, height, mode='RGB'):
+    b = io.BytesIO()
+    Image.new(mode, (width, height)).save(b, 'JPEG')
+    return b.getvalue()
+
+
+def record(record_id, images, store_sizes=True,
+           tfr_encoder=DefaultTFRecordEncoderDecoder()):
+    record_data = {
+        'id': record_id, 'n_images': len(images), 'n_labels': 1,
+        'image_paths': ['%s_%s.jpg' % (record_id, i)
+                        for i in range(0, len(images))],
+        'meta_data': '', 'labelstext': '', 'label/class': ['cat'],
+        'label_num/class': [0], 'images': images}
+    if store_sizes:
+        dimensions = [image_dimensions(x) for x in images]
+        record_data['image_heights'] = [x[0] for x in dimensions]
+        record_data['image_widths'] = [x[1] for x in dimensions]
+        record_data['image_channels'] = [x[2] for x in dimensions]
+        record_data['image_n_bytes'] = [len(x) for x in images]
+    return tfr_encoder.encode_record(record_data)
+
+
+def write_tfr_files(tfr_dir, images, tfr_encoder):
+    """ Write a file with two records with stored sizes and one with a
+        record without
+    """
+    records_a = [record('a', images[0:2], tfr_encoder=tfr_encoder),
+                 record('b', images[2:3], tfr_encoder=tfr_encoder)]
+    records_b = [record('c', images[0:1], store_sizes=False,
+                        tfr_encoder=tfr_encoder)]
+    tfr_paths = list()
+    for name, records in [('a', records_a), ('b', records_b)]:
+        path = os.path.join(tfr_dir, name + '.tfrecord')
+        with open(path, 'wb') as f:
+            f.write(b''.join([frame_record(x) for x in records]))
+        tfr_paths.append(path)
+    return tfr_paths
+
+
+class ImageSizeStatsTests(unittest.TestCase):
+    """ Test Image Size Distributions of TFRecord Files """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.images = [jpeg_bytes(40, 30), jpeg_bytes(20, 60, 'L'),
+                       jpeg_bytes(80, 80)]
+        self.tfr_paths = write_tfr_files(
+            self.tmp_dir, self.images, DefaultTFRecordEncoderDecoder())
+        # flat records in a directory with a manifest
+        flat_dir = os.path.join(self.tmp_dir, 'flat')
+        os.makedirs(flat_dir)
+        DatasetManifest(flat_dir).set_record_format(FLAT_EXAMPLE_FORMAT)
+        self.flat_tfr_paths = write_tfr_files(
+            flat_dir, self.images, FlatTFRecordEncoderDecoder())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testImageDimensions(self):
+        self.assertEqual(image_dimensions(self.images[0]), (30, 40, 3))
+        self.assertEqual(image_dimensions(self.images[1]), (60, 20, 1))
+
+    def testSizesOfRecord(self):
+        sizes, stored = image_sizes_of_record(record('a', self.images[0:2]))
+        self.assertTrue(stored)
+        self.assertEqual(sizes, [(30, 40, 3, len(self.images[0])),
+                                 (60, 20, 1, len(self.images[1]))])
+        # older records without stored sizes - read from the JPEG headers
+        legacy_sizes, stored = image_sizes_of_record(
+            record('a', self.images[0:2], store_sizes=False))
+        self.assertFalse(stored)
+        self.assertEqual(legacy_sizes, sizes)
+
+    def testSizesOfFlatRecord(self):
+        flat = FlatTFRecordEncoderDecoder()
+        sizes, stored = image_sizes_of_record(
+            record('a', self.images[0:2], tfr_encoder=flat),
+            FLAT_EXAMPLE_FORMAT)
+        self.assertTrue(stored)
+        self.assertEqual(sizes, [(30, 40, 3, len(self.images[0])),
+                                 (60, 20, 1, len(self.images[1]))])
+        legacy_sizes, stored = image_sizes_of_record(
+            record('a', self.images[0:2], store_sizes=False,
+                   tfr_encoder=flat),
+            FLAT_EXAMPLE_FORMAT)
+        self.assertFalse(stored)
+        self.assertEqual(legacy_sizes, sizes)
+
+    def testReport(self):
+        for tfr_paths, n_processes in [
+                (self.tfr_paths, 1), (self.tfr_paths, 2),
+                (self.flat_tfr_paths, 1), (self.flat_tfr_paths, 2)]:
+            report = image_size_stats_parallel(
+                tfr_paths, n_processes).report(min_side=30)
+            self.assertEqual(report['n_records'], 3)
+            self.assertEqual(report['n_records_without_stored_sizes'], 1)
+            self.assertEqual(report['min_side']['count'], 4)
+            self.assertEqual(report['min_side']['min'], 20)
+            self.assertEqual(report['max_side']['max'], 80)
+            self.assertEqual(report['n_channels']['counts'],
+                             {'1': 1, '3': 3})
+            self.assertEqual(report['n_images_per_record']['max'], 2)
+            self.assertEqual(report['n_images_below_min_side']['count'], 1)
+
+    def testValueDistribution(self):
+        a = ValueDistribution()
+        b = ValueDistribution()
+        for value in range(1, 51):
+            a.add(value)
+        for value in range(51, 101):
+            b.add(value)
+        a.merge(b)
+        self.assertEqual(a.count, 100)
+        self.assertEqual(a.quantile(0.5), 50)
+        self.assertEqual(a.quantile(0.9), 90)
+        self.assertEqual(a.n_below(11), 10)
+        self.assertEqual(a.to_dict()['mean'], 50.5)
+        self.assertEqual(ValueDistribution().to_dict(), {'count': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from data.input_pipeline import (
+    AUTO, DEFAULT_PIPELINE_SETTINGS, pipeline_setting,
+    resolve_pipeline_settings, reader_arguments, candidate_values,
+    calibrate_pipeline_settings, input_state_path, save_input_state,
+    load_input_state, records_to_skip)
+
+
+class InputPipelineSettingsTests(unittest.TestCase):
+    """ Test Resolving and Calibrating Input Pipeline Settings """
+
+    def testPipelineSetting(self):
+        self.assertEqual(pipeline_setting('8'), 8)
+        self.assertEqual(pipeline_setting('auto'), AUTO)
+        self.assertIsNone(pipeline_setting(None))
+        with self.assertRaises(ValueError):
+            pipeline_setting('-1')
+        with self.assertRaises(ValueError):
+            pipeline_setting('fast')
+
+    def testResolvePriority(self):
+        settings = resolve_pipeline_settings(
+            {'num_parallel_calls': 2},
+            {'num_parallel_calls': 16, 'prefetch_batches': 1},
+            None,
+            {'num_parallel_calls': None, 'interleave_cycle_length': 'auto'})
+        self.assertEqual(settings['num_parallel_calls'], 16)
+        self.assertEqual(settings['prefetch_batches'], 1)
+        self.assertEqual(settings['interleave_cycle_length'], AUTO)
+        self.assertEqual(settings['shuffle_buffer_size'],
+                         DEFAULT_PIPELINE_SETTINGS['shuffle_buffer_size'])
+        self.assertEqual(reader_arguments(settings)['buffer_size'],
+                         settings['shuffle_buffer_size'])
+
+    def testResolveInvalid(self):
+        with self.assertRaises(ValueError):
+            resolve_pipeline_settings({'cycle_length': 4})
+        with self.assertRaises(ValueError):
+            resolve_pipeline_settings({'shuffle_buffer_size': 'auto'})
+
+    def testCandidateValues(self):
+        self.assertEqual(
+            candidate_values('num_parallel_calls', 128, 10, n_cpus=6),
+            [1, 2, 4, 6])
+        self.assertEqual(
+            candidate_values('interleave_cycle_length', 128, 3, n_cpus=64),
+            [1, 2, 3])
+        self.assertEqual(
+            candidate_values('prefetch_records', 128, 3, n_cpus=4),
+            [0, 128, 512])
+
+    def testCalibrate(self):
+        def measure_fun(create_dataset, settings, n_batches):
+            # fastest with 4 parallel calls and 2 prefetched batches
+            return 10 - abs(settings['num_parallel_calls'] - 4) - \
+                abs(settings['prefetch_batches'] - 2)
+
+        settings = resolve_pipeline_settings(
+            {'num_parallel_calls': 'auto', 'prefetch_batches': 'auto',
+             'interleave_cycle_length': 3})
+        calibrated, measurements = calibrate_pipeline_settings(
+            None, settings, 128, 10, n_cpus=8, measure_fun=measure_fun)
+        self.assertEqual(calibrated['num_parallel_calls'], 4)
+        self.assertEqual(calibrated['prefetch_batches'], 2)
+        self.assertEqual(calibrated['interleave_cycle_length'], 3)
+        self.assertEqual(len(measurements), 4 + 4)
+        # nothing to calibrate
+        calibrated, measurements = calibrate_pipeline_settings(
+            None, calibrated, 128, 10, measure_fun=measure_fun)
+        self.assertEqual(measurements, [])
+
+
+class InputStateTests(unittest.TestCase):
+    """ Test Saving and Resuming the Input State """
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.model_path = os.path.join(self.test_dir, 'model_latest.hdf5')
+        self.state = {'seed': 123, 'batch_size': 32, 'epoch_size': 640,
+                      'records_read': 1600, 'epoch': 2}
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def testSaveLoad(self):
+        self.assertIsNone(load_input_state(self.model_path))
+        save_input_state(self.model_path, self.state)
+        self.assertEqual(
+            input_state_path(self.model_path),
+            os.path.join(self.test_dir, 'model_latest.input_state.json'))
+        self.assertEqual(load_input_state(self.model_path), self.state)
+        self.assertEqual(os.listdir(self.test_dir),
+                         ['model_latest.input_state.json'])
+
+    def testRecordsToSkip(self):
+        self.assertEqual(records_to_skip(self.state, 640), 1600)
+        # epoch size changed: continue at the beginning of the epoch
+        self.assertEqual(records_to_skip(self.state, 320), 640)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -59,6 +59,23 @@ class DataInventoryTests(unittest.TestCase):
         self.assertEqual(tfr_dict["label/color_white"], ['0'])
         self.assertEqual(tfr_dict["label/counts"], ['1'])
 
+    def testTFRecordView(self):
+        self.dinv._map_labels_to_numeric()
+        tfrecord_dict = self.dinv.get_tfrecord_dict()
+        view = self.dinv.get_tfrecord_view()
+        self.assertEqual(len(view), len(tfrecord_dict))
+        self.assertEqual(sorted(view.keys()), sorted(tfrecord_dict.keys()))
+        self.assertIn('single_species_standard', view)
+        self.assertNotIn('not_a_record', view)
+        self.assertEqual(view['single_species_standard'],
+                         tfrecord_dict['single_species_standard'])
+        # records are converted on each access
+        view['single_species_standard']['images'] = [b'image']
+        self.assertNotIn('images', view['single_species_standard'])
+        record_ids = sorted(tfrecord_dict.keys(), reverse=True)
+        self.assertEqual(
+            [x[0] for x in self.dinv.iter_tfrecords(record_ids)], record_ids)
+
     def testRemoveMissingLabelRecords(self):
         self.assertIn("missing_counts_label",  self.inventory)
         self.assertIn("counts_is_12",  self.inventory)
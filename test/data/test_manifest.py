@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from data.manifest import DatasetManifest, hash_record_ids, file_md5
+
+
+class DatasetManifestTests(unittest.TestCase):
+    """ Test Tracking of Completed Files """
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.output_dir, 'train_001-of-001.tfrecord')
+        with open(self.file_path, 'wb') as f:
+            f.write(b'0123456789')
+        self.ids_hash = hash_record_ids(['a', 'b', 'c'])
+        manifest = DatasetManifest(self.output_dir)
+        manifest.add_file('train', 'train_001-of-001.tfrecord', {
+            'n_records': 3, 'size': 10, 'md5': file_md5(self.file_path),
+            'record_ids_hash': self.ids_hash})
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def testRecordIdsHashIsOrderIndependent(self):
+        self.assertEqual(self.ids_hash, hash_record_ids(['c', 'a', 'b']))
+        self.assertNotEqual(self.ids_hash, hash_record_ids(['a', 'b']))
+
+    def testCompleteFileIsDetected(self):
+        manifest = DatasetManifest(self.output_dir)
+        self.assertTrue(
+            manifest.is_file_complete('train', self.file_path, self.ids_hash))
+        self.assertTrue(manifest.verify_file('train', self.file_path))
+
+    def testTruncatedFileIsIncomplete(self):
+        with open(self.file_path, 'wb') as f:
+            f.write(b'01234')
+        manifest = DatasetManifest(self.output_dir)
+        self.assertFalse(
+            manifest.is_file_complete('train', self.file_path, self.ids_hash))
+
+    def testCorruptedFileIsIncomplete(self):
+        with open(self.file_path, 'wb') as f:
+            f.write(b'0123456780')
+        manifest = DatasetManifest(self.output_dir)
+        self.assertFalse(
+            manifest.is_file_complete('train', self.file_path, self.ids_hash))
+        self.assertFalse(manifest.verify_file('train', self.file_path))
+
+    def testChangedRecordsAreIncomplete(self):
+        manifest = DatasetManifest(self.output_dir)
+        self.assertFalse(
+            manifest.is_file_complete('train', self.file_path,
+                                      hash_record_ids(['a', 'b'])))
+
+    def testUnknownFileIsIncomplete(self):
+        manifest = DatasetManifest(self.output_dir)
+        self.assertFalse(
+            manifest.is_file_complete('val', self.file_path, self.ids_hash))
+
+    def testSplitIsCompleteWithSameSettings(self):
+        manifest = DatasetManifest(self.output_dir)
+        sharding = {'max_bytes_per_file': 100,
+                    'record_ids_hash': self.ids_hash}
+        self.assertFalse(
+            manifest.is_split_complete('train', self.output_dir, sharding))
+        manifest.update_split(
+            'train', {**sharding, 'file_names': ['train_001-of-001.tfrecord']})
+        manifest = DatasetManifest(self.output_dir)
+        self.assertTrue(
+            manifest.is_split_complete('train', self.output_dir, sharding))
+        self.assertFalse(
+            manifest.is_split_complete(
+                'train', self.output_dir,
+                {**sharding, 'max_bytes_per_file': 200}))
+        with open(self.file_path, 'wb') as f:
+            f.write(b'0123456780')
+        self.assertFalse(
+            manifest.is_split_complete('train', self.output_dir, sharding))
+        os.remove(self.file_path)
+        self.assertFalse(
+            manifest.is_split_complete('train', self.output_dir, sharding))
+
+
+if __name__ == '__main__':
+    unittest.main()
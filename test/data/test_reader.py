@@ -0,0 +1,193 @@
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from data.reader import DatasetReader
+from data.writer import DatasetWriter
+from data.inventory import DatasetInventorySplit
+from data.image import preprocess_image
+from data.tfr_encoder_decoder import (
+    create_tfr_encoder_decoder, SEQUENCE_EXAMPLE_FORMAT, FLAT_EXAMPLE_FORMAT)
+
+
+LABEL_MAPPING = {'species': {'cat': 0, 'dog': 1}}
+
+PRE_PROCESSING = {
+    'output_height': 16, 'output_width': 16, 'resize_side_min': 16,
+    'resize_side_max': 16, 'is_training': False}
+
+# record id: (number of images, species)
+RECORDS = {'r0': (1, 'cat'), 'r1': (3, 'dog'), 'r2': (1, 'dog'),
+           'r3': (3, 'cat')}
+
+
+@unittest.skipIf(not hasattr(tf, 'contrib'), "needs TensorFlow 1.x")
+class MultiImageReaderTests(unittest.TestCase):
+    """ Test Reading Records with Several Images ('expand' and 'stack') """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random_state = np.random.RandomState(123)
+        inventory = dict()
+        for record_id, (n_images, species) in sorted(RECORDS.items()):
+            image_paths = list()
+            for i in range(0, n_images):
+                image_path = os.path.join(
+                    self.tmp_dir, '%s_%s.jpg' % (record_id, i))
+                pixels = random_state.randint(0, 255, size=(24, 32, 3))
+                Image.fromarray(pixels.astype(np.uint8)).save(image_path)
+                image_paths.append(image_path)
+            inventory[record_id] = {
+                'images': image_paths, 'labels': [{'species': species}]}
+        self.split = DatasetInventorySplit(
+            inventory, ['species'], LABEL_MAPPING)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, record_format):
+        """ Write all records to one file, returns the reader """
+        tfr_encoder_decoder = create_tfr_encoder_decoder(record_format)
+        output_dir = os.path.join(self.tmp_dir, record_format)
+        os.makedirs(output_dir)
+        writer = DatasetWriter(tfr_encoder_decoder.encode_record,
+                               record_format)
+        writer.encode_to_tfr(
+            self.split.get_tfrecord_view(), output_dir, 'train',
+            random_shuffle_before_save=False, stats_report_interval=None)
+        self.tfr_files = sorted(glob.glob(output_dir + '/*.tfrecord'))
+        self.tfr_encoder_decoder = tfr_encoder_decoder
+        return DatasetReader(tfr_encoder_decoder.decode_record,
+                             tfr_encoder_decoder)
+
+    def create_dataset(self, reader, multi_image_mode, batch_size=3,
+                       **kwargs):
+        """ Dataset of all records in file order """
+        return reader.get_iterator(
+            self.tfr_files, batch_size, is_train=False, n_repeats=1,
+            output_labels=['species'],
+            label_to_numeric_mapping=LABEL_MAPPING,
+            drop_batch_remainder=False,
+            multi_image_mode=multi_image_mode,
+            image_indices_fun=self.tfr_encoder_decoder.image_indices,
+            **{'image_pre_processing_fun': preprocess_image,
+               'image_pre_processing_args': PRE_PROCESSING, **kwargs})
+
+    def read_all(self, reader, multi_image_mode, batch_size=3, **kwargs):
+        """ Read all batches in file order, returns a list of batches """
+        tf.reset_default_graph()
+        dataset = self.create_dataset(
+            reader, multi_image_mode, batch_size, **kwargs)
+        iterator = dataset.make_initializable_iterator()
+        next_batch = iterator.get_next()
+        batches = list()
+        with tf.Session() as sess:
+            sess.run(tf.tables_initializer())
+            sess.run(iterator.initializer)
+            while True:
+                try:
+                    batches.append(sess.run(next_batch))
+                except tf.errors.OutOfRangeError:
+                    break
+        return batches
+
+    def concat(self, batches, key, features=True):
+        return np.concatenate([x[0 if features else 1][key] for x in batches])
+
+    def checkModes(self, record_format, **kwargs):
+        reader = self.write(record_format)
+        expanded = self.read_all(reader, 'expand', **kwargs)
+        stacked = self.read_all(reader, 'stack')
+
+        # one example per image, the labels of each record are duplicated
+        ids = [x.decode('utf-8') for x in self.concat(expanded, 'id', False)]
+        self.assertEqual(ids, ['r0', 'r1', 'r1', 'r1', 'r2', 'r3', 'r3',
+                               'r3'])
+        self.assertEqual(
+            self.concat(expanded, 'label/species', False).ravel().tolist(),
+            [LABEL_MAPPING['species'][RECORDS[x][1]] for x in ids])
+        expanded_images = self.concat(expanded, 'images')
+        self.assertEqual(expanded_images.shape, (8, 16, 16, 3))
+        self.assertEqual([x[0]['images'].shape[0] for x in expanded],
+                         [3, 3, 2])
+
+        # one example per record, images padded to the most images
+        self.assertEqual(
+            [x[1]['id'].tolist() for x in stacked],
+            [[b'r0', b'r1', b'r2'], [b'r3']])
+        self.assertEqual(stacked[0][0]['images'].shape, (3, 3, 16, 16, 3))
+        self.assertEqual(stacked[1][0]['images'].shape, (1, 3, 16, 16, 3))
+        n_images = self.concat(stacked, 'n_images')
+        self.assertEqual(n_images.tolist(), [1, 3, 1, 3])
+        self.assertEqual(
+            self.concat(stacked, 'label/species', False).ravel().tolist(),
+            [0, 1, 1, 0])
+
+        # the padding is zero, the images are the expanded ones
+        stacked_images = [images[:n] for batch in stacked
+                          for images, n in zip(batch[0]['images'],
+                                               batch[0]['n_images'])]
+        self.assertFalse(stacked[0][0]['images'][0, 1:].any())
+        np.testing.assert_array_equal(
+            np.concatenate(stacked_images), expanded_images)
+
+    def testSequenceExampleRecords(self):
+        self.checkModes(SEQUENCE_EXAMPLE_FORMAT)
+
+    def testFlatExampleRecords(self):
+        self.checkModes(FLAT_EXAMPLE_FORMAT)
+
+    def testFlatExampleRecordsBatchParse(self):
+        self.checkModes(FLAT_EXAMPLE_FORMAT, batch_parse=True)
+
+    def checkBatchParseEqualsRecordParse(self, **kwargs):
+        reader = self.write(FLAT_EXAMPLE_FORMAT)
+        by_record = self.read_all(reader, 'random', **kwargs)
+        by_batch = self.read_all(reader, 'random', batch_parse=True, **kwargs)
+        self.assertEqual(len(by_record), len(by_batch))
+        for (features, labels), (batch_features, batch_labels) in zip(
+                by_record, by_batch):
+            self.assertEqual(batch_labels['id'].tolist(),
+                             labels['id'].tolist())
+            self.assertEqual(batch_labels['label/species'].dtype,
+                             labels['label/species'].dtype)
+            self.assertEqual(batch_labels['label/species'].tolist(),
+                             labels['label/species'].tolist())
+            self.assertEqual(batch_features['images'].shape,
+                             features['images'].shape)
+            self.assertEqual(batch_features['images'].dtype,
+                             features['images'].dtype)
+        ids = self.concat(by_batch, 'id', False).tolist()
+        self.assertEqual(ids, [b'r0', b'r1', b'r2', b'r3'])
+        return by_batch
+
+    def testBatchParseEqualsRecordParse(self):
+        batches = self.checkBatchParseEqualsRecordParse()
+        self.assertEqual(
+            [x[0]['images'].shape for x in batches],
+            [(3, 16, 16, 3), (1, 16, 16, 3)])
+        self.assertEqual(
+            self.concat(batches, 'label/species', False).ravel().tolist(),
+            [0, 1, 1, 0])
+
+    def testBatchParseEqualsRecordParseAllLabels(self):
+        self.checkBatchParseEqualsRecordParse(only_return_one_label=False)
+
+    def testBatchParseNeedsPreProcessing(self):
+        reader = self.write(FLAT_EXAMPLE_FORMAT)
+        tf.reset_default_graph()
+        with self.assertRaises(ValueError):
+            self.create_dataset(
+                reader, 'random', batch_parse=True,
+                image_pre_processing_fun=None,
+                image_pre_processing_args=None)
+
+
+if __name__ == '__main__':
+    unittest.main()
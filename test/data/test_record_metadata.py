@@ -0,0 +1,96 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from data.manifest import DatasetManifest
+from data.record_metadata import (
+    write_metadata, read_metadata, metadata_path, record_metadata)
+from data.tfr_encoder_decoder import (
+    record_format_of_tfr_files, create_tfr_encoder_decoder,
+    DefaultTFRecordEncoderDecoder, FlatTFRecordEncoderDecoder,
+    FLAT_EXAMPLE_FORMAT, SEQUENCE_EXAMPLE_FORMAT, LABEL_MAPPING_FILE_NAME)
+
+
+def tfr_record(record_id):
+    return {
+        'id': record_id, 'n_images': 1, 'n_labels': 1,
+        'image_paths': ['/images/%s.jpg' % record_id],
+        'meta_data': '{"site": "A1"}', 'labelstext': '#species:zebra',
+        'label/species': ['zebra'], 'label_num/species': [3]}
+
+
+class RecordMetadataTests(unittest.TestCase):
+    """ Test Metadata Sidecars and Record Formats of TFRecord Files """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tfr_path = os.path.join(self.tmp_dir, 'train_001-of-001.tfrecord')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testRecordMetadata(self):
+        metadata = record_metadata(tfr_record('a'))
+        self.assertEqual(metadata['labels'], {'species': ['zebra']})
+        self.assertEqual(metadata['image_paths'], ['/images/a.jpg'])
+        self.assertNotIn('label_num/species', metadata)
+
+    def testWriteAndReadMetadata(self):
+        tfrecord_dict = {x: tfr_record(x) for x in ['a', 'b', 'c']}
+        write_metadata(self.tfr_path, tfrecord_dict, ['c', 'a'])
+        self.assertTrue(os.path.exists(metadata_path(self.tfr_path)))
+        with open(metadata_path(self.tfr_path), 'r') as f:
+            self.assertEqual(len(f.readlines()), 2)
+        metadata = read_metadata(self.tfr_path)
+        self.assertEqual(sorted(metadata.keys()), ['a', 'c'])
+        self.assertEqual(metadata['c']['meta_data'], '{"site": "A1"}')
+
+    def testRecordFormatOfTFRFiles(self):
+        # no manifest / no recorded format
+        self.assertEqual(record_format_of_tfr_files([self.tfr_path]),
+                         SEQUENCE_EXAMPLE_FORMAT)
+        DatasetManifest(self.tmp_dir).set_record_format(FLAT_EXAMPLE_FORMAT)
+        self.assertEqual(record_format_of_tfr_files([self.tfr_path]),
+                         FLAT_EXAMPLE_FORMAT)
+        other_dir = tempfile.mkdtemp()
+        try:
+            with self.assertRaises(ValueError):
+                record_format_of_tfr_files(
+                    [self.tfr_path, os.path.join(other_dir, 'a.tfrecord')])
+        finally:
+            shutil.rmtree(other_dir)
+
+    def testCreateEncoderDecoder(self):
+        self.assertIsInstance(
+            create_tfr_encoder_decoder(SEQUENCE_EXAMPLE_FORMAT),
+            DefaultTFRecordEncoderDecoder)
+        flat = create_tfr_encoder_decoder(FLAT_EXAMPLE_FORMAT)
+        self.assertIsInstance(flat, FlatTFRecordEncoderDecoder)
+        self.assertFalse(flat.stores_metadata)
+        with self.assertRaises(ValueError):
+            create_tfr_encoder_decoder('unknown')
+
+
+    def testFlatLabelMappingMustMatchDataset(self):
+        dataset_mapping = {'species': {'elephant': 0, 'zebra': 1},
+                           'count': {'1': 0, '2': 1}}
+        with open(os.path.join(self.tmp_dir, LABEL_MAPPING_FILE_NAME),
+                  'w') as f:
+            json.dump(dataset_mapping, f)
+        flat = FlatTFRecordEncoderDecoder()
+        flat.check_label_mapping(
+            dataset_mapping, ['species', 'count'], [self.tfr_path])
+        merged = {'species': {'elephant': 0, 'zebra': 0},
+                  'count': {'1': 0, '2': 1}}
+        flat.check_label_mapping(merged, ['count'], [self.tfr_path])
+        with self.assertRaises(ValueError):
+            flat.check_label_mapping(merged, ['species'], [self.tfr_path])
+        # string labels can be mapped with any mapping
+        DefaultTFRecordEncoderDecoder().check_label_mapping(
+            merged, ['species'], [self.tfr_path])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from data.remote import (
+    RemoteImageFetcher, HTTPError, is_remote_path, join_url)
+from data.stats import PipelineStats, failed_stage
+from data.image import resize_jpeg
+from data.image_cache import ImageCache
+from data.writer import DatasetWriter
+from data.tfr_encoder_decoder import DefaultTFRecordEncoderDecoder
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _make_handler(server_state):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            with server_state['lock']:
+                server_state['n_requests'] += 1
+                server_state['active'] += 1
+                server_state['max_active'] = max(
+                    server_state['max_active'], server_state['active'])
+                n_failures = server_state['failures'].get(self.path, 0)
+                if n_failures > 0:
+                    server_state['failures'][self.path] = n_failures - 1
+            try:
+                time.sleep(server_state['delay'])
+                if n_failures > 0:
+                    self._send(503, b'unavailable')
+                elif self.path == '/redirect':
+                    self.send_response(302)
+                    self.send_header('Location', '/images/a.jpg')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                elif self.path == '/chunked':
+                    self.send_response(200)
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for chunk in [b'chunk', b'ed body']:
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                    self.wfile.write(b'0\r\n\r\n')
+                elif self.path in server_state['files']:
+                    self._send(200, server_state['files'][self.path])
+                else:
+                    self._send(404, b'not found')
+            finally:
+                with server_state['lock']:
+                    server_state['active'] -= 1
+
+        def _send(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            with server_state['lock']:
+                server_state['n_connections'] += 1
+
+    return Handler
+
+
+def _start_server(files):
+    """ Start an HTTP server that serves 'files' ({path: bytes}), returns
+        the server and its state
+    """
+    state = {
+        'lock': threading.Lock(), 'n_requests': 0, 'n_connections': 0,
+        'active': 0, 'max_active': 0, 'delay': 0.0, 'failures': dict(),
+        'files': files}
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+class EvictingImageCache(ImageCache):
+    """ Image cache whose entries are evicted right after they were found
+        when the writer decided which images to prefetch
+    """
+    def _evict_found(self, key, found):
+        if found:
+            os.remove(self._entry_path(key))
+        return found
+
+    def contains(self, key):
+        return self._evict_found(
+            key, super(EvictingImageCache, self).contains(key))
+
+    def touch(self, key):
+        return self._evict_found(
+            key, super(EvictingImageCache, self).touch(key))
+
+
+class RemoteImageFetcherTests(unittest.TestCase):
+    """ Test Fetching Images from a local HTTP Server """
+
+    def setUp(self):
+        self.server, self.state = _start_server(
+            {'/images/%s.jpg' % x: ('image %s' % x).encode('utf-8')
+             for x in 'abcdefghijklmnop'})
+        self.root_url = 'http://127.0.0.1:%s/images' % \
+            self.server.server_address[1]
+        self.stats = PipelineStats()
+        self.fetcher = RemoteImageFetcher(
+            max_connections=4, max_retries=2, timeout=5, prefetch_size=8,
+            stats=self.stats)
+        self.fetcher.client.backoff = 0.01
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testRemotePaths(self):
+        self.assertTrue(is_remote_path('https://example.com/images'))
+        self.assertFalse(is_remote_path('/data/images'))
+        self.assertFalse(is_remote_path(None))
+        self.assertEqual(
+            join_url('http://host/images/', '/cats/a b.jpg'),
+            'http://host/images/cats/a%20b.jpg')
+
+    def testFetchReusesConnections(self):
+        for _ in range(0, 3):
+            for name in 'abc':
+                self.assertEqual(
+                    self.fetcher.fetch(join_url(self.root_url, name + '.jpg')),
+                    ('image %s' % name).encode('utf-8'))
+        self.assertEqual(self.state['n_requests'], 9)
+        self.assertEqual(self.state['n_connections'], 1)
+        self.assertEqual(self.stats.timings['fetch'].count, 9)
+
+    def testRetryOnServerError(self):
+        self.state['failures']['/images/a.jpg'] = 2
+        self.assertEqual(self.fetcher.fetch(join_url(self.root_url, 'a.jpg')),
+                         b'image a')
+        self.assertEqual(self.state['n_requests'], 3)
+        self.assertEqual(self.stats.counters['fetch_retries'], 2)
+
+    def testNotFoundIsNotRetried(self):
+        with self.assertRaises(HTTPError) as context:
+            self.fetcher.fetch(join_url(self.root_url, 'missing.jpg'))
+        self.assertEqual(context.exception.status, 404)
+        self.assertEqual(failed_stage(context.exception), 'fetch')
+        self.assertEqual(self.state['n_requests'], 1)
+        # errors are sent to worker processes
+        error = pickle.loads(pickle.dumps(context.exception))
+        self.assertEqual(error.status, 404)
+        self.assertEqual(failed_stage(error), 'fetch')
+
+    def testRedirectAndChunkedResponses(self):
+        root = self.root_url.replace('/images', '')
+        self.assertEqual(self.fetcher.fetch(root + '/redirect'), b'image a')
+        self.assertEqual(self.fetcher.fetch(root + '/chunked'),
+                         b'chunked body')
+
+    def testPrefetchKeepsOrderAndLimitsConnections(self):
+        self.state['delay'] = 0.02
+        self.state['failures']['/images/c.jpg'] = 5
+        url_lists = [[join_url(self.root_url, x + '.jpg'),
+                      join_url(self.root_url, 'missing.jpg')]
+                     for x in 'abcdefghijklmnop']
+        results = list(self.fetcher.prefetch(url_lists))
+        self.assertEqual(len(results), len(url_lists))
+        for urls, fetched in zip(url_lists, results):
+            self.assertEqual(set(fetched.keys()), set(urls))
+            self.assertIsInstance(fetched[urls[1]], HTTPError)
+            if urls[0].endswith('c.jpg'):
+                self.assertIsInstance(fetched[urls[0]], HTTPError)
+            else:
+                self.assertEqual(fetched[urls[0]], b'image ' +
+                                 urls[0][-5:-4].encode('utf-8'))
+        self.assertLessEqual(self.state['max_active'], 4)
+        self.assertLessEqual(self.state['n_connections'], 4)
+        self.assertGreater(self.state['max_active'], 1)
+
+
+@unittest.skipIf(not hasattr(tf, 'python_io'), "needs TensorFlow 1.x")
+class RemoteImageWriterTests(unittest.TestCase):
+    """ Test Writing Records with Images from a local HTTP Server """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random_state = np.random.RandomState(123)
+        files = dict()
+        self.records = dict()
+        for i in range(0, 12):
+            pixels = random_state.randint(0, 255, size=(64, 64, 3))
+            b = io.BytesIO()
+            Image.fromarray(pixels.astype(np.uint8)).save(b, 'JPEG')
+            files['/images/image_%s.jpg' % i] = b.getvalue()
+            record_id = 'record_%02d' % i
+            self.records[record_id] = {
+                'id': record_id, 'n_images': 1, 'n_labels': 1,
+                'image_paths': ['image_%s.jpg' % i], 'meta_data': '',
+                'labelstext': '', 'label/class': ['cat'],
+                'label_num/class': [0]}
+        self.server, self.state = _start_server(files)
+        self.root_url = 'http://127.0.0.1:%s/images' % \
+            self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, image_cache, output_name, n_processes=1):
+        output_dir = os.path.join(self.tmp_dir, output_name)
+        os.makedirs(output_dir)
+        writer = DatasetWriter(DefaultTFRecordEncoderDecoder().encode_record)
+        writer.encode_to_tfr(
+            self.records, output_dir, 'train',
+            image_root_path=self.root_url,
+            image_pre_processing_fun=resize_jpeg,
+            image_pre_processing_args={'max_side': 48},
+            process_images_in_parallel=n_processes > 1,
+            processes_images_in_parallel_n_processes=n_processes,
+            image_cache=image_cache, stats_report_interval=None)
+        return writer
+
+    def checkEvictedImagesAreFetched(self, n_processes):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.write(ImageCache(cache_dir), 'first')
+        self.assertEqual(self.state['n_requests'], 12)
+
+        # cached images are not prefetched but evicted before they are read
+        writer = self.write(EvictingImageCache(cache_dir), 'second',
+                            n_processes)
+        self.assertEqual(writer.stats.counters['records_written'], 12)
+        self.assertEqual(writer.stats.counters['images_fetched_late'], 12)
+        self.assertEqual(writer.stats.counters['images_failed'], 0)
+        self.assertEqual(len(writer.failures), 0)
+        self.assertEqual(self.state['n_requests'], 24)
+
+    def testEvictedImagesAreFetchedSerial(self):
+        self.checkEvictedImagesAreFetched(n_processes=1)
+
+    def testEvictedImagesAreFetchedParallel(self):
+        self.checkEvictedImagesAreFetched(n_processes=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
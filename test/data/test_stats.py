@@ -0,0 +1,86 @@
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from data.stats import TimingHistogram, PipelineStats, failed_stage, NO_STATS
+
+
+class TimingHistogramTests(unittest.TestCase):
+    """ Test Timing Histograms """
+
+    def testQuantilesAreBucketUpperBounds(self):
+        histogram = TimingHistogram()
+        for _ in range(0, 90):
+            histogram.add(0.0015)
+        for _ in range(0, 10):
+            histogram.add(0.1)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.002048)
+        self.assertEqual(histogram.quantile(0.99), 0.1)
+        self.assertEqual(histogram.max, 0.1)
+
+    def testMerge(self):
+        a = TimingHistogram()
+        b = TimingHistogram()
+        a.add(0.001)
+        b.add(0.002)
+        b.add(0.0005)
+        a.merge(b)
+        self.assertEqual(a.count, 3)
+        self.assertAlmostEqual(a.total, 0.0035)
+        self.assertEqual(a.min, 0.0005)
+        self.assertEqual(a.max, 0.002)
+        self.assertEqual(sum(a.buckets.values()), 3)
+
+
+class PipelineStatsTests(unittest.TestCase):
+    """ Test Collecting and Reporting Stats """
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def testMergeWorkerStats(self):
+        stats = PipelineStats()
+        worker_stats = PipelineStats()
+        with worker_stats.time('decode'):
+            pass
+        worker_stats.count('bytes_read', 100)
+        # stats are sent from worker processes
+        worker_stats = pickle.loads(pickle.dumps(worker_stats))
+        stats.merge(worker_stats)
+        stats.merge(worker_stats)
+        self.assertEqual(stats.timings['decode'].count, 2)
+        self.assertEqual(stats.counters['bytes_read'], 200)
+
+    def testWriteReport(self):
+        stats = PipelineStats()
+        with stats.time('write'):
+            pass
+        stats.count('records_written', 10)
+        path = os.path.join(self.output_dir, 'stats.json')
+        stats.write_report(path)
+        with open(path, 'r') as f:
+            report = json.load(f)
+        self.assertEqual(report['counters']['records_written'], 10)
+        self.assertEqual(report['stages']['write']['count'], 1)
+        self.assertGreater(report['throughput']['records_per_s'], 0)
+
+    def testExceptionsAreTaggedWithInnermostStage(self):
+        for stats in [PipelineStats(), NO_STATS]:
+            try:
+                with stats.time('image'):
+                    with stats.time('decode'):
+                        raise OSError("truncated image")
+            except OSError as e:
+                self.assertEqual(failed_stage(e, 'unknown'), 'decode')
+        self.assertEqual(failed_stage(ValueError(), 'unknown'), 'unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
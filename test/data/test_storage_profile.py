@@ -0,0 +1,75 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from data.image import resize_jpeg, _min_side_size
+from data.manifest import DatasetManifest
+from data.storage_profile import (
+    required_min_side, create_storage_profile, check_storage_profile,
+    check_tfr_files_storage_profile)
+
+
+RESNET = {'output_height': 224, 'output_width': 224,
+          'resize_side_min': 224, 'resize_side_max': 246}
+
+
+class StorageProfileTests(unittest.TestCase):
+    """ Test Deriving the Size of stored Images from a Model """
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def testRequiredMinSide(self):
+        self.assertEqual(required_min_side(RESNET), 246)
+        self.assertEqual(required_min_side(RESNET, True), 295)
+        profile = create_storage_profile('ResNet18', RESNET)
+        self.assertEqual(profile['min_side'], 246)
+        self.assertEqual(profile['model'], 'ResNet18')
+
+    def testMinSideSize(self):
+        self.assertEqual(_min_side_size((1000, 750), 246), (328, 246))
+        self.assertEqual(_min_side_size((500, 2000), 246), (246, 984))
+        # images are not enlarged
+        self.assertEqual(_min_side_size((300, 200), 246), (300, 200))
+
+    def testResizeJpegMinSide(self):
+        for size in [(1000, 750), (641, 1203)]:
+            b = io.BytesIO()
+            Image.new('RGB', size, (120, 50, 30)).save(b, 'JPEG')
+            resized = Image.open(io.BytesIO(
+                resize_jpeg(b.getvalue(), min_side=246)))
+            self.assertEqual(min(resized.size), 246)
+            self.assertEqual(resized.size, _min_side_size(size, 246))
+
+    def testCheckStorageProfile(self):
+        profile = create_storage_profile('ResNet18', RESNET)
+        self.assertEqual(check_storage_profile(profile, RESNET), [])
+        self.assertEqual(
+            len(check_storage_profile(profile, RESNET, True)), 1)
+        self.assertEqual(
+            check_storage_profile({'max_side': 500}, RESNET), [])
+        self.assertEqual(
+            len(check_storage_profile({'max_side': 200}, RESNET)), 1)
+
+    def testCheckManifestOfTfrFiles(self):
+        tfr_file = os.path.join(self.output_dir, 'train_001-of-001.tfrecord')
+        small_cnn = {'output_height': 50, 'output_width': 50,
+                     'resize_side_min': 50, 'resize_side_max': 55}
+        # no manifest - nothing to check
+        self.assertEqual(
+            check_tfr_files_storage_profile([tfr_file], RESNET), [])
+        DatasetManifest(self.output_dir).set_storage_profile(
+            create_storage_profile('small_cnn', small_cnn))
+        self.assertEqual(
+            len(check_tfr_files_storage_profile([tfr_file], RESNET)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import gzip
+import zlib
+import shutil
+import struct
+import tempfile
+import unittest
+
+import tensorflow as tf
+
+from data.utils import masked_crc32c
+from data.manifest import DatasetManifest
+from data.record_metadata import metadata_path
+from data.tfr_index import (
+    create_index, read_index, write_index, IndexedTFRecordReader)
+from data.tfr_encoder_decoder import (
+    DefaultTFRecordEncoderDecoder, FlatTFRecordEncoderDecoder,
+    FLAT_EXAMPLE_FORMAT)
+
+
+def frame_record(data):
+    """ TFRecord framing of a serialized record """
+    length = struct.pack('<Q', len(data))
+    return length + struct.pack('<I', masked_crc32c(length)) + \
+        data + struct.pack('<I', masked_crc32c(data))
+
+
+def record_id_fun(data):
+    return data.decode('utf-8').split(':')[0]
+
+
+def write_records(tfr_path, record_ids, tfr_encoder):
+    """ Write records with one (fake) image in the format of 'tfr_encoder' """
+    records = [tfr_encoder.encode_record({
+        'id': record_id, 'n_images': 1, 'n_labels': 1,
+        'image_paths': [record_id + '.jpg'], 'meta_data': '',
+        'labelstext': '', 'label/class': ['cat'], 'label_num/class': [0],
+        'images': [record_id.encode('utf-8')]}) for record_id in record_ids]
+    with open(tfr_path, 'wb') as f:
+        f.write(b''.join([frame_record(x) for x in records]))
+
+
+class TFRecordIndexTests(unittest.TestCase):
+    """ Test Record Offset Indexes """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.records = [('id_%s' % i, ('id_%s:' % i + 'x' * i).encode('utf-8'))
+                        for i in range(0, 20)]
+        content = b''.join([frame_record(x[1]) for x in self.records])
+        self.tfr_paths = list()
+        for name, compress in [('plain', lambda x: x),
+                               ('gzip', gzip.compress),
+                               ('zlib', zlib.compress)]:
+            path = os.path.join(self.tmp_dir, name + '.tfrecord')
+            with open(path, 'wb') as f:
+                f.write(compress(content))
+            self.tfr_paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testCreateIndex(self):
+        for tfr_path in self.tfr_paths:
+            self.assertEqual(create_index(tfr_path, record_id_fun), 20)
+            index = read_index(tfr_path)
+            self.assertEqual(index['id_0'], (0, 5))
+            self.assertEqual(index['id_1'], (21, 6))
+            self.assertEqual(len(index), 20)
+
+    def testWriteAndReadIndex(self):
+        write_index(self.tfr_paths[0], [('id\twith tab', 10, 3)])
+        self.assertEqual(read_index(self.tfr_paths[0]),
+                         {'id\twith tab': (10, 3)})
+
+    def testReadRecordsById(self):
+        for tfr_path in self.tfr_paths:
+            create_index(tfr_path, record_id_fun)
+            reader = IndexedTFRecordReader(
+                [tfr_path], decode_fun=lambda x: x, verify_crc=True)
+            records = dict(self.records)
+            ids = ['id_15', 'id_3', 'id_19']
+            self.assertEqual(reader.get_records(ids),
+                             [records[x] for x in ids])
+            self.assertEqual(reader.get_record('id_0'), records['id_0'])
+            self.assertRaises(KeyError, reader.get_record, 'unknown')
+
+    def testStaleIndexIsDetected(self):
+        write_index(self.tfr_paths[0], [('id_1', 0, 6)])
+        reader = IndexedTFRecordReader(
+            [self.tfr_paths[0]], decode_fun=lambda x: x)
+        self.assertRaises(ValueError, reader.get_record, 'id_1')
+
+
+
+class RecordFormatIndexTests(unittest.TestCase):
+    """ Test Indexes of Files in the Supported Record Formats """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.record_ids = ['id_%s' % i for i in range(0, 5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testSequenceExampleRecords(self):
+        tfr_path = os.path.join(self.tmp_dir, 'train.tfrecord')
+        write_records(tfr_path, self.record_ids,
+                      DefaultTFRecordEncoderDecoder())
+        self.assertEqual(create_index(tfr_path), 5)
+        self.assertEqual(sorted(read_index(tfr_path).keys()),
+                         self.record_ids)
+        record = IndexedTFRecordReader([tfr_path]).get_record('id_3')
+        self.assertIsInstance(record, tf.train.SequenceExample)
+        self.assertEqual(
+            record.context.feature['id'].bytes_list.value[0], b'id_3')
+
+    def testFlatExampleRecordsWithManifest(self):
+        tfr_path = os.path.join(self.tmp_dir, 'train.tfrecord')
+        DatasetManifest(self.tmp_dir).set_record_format(FLAT_EXAMPLE_FORMAT)
+        write_records(tfr_path, self.record_ids, FlatTFRecordEncoderDecoder())
+        self.assertEqual(create_index(tfr_path), 5)
+        self.assertEqual(sorted(read_index(tfr_path).keys()),
+                         self.record_ids)
+        record = IndexedTFRecordReader([tfr_path]).get_record('id_3')
+        self.assertIsInstance(record, tf.train.Example)
+        self.assertEqual(
+            record.features.feature['images'].bytes_list.value, [b'id_3'])
+
+    def testFlatExampleRecordsWithMetadataSidecar(self):
+        # files without a manifest, the index is created by the reader
+        tfr_path = os.path.join(self.tmp_dir, 'train.tfrecord')
+        write_records(tfr_path, self.record_ids, FlatTFRecordEncoderDecoder())
+        with open(metadata_path(tfr_path), 'w') as f:
+            f.write('')
+        record = IndexedTFRecordReader([tfr_path]).get_record('id_1')
+        self.assertEqual(
+            record.features.feature['id'].bytes_list.value, [b'id_1'])
+        self.assertEqual(sorted(read_index(tfr_path).keys()),
+                         self.record_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,10 +4,21 @@ from data.utils import (
     assign_hash_to_zero_one,
     calc_n_batches_per_epoch,
     clean_input_path,
-    randomly_split_dataset
+    randomly_split_dataset,
+    crc32c,
+    masked_crc32c,
+    detect_tfr_compression_type,
+    stratified_order,
+    label_histograms,
+    slice_generator
 )
 import random
 import os
+import gzip
+import zlib
+import struct
+import shutil
+import tempfile
 
 
 class RandomSplitterTest(unittest.TestCase):
@@ -146,3 +157,78 @@ class PathCleaningTests(unittest.TestCase):
         """ Check good case """
         self.assertEqual(self.normal_path,
                          clean_input_path(self.no_path_sep_at_end))
+
+
+class TFRecordCompressionTests(unittest.TestCase):
+    """ Test Detection of TFRecord Compression """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        data = b'serialized record'
+        length = struct.pack('<Q', len(data))
+        self.tfrecord = length + \
+            struct.pack('<I', masked_crc32c(length)) + \
+            data + struct.pack('<I', masked_crc32c(data))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def testCrc32c(self):
+        self.assertEqual(crc32c(b'123456789'), 0xE3069283)
+
+    def testDetectCompression(self):
+        self.assertEqual(
+            detect_tfr_compression_type(self._write('a', self.tfrecord)), '')
+        self.assertEqual(
+            detect_tfr_compression_type(
+                self._write('b', gzip.compress(self.tfrecord))), 'GZIP')
+        self.assertEqual(
+            detect_tfr_compression_type(
+                self._write('c', zlib.compress(self.tfrecord))), 'ZLIB')
+        self.assertEqual(
+            detect_tfr_compression_type(self._write('d', b'')), '')
+
+    def testUnknownFormat(self):
+        path = self._write('e', b'not a tfrecord file')
+        self.assertRaises(ValueError, detect_tfr_compression_type, path)
+
+
+class StratifiedOrderTests(unittest.TestCase):
+    """ Test Stratified Assignment of Records to Files """
+
+    def setUp(self):
+        # records sorted by id are grouped by label
+        self.labels = ['elephant'] * 60 + ['zebra'] * 30 + ['lion'] * 10
+        self.ids = ['id_%03d' % i for i in range(0, len(self.labels))]
+        self.tfrecord_dict = {
+            i: {'id': i, 'label/species': [l], 'label/count': ['1']}
+            for i, l in zip(self.ids, self.labels)}
+        self.id_to_label = dict(zip(self.ids, self.labels))
+
+    def testEachSliceIsBalanced(self):
+        order = stratified_order(self.ids, self.id_to_label)
+        self.assertEqual(sorted(order), self.ids)
+        for start, end in slice_generator(len(order), 5):
+            histogram = label_histograms(
+                self.tfrecord_dict, order[start:end])['species']
+            self.assertEqual(sum(histogram.values()), 20)
+            self.assertLessEqual(abs(histogram['elephant'] - 12), 1)
+            self.assertLessEqual(abs(histogram['zebra'] - 6), 1)
+            self.assertLessEqual(abs(histogram['lion'] - 2), 1)
+
+    def testDeterministic(self):
+        shuffled_ids = list(self.ids)
+        random.shuffle(shuffled_ids)
+        self.assertEqual(stratified_order(self.ids, self.id_to_label),
+                         stratified_order(shuffled_ids, self.id_to_label))
+
+    def testLabelHistograms(self):
+        histograms = label_histograms(self.tfrecord_dict, self.ids[55:65])
+        self.assertEqual(histograms, {
+            'species': {'elephant': 5, 'zebra': 5}, 'count': {'1': 10}})
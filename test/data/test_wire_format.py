@@ -0,0 +1,152 @@
+import os
+import random
+import unittest
+
+import tensorflow as tf
+
+from data.tfr_encoder_decoder import (
+    DefaultTFRecordEncoderDecoder, FlatTFRecordEncoderDecoder)
+from data.wire_format import (
+    varint, bytes_feature, int64_feature, feature_list, to_bytes,
+    SequenceExampleEncoder, ExampleEncoder)
+
+
+def create_record(record_id, n_images=2, image_size=1000, labels=None):
+    labels = labels or {'species': ['zebra'], 'count': ['2']}
+    record = {
+        'id': record_id,
+        'n_images': n_images,
+        'n_labels': max([len(x) for x in labels.values()]),
+        'image_paths': ['/images/%s_%s.jpg' % (record_id, i)
+                        for i in range(0, n_images)],
+        'meta_data': '{"site": "A1"}',
+        'labelstext': '#species:zebra',
+        'images': [os.urandom(image_size) for _ in range(0, n_images)]}
+    for label_name, values in labels.items():
+        record['label/' + label_name] = values
+        record['label_num/' + label_name] = [
+            len(x) if x != '-1' else -1 for x in values]
+    return record
+
+
+class WireFormatTests(unittest.TestCase):
+    """ Test Encoding SequenceExamples in the Protobuf Wire Format """
+
+    def setUp(self):
+        self.encoder_decoder = DefaultTFRecordEncoderDecoder()
+
+    def assertSameEncoding(self, record):
+        serialized = self.encoder_decoder.encode_record(record)
+        self.assertEqual(
+            serialized, self.encoder_decoder._encode_record_proto(record))
+        return serialized
+
+    def testVarint(self):
+        for value in [0, 1, 127, 128, 300, 16383, 16384, 2**35, 2**64 - 1]:
+            encoded = varint(value)
+            decoded = sum([(b & 0x7F) << (7 * i)
+                           for i, b in enumerate(encoded)])
+            self.assertEqual(decoded, value)
+            self.assertTrue(all([b & 0x80 for b in encoded[:-1]]))
+            self.assertFalse(encoded[-1] & 0x80)
+
+    def testFeatures(self):
+        self.assertEqual(
+            to_bytes(bytes_feature([b'abc', 'dé'])),
+            tf.train.Feature(bytes_list=tf.train.BytesList(
+                value=[b'abc', 'dé'.encode('utf-8')])).SerializeToString())
+        for values in [[0], [1, -1], [2**62, -2**63], []]:
+            self.assertEqual(
+                to_bytes(int64_feature(values)),
+                tf.train.Feature(int64_list=tf.train.Int64List(
+                    value=values)).SerializeToString())
+        self.assertEqual(
+            to_bytes(feature_list([int64_feature([1]), int64_feature([2])])),
+            tf.train.FeatureList(feature=[
+                tf.train.Feature(int64_list=tf.train.Int64List(value=[x]))
+                for x in [1, 2]]).SerializeToString())
+
+    def testEmptySequenceExample(self):
+        self.assertEqual(
+            SequenceExampleEncoder().encode(dict(), dict()),
+            tf.train.SequenceExample(
+                context=tf.train.Features(),
+                feature_lists=tf.train.FeatureLists()).SerializeToString())
+
+    def testEmptyExample(self):
+        self.assertEqual(
+            ExampleEncoder().encode(dict()),
+            tf.train.Example(
+                features=tf.train.Features()).SerializeToString())
+
+    def testFlatParityWithProtoEncoder(self):
+        encoder_decoder = FlatTFRecordEncoderDecoder()
+        sized = create_record('with_image_sizes', n_images=3)
+        sized.update({'image_heights': [480, 3000, 10],
+                      'image_widths': [640, 4000, 10],
+                      'image_channels': [3, 1, 3],
+                      'image_n_bytes': [1000, 1000, 1000]})
+        records = [
+            create_record('simple'),
+            create_record('no_images', n_images=0),
+            create_record('unicode_é中', labels={
+                'species': ['zébra', 'lion'], 'count': ['1', '-1']}),
+            sized]
+        for record in records:
+            serialized = encoder_decoder.encode_record(record)
+            self.assertEqual(
+                serialized, encoder_decoder._encode_record_proto(record))
+            example = tf.train.Example.FromString(serialized)
+            self.assertEqual(
+                sorted(example.features.feature.keys()),
+                sorted(['id', 'images'] +
+                       [k for k in record.keys() if 'label_num/' in k or
+                        k.startswith('image_') and k != 'image_paths']))
+            self.assertEqual(
+                list(example.features.feature['images'].bytes_list.value),
+                record['images'])
+
+    def testParityWithProtoEncoder(self):
+        records = [
+            create_record('simple'),
+            create_record('one_small_image', n_images=1, image_size=10),
+            create_record('large_images', n_images=3, image_size=300000),
+            create_record('unicode_é中', labels={
+                'species': ['zébra', 'lion'], 'count': ['1', '-1']}),
+            create_record('no_labels', labels={'species': []}),
+            create_record('many_labels', labels={
+                'label_%02d' % i: [str(i) * i] for i in range(0, 30)})]
+        sized = create_record('with_image_sizes')
+        sized.update({'image_heights': [480, 3000],
+                      'image_widths': [640, 4000],
+                      'image_channels': [3, 1],
+                      'image_n_bytes': [1000, 1000]})
+        records.append(sized)
+
+        for record in records:
+            serialized = self.assertSameEncoding(record)
+            example = tf.train.SequenceExample.FromString(serialized)
+            self.assertEqual(
+                example.context.feature['id'].bytes_list.value[0],
+                record['id'].encode('utf-8'))
+            self.assertEqual(
+                [x.bytes_list.value[0] for x in
+                 example.feature_lists.feature_list['images'].feature],
+                record['images'])
+
+    def testRandomRecords(self):
+        rand = random.Random(123)
+        for i in range(0, 50):
+            labels = {
+                'label_%s' % j: [str(rand.randint(-1, 10**6))
+                                 for _ in range(0, rand.randint(1, 3))]
+                for j in range(0, rand.randint(1, 5))}
+            record = create_record(
+                'random_%s' % i, n_images=rand.randint(1, 4),
+                image_size=rand.randint(0, 20000), labels=labels)
+            record['n_labels'] = rand.randint(0, 2**40)
+            self.assertSameEncoding(record)
+
+
+if __name__ == '__main__':
+    unittest.main()
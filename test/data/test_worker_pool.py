@@ -0,0 +1,63 @@
+import os
+import unittest
+
+from data.worker_pool import OrderedProcessPool
+
+
+def _square(x):
+    return x * x
+
+
+def _square_or_crash(x):
+    if x == 7:
+        os._exit(1)
+    return x * x
+
+
+_offset = 0
+
+
+def _set_offset(offset):
+    global _offset
+    _offset = offset
+
+
+def _add_offset_or_crash(x):
+    if x == 3:
+        os._exit(1)
+    return x + _offset
+
+
+class OrderedProcessPoolTests(unittest.TestCase):
+    """ Test Ordered Streaming and Crash Isolation """
+
+    def testResultsInInputOrder(self):
+        with OrderedProcessPool(n_processes=3, max_pending=5) as pool:
+            results = list(pool.imap(_square, range(50)))
+        self.assertEqual(results, [x * x for x in range(50)])
+
+    def testPoolIsReusable(self):
+        with OrderedProcessPool(n_processes=2) as pool:
+            first = list(pool.imap(_square, range(10)))
+            second = list(pool.imap(_square, range(10, 20)))
+        self.assertEqual(first + second, [x * x for x in range(20)])
+
+    def testCrashedWorkerIsIsolated(self):
+        with OrderedProcessPool(n_processes=2, max_pending=4) as pool:
+            results = list(pool.imap(_square_or_crash, range(20),
+                                     crash_result=-1))
+            self.assertEqual(pool.n_crashed, 1)
+        expected = [-1 if x == 7 else x * x for x in range(20)]
+        self.assertEqual(results, expected)
+
+    def testInitializerRunsInRestartedWorkers(self):
+        with OrderedProcessPool(n_processes=2, initializer=_set_offset,
+                                initargs=(100, )) as pool:
+            results = list(pool.imap(_add_offset_or_crash, range(8),
+                                     crash_result=-1))
+        expected = [-1 if x == 3 else x + 100 for x in range(8)]
+        self.assertEqual(results, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
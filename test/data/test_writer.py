@@ -0,0 +1,336 @@
+import io
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from data.writer import DatasetWriter
+from data.image import resize_jpeg
+from data.manifest import MANIFEST_FILE_NAME, file_md5
+from data.tfr_encoder_decoder import DefaultTFRecordEncoderDecoder
+from data.tfr_index import read_index
+from data.utils import stratified_order
+
+
+def create_records(image_dir, n_records, missing_images=()):
+    """ Create records with one generated JPEG each, the images of the
+        records in 'missing_images' are not created
+    """
+    random_state = np.random.RandomState(123)
+    records = dict()
+    for i in range(n_records):
+        record_id = 'record_%02d' % i
+        image_path = os.path.join(image_dir, record_id + '.jpg')
+        if record_id not in missing_images:
+            create_image(image_path, random_state)
+        records[record_id] = {
+            'id': record_id, 'n_images': 1, 'n_labels': 1,
+            'image_paths': [image_path], 'meta_data': '',
+            'labelstext': '', 'label/class': ['cat' if i % 2 else 'dog'],
+            'label_num/class': [i % 2]}
+    return records
+
+
+def create_image(image_path, random_state):
+    pixels = random_state.randint(0, 255, size=(32, 48, 3))
+    Image.fromarray(pixels.astype(np.uint8)).save(image_path)
+
+
+def stored_images_of_file(tfr_path):
+    """ Stored image bytes of each record in a file by record id """
+    images = dict()
+    for serialized in tf.python_io.tf_record_iterator(tfr_path):
+        example = tf.train.SequenceExample.FromString(serialized)
+        record_id = example.context.feature['id'].bytes_list.value[0]
+        images[record_id.decode('utf-8')] = [
+            x.bytes_list.value[0] for x in
+            example.feature_lists.feature_list['images'].feature]
+    return images
+
+
+def record_ids_of_file(tfr_path):
+    return sorted(read_index(tfr_path).keys())
+
+
+def corrupt_file(path, offset=100):
+    """ Change one byte of a file, the size stays the same """
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+
+def n_records_of_file(tfr_path):
+    return sum(1 for _ in tf.python_io.tf_record_iterator(tfr_path))
+
+
+@unittest.skipIf(not hasattr(tf, 'python_io'), "needs TensorFlow 1.x")
+class DatasetWriterTests(unittest.TestCase):
+    """ Test Writing Records to Sharded Files and Resuming """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_dir = os.path.join(self.tmp_dir, 'images')
+        os.makedirs(self.image_dir)
+        self.records = create_records(self.image_dir, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, output_dir, records=None, n_processes=1, **kwargs):
+        os.makedirs(output_dir, exist_ok=True)
+        writer = DatasetWriter(DefaultTFRecordEncoderDecoder().encode_record)
+        writer.encode_to_tfr(
+            records or self.records, output_dir, 'train',
+            process_images_in_parallel=n_processes > 1,
+            processes_images_in_parallel_n_processes=n_processes,
+            stats_report_interval=None, **kwargs)
+        return writer
+
+    def read_manifest(self, output_dir):
+        with open(os.path.join(output_dir, MANIFEST_FILE_NAME)) as f:
+            return json.load(f)
+
+    def assertFilesMatchManifest(self, output_dir, files):
+        manifest_files = self.read_manifest(output_dir)['splits']['train'][
+            'files']
+        self.assertEqual(sorted(manifest_files.keys()),
+                         sorted([os.path.basename(x) for x in files]))
+        for tfr_path in files:
+            file_info = manifest_files[os.path.basename(tfr_path)]
+            self.assertEqual(file_info['n_records'],
+                             n_records_of_file(tfr_path))
+            self.assertEqual(file_info['size'], os.path.getsize(tfr_path))
+            self.assertEqual(file_info['md5'], file_md5(tfr_path))
+
+    def assertSecondRunIsNoOp(self, output_dir, files, **kwargs):
+        mtimes = [os.path.getmtime(x) for x in files]
+        manifest = self.read_manifest(output_dir)
+        writer = self.write(output_dir, overwrite_existing_files=False,
+                            **kwargs)
+        self.assertEqual(writer.stats.counters['records_written'], 0)
+        self.assertEqual(sorted(writer.files['train']), sorted(files))
+        self.assertEqual([os.path.getmtime(x) for x in files], mtimes)
+        self.assertEqual(self.read_manifest(output_dir), manifest)
+
+    def checkCountSharding(self, n_processes):
+        output_dir = os.path.join(self.tmp_dir, 'tfr')
+        writer = self.write(output_dir, n_processes=n_processes,
+                            max_records_per_file=4)
+        files = sorted(writer.files['train'])
+        self.assertEqual(
+            [os.path.basename(x) for x in files],
+            ['train_%03d-of-003.tfrecord' % i for i in range(1, 4)])
+        self.assertEqual([n_records_of_file(x) for x in files], [3, 4, 3])
+        self.assertEqual(
+            [record_ids_of_file(x) for x in files],
+            [sorted(self.records.keys())[start:end]
+             for start, end in [(0, 3), (3, 7), (7, 10)]])
+        self.assertEqual(writer.stats.counters['records_written'], 10)
+        self.assertFilesMatchManifest(output_dir, files)
+        self.assertEqual(
+            self.read_manifest(output_dir)['record_format'],
+            'sequence_example')
+        self.assertSecondRunIsNoOp(output_dir, files, n_processes=n_processes,
+                                   max_records_per_file=4)
+        return files
+
+    def checkByteSharding(self, n_processes):
+        output_dir = os.path.join(self.tmp_dir, 'tfr')
+        writer = self.write(output_dir, n_processes=n_processes,
+                            max_bytes_per_file=15000)
+        files = writer.files['train']
+        self.assertGreater(len(files), 1)
+        self.assertEqual(
+            [os.path.basename(x) for x in files],
+            ['train_%03d-of-%03d.tfrecord' % (i, len(files))
+             for i in range(1, len(files) + 1)])
+        for tfr_path in files[:-1]:
+            self.assertGreaterEqual(os.path.getsize(tfr_path), 15000)
+        self.assertEqual(sum([n_records_of_file(x) for x in files]), 10)
+        self.assertEqual(
+            sorted([y for x in files for y in record_ids_of_file(x)]),
+            sorted(self.records.keys()))
+        self.assertFilesMatchManifest(output_dir, files)
+        split_info = self.read_manifest(output_dir)['splits']['train'][
+            'split']
+        self.assertEqual(split_info['max_bytes_per_file'], 15000)
+        self.assertEqual(split_info['file_names'],
+                         [os.path.basename(x) for x in files])
+        self.assertSecondRunIsNoOp(output_dir, files, n_processes=n_processes,
+                                   max_bytes_per_file=15000)
+        return files
+
+    def testCountShardingSerial(self):
+        self.checkCountSharding(n_processes=1)
+
+    def testCountShardingParallel(self):
+        self.checkCountSharding(n_processes=3)
+
+    def testByteShardingSerial(self):
+        self.checkByteSharding(n_processes=1)
+
+    def testByteShardingParallel(self):
+        self.checkByteSharding(n_processes=3)
+
+    def testParallelFilesEqualSerialFiles(self):
+        serial_dir = os.path.join(self.tmp_dir, 'serial')
+        parallel_dir = os.path.join(self.tmp_dir, 'parallel')
+        serial = self.write(serial_dir, max_records_per_file=4)
+        parallel = self.write(parallel_dir, n_processes=3,
+                              max_records_per_file=4)
+        self.assertEqual(
+            [file_md5(x) for x in sorted(serial.files['train'])],
+            [file_md5(x) for x in sorted(parallel.files['train'])])
+
+    def testCorruptedFileIsRewritten(self):
+        output_dir = os.path.join(self.tmp_dir, 'tfr')
+        writer = self.write(output_dir, max_records_per_file=4)
+        tfr_path = sorted(writer.files['train'])[1]
+        md5 = file_md5(tfr_path)
+        corrupt_file(tfr_path)
+        writer = self.write(output_dir, max_records_per_file=4,
+                            overwrite_existing_files=False)
+        self.assertEqual(writer.stats.counters['records_written'], 4)
+        self.assertEqual(file_md5(tfr_path), md5)
+
+    def testCorruptedByteShardedFileIsRewritten(self):
+        output_dir = os.path.join(self.tmp_dir, 'tfr')
+        writer = self.write(output_dir, max_bytes_per_file=15000)
+        tfr_path = writer.files['train'][0]
+        md5 = file_md5(tfr_path)
+        corrupt_file(tfr_path)
+        writer = self.write(output_dir, max_bytes_per_file=15000,
+                            overwrite_existing_files=False)
+        self.assertEqual(writer.stats.counters['records_written'], 10)
+        self.assertEqual(file_md5(tfr_path), md5)
+
+    def testFileWithAllRecordsInRetryFilesIsWritten(self):
+        output_dir = os.path.join(self.tmp_dir, 'tfr')
+        image_dir = os.path.join(self.tmp_dir, 'retry_images')
+        os.makedirs(image_dir)
+        missing = ['record_04', 'record_05']
+        records = create_records(image_dir, 6, missing_images=missing)
+        self.write(output_dir, records, max_records_per_file=2)
+        last_file = os.path.join(output_dir, 'train_003-of-003.tfrecord')
+        self.assertEqual(n_records_of_file(last_file), 0)
+
+        # write the dropped records to a retry file
+        random_state = np.random.RandomState(1)
+        for record_id in missing:
+            create_image(records[record_id]['image_paths'][0], random_state)
+        writer = self.write(output_dir, records, max_records_per_file=2,
+                            overwrite_existing_files=False,
+                            retry_failed_records=True)
+        self.assertEqual(writer.stats.counters['records_written'], 2)
+
+        # all records of the rewritten file are in the retry file
+        os.remove(last_file)
+        writer = self.write(output_dir, records, max_records_per_file=2,
+                            overwrite_existing_files=False)
+        self.assertEqual(writer.stats.counters['records_written'], 0)
+        self.assertEqual(len(writer.files['train']), 4)
+        for tfr_path in writer.files['train']:
+            self.assertTrue(os.path.exists(tfr_path))
+        self.assertEqual(n_records_of_file(last_file), 0)
+        self.assertEqual(
+            sorted([y for x in writer.files['train']
+                    for y in record_ids_of_file(x)]),
+            sorted(records.keys()))
+        self.assertFilesMatchManifest(output_dir, writer.files['train'])
+
+    def testStratifiedByteSharding(self):
+        image_dir = os.path.join(self.tmp_dir, 'stratified_images')
+        os.makedirs(image_dir)
+        records = create_records(image_dir, 30)
+        for i, record_id in enumerate(sorted(records.keys())):
+            records[record_id]['label/class'] = ['abc'[i % 3]]
+        output_dir = os.path.join(self.tmp_dir, 'tfr')
+        writer = self.write(output_dir, records, max_bytes_per_file=25000,
+                            stratify_by_labels=['class'])
+        files = writer.files['train']
+        self.assertGreater(len(files), 2)
+
+        # each file has about the same share of every label value
+        manifest_files = self.read_manifest(output_dir)['splits']['train'][
+            'files']
+        for tfr_path in files:
+            file_info = manifest_files[os.path.basename(tfr_path)]
+            histogram = file_info['label_histograms']['class']
+            counts = [histogram.get(x, 0) for x in 'abc']
+            self.assertLessEqual(max(counts) - min(counts), 1)
+            self.assertEqual(sum(counts), file_info['n_records'])
+
+        # the files are contiguous parts of the stratified order, the
+        # records are shuffled within each file
+        order = stratified_order(
+            list(records.keys()),
+            {k: v['label/class'][0] for k, v in records.items()})
+        file_record_ids = [list(stored_images_of_file(x).keys())
+                           for x in files]
+        start = 0
+        for tfr_path, record_ids in zip(files, file_record_ids):
+            end = start + len(record_ids)
+            self.assertEqual(sorted(record_ids), sorted(order[start:end]))
+            index = read_index(tfr_path)
+            self.assertEqual(sorted(index, key=index.get), record_ids)
+            start = end
+        self.assertEqual(start, 30)
+        self.assertNotEqual(file_record_ids[0],
+                            order[0:len(file_record_ids[0])])
+        self.assertFilesMatchManifest(output_dir, files)
+        self.assertSecondRunIsNoOp(output_dir, files, records=records,
+                                   max_bytes_per_file=25000,
+                                   stratify_by_labels=['class'])
+
+    def checkJpegPassthrough(self, n_processes):
+        # small JPEG, oversized JPEG, small PNG and small CMYK JPEG
+        random_state = np.random.RandomState(2)
+        records = create_records(self.image_dir, 4)
+        image_paths = [records['record_%02d' % i]['image_paths'][0]
+                       for i in range(4)]
+        for image_path, (height, width), mode, image_format in zip(
+                image_paths, [(32, 48), (80, 120), (32, 48), (32, 48)],
+                ['RGB', 'RGB', 'RGB', 'CMYK'], ['JPEG', 'JPEG', 'PNG', 'JPEG']):
+            pixels = random_state.randint(0, 255, size=(height, width, 3))
+            Image.fromarray(pixels.astype(np.uint8)).convert(mode).save(
+                image_path, image_format)
+        original = dict()
+        for record_id, image_path in zip(sorted(records.keys()), image_paths):
+            with open(image_path, 'rb') as f:
+                original[record_id] = f.read()
+
+        output_dir = os.path.join(self.tmp_dir, 'tfr')
+        writer = self.write(
+            output_dir, records, n_processes=n_processes,
+            image_pre_processing_fun=resize_jpeg,
+            image_pre_processing_args={'max_side': 60},
+            jpeg_passthrough=True)
+        self.assertEqual(writer.stats.counters['images_passthrough'], 1)
+        self.assertEqual(writer.stats.counters['images_reencoded'], 3)
+
+        stored = stored_images_of_file(writer.files['train'][0])
+        self.assertEqual(stored['record_00'], [original['record_00']])
+        for record_id in ['record_01', 'record_02', 'record_03']:
+            self.assertNotEqual(stored[record_id], [original[record_id]])
+            with Image.open(io.BytesIO(stored[record_id][0])) as img:
+                self.assertEqual(img.format, 'JPEG')
+                self.assertLessEqual(max(img.size), 60)
+        with Image.open(io.BytesIO(stored['record_01'][0])) as img:
+            self.assertEqual(img.size, (60, 40))
+
+    def testJpegPassthroughSerial(self):
+        self.checkJpegPassthrough(n_processes=1)
+
+    def testJpegPassthroughParallel(self):
+        self.checkJpegPassthrough(n_processes=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
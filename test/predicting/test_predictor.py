@@ -0,0 +1,67 @@
+import unittest
+
+import numpy as np
+
+try:
+    from predicting.predictor import Predictor
+except ImportError:
+    Predictor = None
+
+
+class StubModel(object):
+    """ Model with two outputs derived from the first pixel of an image """
+    def __init__(self):
+        self.batches = list()
+
+    def predict_on_batch(self, images):
+        self.batches.append(images)
+        return [images[:, 0, 0, 0:2], images[:, 0, 0, 0:1] * 10]
+
+
+@unittest.skipIf(Predictor is None, "needs TensorFlow 1.x")
+class PredictStackedImagesTests(unittest.TestCase):
+    """ Test Averaging the Predictions of the Images of each Record """
+
+    def setUp(self):
+        self.predictor = Predictor.__new__(Predictor)
+        self.predictor.model = StubModel()
+        # pixel values of the images of each record, 0 is padding
+        self.values = [[1, 2, 3], [4], [5, 7]]
+        self.n_images = np.array([3, 1, 2])
+        self.images = np.zeros((3, 3, 2, 2, 3))
+        for i, record_values in enumerate(self.values):
+            for j, value in enumerate(record_values):
+                self.images[i, j] = value
+
+    def testPadding(self):
+        self.predictor._predict_stacked_images(self.images, self.n_images)
+        batches = self.predictor.model.batches
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0].shape, (6, 2, 2, 3))
+        self.assertEqual(batches[0][:, 0, 0, 0].tolist(),
+                         [1, 2, 3, 4, 5, 7])
+
+    def testAveragePerRecord(self):
+        preds_list = self.predictor._predict_stacked_images(
+            self.images, self.n_images)
+        self.assertEqual(len(preds_list), 2)
+        self.assertEqual(preds_list[0].shape, (3, 2))
+        self.assertEqual(preds_list[1].shape, (3, 1))
+        means = [np.mean(x) for x in self.values]
+        np.testing.assert_allclose(
+            preds_list[0], [[x, x] for x in means])
+        np.testing.assert_allclose(
+            preds_list[1], [[x * 10] for x in means])
+
+    def testSingleOutput(self):
+        self.predictor.model.predict_on_batch = \
+            lambda images: images[:, 0, 0, 0:1]
+        preds_list = self.predictor._predict_stacked_images(
+            self.images, self.n_images)
+        self.assertEqual(len(preds_list), 1)
+        np.testing.assert_allclose(
+            preds_list[0], [[np.mean(x)] for x in self.values])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+
+from data.input_pipeline import load_input_state, records_to_skip
+from training.hooks import InputStateTracker, ModelCheckpoint
+
+
+class DummyModel(object):
+    """ Model that records where it was saved """
+    def __init__(self):
+        self.layers = list()
+        self.saved = list()
+
+    def save(self, filepath, overwrite=True):
+        self.saved.append(filepath)
+
+
+class InputStateTester(unittest.TestCase):
+    """ Test Saving the Input State with Model Checkpoints """
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        # continued at the beginning of epoch 1, 3 batches per epoch
+        self.tracker = InputStateTracker(
+            seed=7, batch_size=4, epoch_size=12, skip_records=12)
+        self.model = DummyModel()
+        self.checkpoint = ModelCheckpoint(
+            os.path.join(self.test_dir, 'model_latest.hdf5'),
+            input_state=self.tracker, save_every_n_batches=2)
+        self.checkpoint.model = self.model
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def run_batches(self, epoch, n_batches):
+        for callback in [self.tracker, self.checkpoint]:
+            callback.on_epoch_begin(epoch)
+        for batch in range(0, n_batches):
+            for callback in [self.tracker, self.checkpoint]:
+                callback.on_batch_end(batch)
+
+    def testSaveWithinEpoch(self):
+        self.run_batches(epoch=1, n_batches=2)
+        model_path = os.path.join(self.test_dir, 'model_latest.hdf5')
+        self.assertEqual(self.model.saved, [model_path])
+        state = load_input_state(model_path)
+        self.assertEqual(state, {
+            'seed': 7, 'batch_size': 4, 'epoch_size': 12,
+            'records_read': 20, 'epoch': 1})
+        # continue in epoch 1 after the 2 batches read
+        self.assertEqual(divmod(records_to_skip(state, 12), 12), (1, 8))
+        # the epoch size changed - continue at the beginning of epoch 1
+        self.assertEqual(records_to_skip(state, 16), 16)
+
+    def testSaveAtEpochEnd(self):
+        self.run_batches(epoch=1, n_batches=3)
+        for callback in [self.tracker, self.checkpoint]:
+            callback.on_epoch_end(1)
+        model_path = os.path.join(self.test_dir, 'model_latest.hdf5')
+        self.assertEqual(len(self.model.saved), 2)
+        state = load_input_state(model_path)
+        self.assertEqual(state['records_read'], 24)
+        self.assertEqual(state['epoch'], 2)
+        self.assertEqual(divmod(records_to_skip(state, 12), 12), (2, 0))
@@ -28,6 +28,7 @@ python train.py \
 import argparse
 import logging
 import os
+import random
 
 import tensorflow as tf
 import numpy as np
@@ -37,12 +38,19 @@ from tensorflow.python.keras.callbacks import (
 from config.config import ConfigLoader
 from config.config_logging import setup_logging
 from training.utils import copy_models_and_config_files
-from training.hooks import ModelCheckpoint, TableInitializerCallback
+from training.hooks import (
+    ModelCheckpoint, TableInitializerCallback, InputStateTracker)
 from training.prepare_model import create_model
 from predicting.predictor import Predictor
-from data.tfr_encoder_decoder import DefaultTFRecordEncoderDecoder
-from data.reader import DatasetReader
+from data.tfr_encoder_decoder import tfr_encoder_decoder_of_tfr_files
+from data.input_pipeline import (
+    pipeline_setting, resolve_pipeline_settings, reader_arguments,
+    calibrate_pipeline_settings, load_input_state, records_to_skip)
+from data.reader import (
+    DatasetReader, MULTI_IMAGE_RANDOM, MULTI_IMAGE_EXPAND, MULTI_IMAGE_STACK)
 from data.image import preprocess_image
+from data.storage_profile import (
+    check_tfr_files_storage_profile, required_min_side)
 from data.utils import (
     calc_n_batches_per_epoch, export_dict_to_json, read_json,
     n_records_in_tfr_parallel, find_files_with_ending,
@@ -114,15 +122,51 @@ if __name__ == '__main__':
         "-n_gpus", type=int, default=1,
         help='The number of GPUs to use (default 1)')
     parser.add_argument(
-        "-buffer_size", type=int, default=32768,
+        "-buffer_size", type=int, default=None,
         help='The buffer size to use for shuffling training records. Use \
-              smaller values if memory is limited.')
+              smaller values if memory is limited (default 32768, see \
+              input_pipeline in config/models.yaml).')
+    # Input Pipeline
+    parser.add_argument(
+        "-num_parallel_calls", type=pipeline_setting, default=None,
+        help="Number of records that are decoded and pre-processed in \
+              parallel, or 'auto' to calibrate it (default -n_cpus, see \
+              input_pipeline in config/models.yaml).")
+    parser.add_argument(
+        "-interleave_cycle_length", type=pipeline_setting, default=None,
+        help="Number of TFRecord files read in parallel, or 'auto' \
+              (default 12).")
+    parser.add_argument(
+        "-prefetch_records", type=pipeline_setting, default=None,
+        help="Number of records prefetched before shuffling, or 'auto' \
+              (default batch_size).")
+    parser.add_argument(
+        "-prefetch_batches", type=pipeline_setting, default=None,
+        help="Number of batches prefetched for the model, or 'auto' \
+              (default 1).")
+    parser.add_argument(
+        "-calibration_batches", type=int, default=20,
+        help="Number of batches measured per value of each input pipeline \
+              setting that is 'auto'.")
     parser.add_argument(
         "-max_epochs", type=int, default=70,
         help="The max number of epochs to train the model")
     parser.add_argument(
-        "-starting_epoch", type=int, default=0,
-        help="The starting epoch number (0-based index).")
+        "-starting_epoch", type=int, default=None,
+        help="The starting epoch number (0-based index), default is 0 or \
+              the epoch of the input state of the model to load if \
+              continue_training.")
+    parser.add_argument(
+        "-input_seed", type=int, default=None,
+        help="Seed of the order of the training records (default: the \
+              seed of the input state of the model to load or random if \
+              continue_training or checkpoint_every_n_batches, else the \
+              input is not seeded, which is faster).")
+    parser.add_argument(
+        "-checkpoint_every_n_batches", type=int, default=None,
+        help="Additionally save the model and the input state every n \
+              batches to model_latest.hdf5, such that an interrupted run \
+              can be continued within an epoch with -continue_training.")
     # Model Training Parameters
     parser.add_argument(
         "-initial_learning_rate", type=float, default=0.01,
@@ -175,6 +219,44 @@ if __name__ == '__main__':
               model sees during training and prediction. However, the images \
               are slightly distorted with this option since they are \
               converted to squares.")
+    parser.add_argument(
+        "-min_image_side", type=int, default=None,
+        help="Train only on images whose smaller side has at least that \
+              many pixels, records without such images are skipped \
+              (uses the image sizes stored in the TFRecord files).")
+    parser.add_argument(
+        "-disable_scaled_decode", default=False, action='store_true',
+        help="Always decode images at full size. By default JPEGs are \
+              decoded at 1/2, 1/4 or 1/8 scale if they are still large \
+              enough for the model, which speeds up the input pipeline.")
+    parser.add_argument(
+        "-fused_decode_crop", default=False, action='store_true',
+        help="Sample the random crop of the training augmentation from the \
+              stored image sizes and decode only that region of each JPEG \
+              instead of decoding, resizing and cropping the whole image. \
+              The augmentation is the same, records without stored image \
+              sizes are decoded as usual.")
+    parser.add_argument(
+        "-multi_image_mode", type=str, default=MULTI_IMAGE_RANDOM,
+        choices=[MULTI_IMAGE_RANDOM, MULTI_IMAGE_EXPAND],
+        help="How records with several images are used for training and \
+              validation: 'random' uses one random image per record \
+              (default), 'expand' each image as an example with the \
+              labels of the record (an epoch has one batch per \
+              batch_size images).")
+    parser.add_argument(
+        "-test_multi_image_mode", type=str, default=MULTI_IMAGE_RANDOM,
+        choices=[MULTI_IMAGE_RANDOM, MULTI_IMAGE_STACK],
+        help="How records with several images are predicted on the test \
+              set: 'random' predicts one random image per record \
+              (default), 'stack' all images and averages the predictions \
+              of each record.")
+    parser.add_argument(
+        "-batch_parse", default=False, action='store_true',
+        help="Parse batches of records at once and decode the images of a \
+              batch in parallel instead of processing one record at a \
+              time. Needs TFRecord files with -record_format flat_example \
+              (see create_dataset.py), ignored otherwise.")
 
     # Parse command line arguments
     args = vars(parser.parse_args())
@@ -243,6 +325,11 @@ if __name__ == '__main__':
     else:
         TEST_SET = False
 
+    # Check that the stored images are large enough for the model
+    check_tfr_files_storage_profile(
+        tfr_train + tfr_val + (tfr_test if TEST_SET else []),
+        image_processing, args['ignore_aspect_ratio'])
+
     # Create best model output name
     best_model_save_path = os.path.join(args['model_save_dir'],
                                         'best_model.hdf5')
@@ -257,14 +344,126 @@ if __name__ == '__main__':
                 logging.debug("Loading most recent model file %s:"
                               % most_recent_model)
 
+    # Continue reading the training records where the loaded model stopped
+    input_state = None
+    if args['continue_training'] and args['model_to_load'] is not None:
+        input_state = load_input_state(args['model_to_load'])
+        if input_state is None:
+            logger.warning("No input state found for %s - the training "
+                           "input starts from the beginning" %
+                           args['model_to_load'])
+        else:
+            logger.info("Continuing with input state %s" % input_state)
+
+    # the seeded training input is deterministic but slower, it is only
+    # used if the input state is saved or continued
+    if args['input_seed'] is None and input_state is not None:
+        args['input_seed'] = input_state['seed']
+    if args['input_seed'] is None and \
+       (args['continue_training'] or
+            args['checkpoint_every_n_batches'] is not None):
+        args['input_seed'] = random.randint(0, 2 ** 31 - 1)
+    if args['input_seed'] is not None:
+        logger.info("Seed of the training input: %s" % args['input_seed'])
+    else:
+        logger.info("Training input is not seeded - the input state is "
+                    "not saved with the checkpoints")
+
+    if args['starting_epoch'] is None:
+        if input_state is not None:
+            args['starting_epoch'] = input_state['epoch']
+        else:
+            args['starting_epoch'] = 0
+
     ###########################################
     # CALC IMAGE STATS ###########
     ###########################################
 
-    tfr_encoder_decoder = DefaultTFRecordEncoderDecoder()
+    # decoder of the record format in the dataset manifest
+    tfr_encoder_decoder = tfr_encoder_decoder_of_tfr_files(
+        tfr_train + tfr_val + (tfr_test if TEST_SET else []))
+    tfr_encoder_decoder.check_label_mapping(
+        class_mapping, output_labels,
+        tfr_train + tfr_val + (tfr_test if TEST_SET else []))
+
+    # decode images only as large as the pre-processing needs them
+    if args['disable_scaled_decode']:
+        decode_min_side = None
+    else:
+        decode_min_side = required_min_side(
+            image_processing, args['ignore_aspect_ratio'])
+        logger.info("Decoding images with a smaller side of at least %s" %
+                    decode_min_side)
+
+    if args['min_image_side'] is not None:
+        def train_record_filter(serialized_example):
+            return tfr_encoder_decoder.has_image_with_min_side(
+                serialized_example, args['min_image_side'])
+    else:
+        train_record_filter = None
+
+    # images of the training records (multi image mode 'expand')
+    def train_image_indices(serialized_example):
+        return tfr_encoder_decoder.image_indices(
+            serialized_example, args['min_image_side'])
+
+    if args['batch_parse'] and not tfr_encoder_decoder.supports_batch_parse:
+        logger.warning("Batch parsing is not supported for records in the "
+                       "%s format - parsing one record at a time" %
+                       tfr_encoder_decoder.record_format)
+        args['batch_parse'] = False
 
     logger.info("Create Dataset Reader")
-    data_reader = DatasetReader(tfr_encoder_decoder.decode_record)
+    data_reader = DatasetReader(tfr_encoder_decoder.decode_record,
+                                tfr_encoder_decoder)
+
+    # Input pipeline settings: arguments > model > models.yaml > defaults
+    pipeline_settings = resolve_pipeline_settings(
+        {'num_parallel_calls': args['n_cpus']},
+        model_cfg.cfg.get('input_pipeline'),
+        model_cfg.cfg['models'][args['model']].get('input_pipeline'),
+        {'num_parallel_calls': args['num_parallel_calls'],
+         'interleave_cycle_length': args['interleave_cycle_length'],
+         'prefetch_records': args['prefetch_records'],
+         'prefetch_batches': args['prefetch_batches'],
+         'shuffle_buffer_size': args['buffer_size']})
+
+    def calibration_dataset(settings):
+        # small shuffle buffer to not wait for it to be filled
+        settings = {**settings, 'shuffle_buffer_size': min(
+            settings['shuffle_buffer_size'], 4 * args['batch_size'])}
+        return data_reader.get_iterator(
+                    tfr_files=tfr_train,
+                    batch_size=args['batch_size'],
+                    is_train=True,
+                    n_repeats=None,
+                    output_labels=output_labels,
+                    label_to_numeric_mapping=class_mapping,
+                    image_pre_processing_fun=preprocess_image,
+                    image_pre_processing_args={
+                        **image_processing,
+                        'is_training': True,
+                        'color_augmentation': args['color_augmentation']},
+                    record_filter_fun=train_record_filter,
+                    min_image_side=args['min_image_side'],
+                    decode_min_side=decode_min_side,
+                    fused_decode_crop=args['fused_decode_crop'],
+                    batch_parse=args['batch_parse'],
+                    seed=args['input_seed'],
+                    multi_image_mode=args['multi_image_mode'],
+                    image_indices_fun=train_image_indices,
+                    **reader_arguments(settings))
+
+    pipeline_settings, _ = calibrate_pipeline_settings(
+        calibration_dataset, pipeline_settings, args['batch_size'],
+        len(tfr_train), n_batches=args['calibration_batches'],
+        n_cpus=args['n_cpus'])
+
+    logger.info("Input pipeline settings: %s" % pipeline_settings)
+    export_dict_to_json(
+        pipeline_settings,
+        os.path.join(args['run_outputs_dir'], 'input_pipeline.json'))
+    pipeline_args = reader_arguments(pipeline_settings)
 
     # Calculate Dataset Image Means and Stdevs for a dummy batch
     logger.info("Get Dataset Reader for calculating datset stats")
@@ -279,8 +478,9 @@ if __name__ == '__main__':
             image_pre_processing_fun=preprocess_image,
             image_pre_processing_args={**image_processing,
                                        'is_training': False},
-            buffer_size=args['buffer_size'],
-            num_parallel_calls=args['n_cpus'])
+            **pipeline_args,
+            decode_min_side=decode_min_side,
+            batch_parse=args['batch_parse'])
     iterator = dataset.make_initializable_iterator()
     batch_data = iterator.get_next()
 
@@ -311,7 +511,7 @@ if __name__ == '__main__':
 
     logger.info("Preparing Data Feeders")
 
-    def input_feeder_train():
+    def input_feeder_train(epoch_size, skip_records):
         return data_reader.get_iterator(
                     tfr_files=tfr_train,
                     batch_size=args['batch_size'],
@@ -324,8 +524,17 @@ if __name__ == '__main__':
                         **image_processing,
                         'is_training': True,
                         'color_augmentation': args['color_augmentation']},
-                    buffer_size=args['buffer_size'],
-                    num_parallel_calls=args['n_cpus'])
+                    **pipeline_args,
+                    record_filter_fun=train_record_filter,
+                    min_image_side=args['min_image_side'],
+                    decode_min_side=decode_min_side,
+                    fused_decode_crop=args['fused_decode_crop'],
+                    batch_parse=args['batch_parse'],
+                    seed=args['input_seed'],
+                    epoch_size=epoch_size,
+                    skip_records=skip_records,
+                    multi_image_mode=args['multi_image_mode'],
+                    image_indices_fun=train_image_indices)
 
     def input_feeder_val():
         return data_reader.get_iterator(
@@ -339,8 +548,11 @@ if __name__ == '__main__':
                     image_pre_processing_args={
                         **image_processing,
                         'is_training': False},
-                    buffer_size=args['buffer_size'],
-                    num_parallel_calls=args['n_cpus'])
+                    **pipeline_args,
+                    decode_min_side=decode_min_side,
+                    batch_parse=args['batch_parse'],
+                    multi_image_mode=args['multi_image_mode'],
+                    image_indices_fun=tfr_encoder_decoder.image_indices)
 
     if TEST_SET:
         def input_feeder_test():
@@ -354,9 +566,11 @@ if __name__ == '__main__':
                         image_pre_processing_args={
                             **image_processing,
                             'is_training': False},
-                        buffer_size=args['buffer_size'],
-                        num_parallel_calls=args['n_cpus'],
-                        drop_batch_remainder=False)
+                        **pipeline_args,
+                        drop_batch_remainder=False,
+                        decode_min_side=decode_min_side,
+                        batch_parse=args['batch_parse'],
+                        multi_image_mode=args['test_multi_image_mode'])
 
     # Export Image Processing Settings
     export_dict_to_json({**image_processing,
@@ -365,12 +579,33 @@ if __name__ == '__main__':
                                      'image_processing.json'))
 
     logger.info("Calculating batches per epoch")
+    n_records_val = n_records_in_tfr_parallel(tfr_val, args['n_cpus'])
+
+    # with multi image mode 'expand' each image is an example
+    if args['multi_image_mode'] == MULTI_IMAGE_EXPAND:
+        logger.info("Counting the images of the records")
+        n_examples_train = data_reader.count_examples(
+            tfr_train, record_filter_fun=train_record_filter,
+            image_indices_fun=train_image_indices)
+        n_examples_val = data_reader.count_examples(
+            tfr_val, image_indices_fun=tfr_encoder_decoder.image_indices)
+        logger.info("Images: %s training, %s validation" %
+                    (n_examples_train, n_examples_val))
+    else:
+        n_examples_train = n_records_train
+        n_examples_val = n_records_val
+
     n_batches_per_epoch_train = calc_n_batches_per_epoch(
-        n_records_train, args['batch_size'])
+        n_examples_train, args['batch_size'])
+    n_records_per_epoch_train = n_batches_per_epoch_train * args['batch_size']
+
+    if input_state is not None:
+        skip_records = records_to_skip(input_state, n_records_per_epoch_train)
+    else:
+        skip_records = args['starting_epoch'] * n_records_per_epoch_train
 
-    n_records_val = n_records_in_tfr_parallel(tfr_val, args['n_cpus'])
     n_batches_per_epoch_val = calc_n_batches_per_epoch(
-        n_records_val, args['batch_size'])
+        n_examples_val, args['batch_size'])
 
     if TEST_SET:
         n_records_test = n_records_in_tfr_parallel(tfr_test, args['n_cpus'])
@@ -428,18 +663,38 @@ if __name__ == '__main__':
     csv_logger = CSVLogger(args['run_outputs_dir'] + 'training.log',
                            append=args['continue_training'])
 
+    # track the training records read to save them with the checkpoints
+    if args['input_seed'] is not None:
+        input_state_tracker = InputStateTracker(
+            seed=args['input_seed'],
+            batch_size=args['batch_size'],
+            epoch_size=n_records_per_epoch_train,
+            skip_records=skip_records)
+    else:
+        input_state_tracker = None
+
     # create model checkpoints after each epoch
     checkpointer = ModelCheckpoint(
         filepath=args['run_outputs_dir'] +
         'model_epoch_{epoch:02d}_loss_{val_loss:.2f}.hdf5',
         monitor='val_loss', verbose=0, save_best_only=False,
-        save_weights_only=False, mode='auto', period=1)
+        save_weights_only=False, mode='auto', period=1,
+        input_state=input_state_tracker)
 
     # save best model
     checkpointer_best = ModelCheckpoint(
         filepath=args['run_outputs_dir'] + 'model_best.hdf5',
         monitor='val_loss', verbose=0, save_best_only=True,
-        save_weights_only=False, mode='auto', period=1)
+        save_weights_only=False, mode='auto', period=1,
+        input_state=input_state_tracker)
+
+    # save the latest model within epochs
+    checkpointer_latest = ModelCheckpoint(
+        filepath=args['run_outputs_dir'] + 'model_latest.hdf5',
+        verbose=0, save_best_only=False,
+        save_weights_only=False, mode='auto', period=1,
+        input_state=input_state_tracker,
+        save_every_n_batches=args['checkpoint_every_n_batches'])
 
     # write graph to disk
     tensorboard = TensorBoard(log_dir=args['run_outputs_dir'],
@@ -451,8 +706,13 @@ if __name__ == '__main__':
     # Initialize tables (lookup tables)
     table_init = TableInitializerCallback()
 
-    callbacks_list = [early_stopping, reduce_lr_on_plateau, csv_logger,
-                      checkpointer, checkpointer_best, table_init, tensorboard]
+    callbacks_list = [early_stopping,
+                      reduce_lr_on_plateau, csv_logger, checkpointer,
+                      checkpointer_best, table_init, tensorboard]
+    if input_state_tracker is not None:
+        callbacks_list.insert(0, input_state_tracker)
+    if args['checkpoint_every_n_batches'] is not None:
+        callbacks_list.append(checkpointer_latest)
 
     ###########################################
     # MODEL TRAINING  ###########
@@ -461,7 +721,7 @@ if __name__ == '__main__':
     logger.info("Start Model Training")
 
     history = model.fit(
-        input_feeder_train(),
+        input_feeder_train(n_records_per_epoch_train, skip_records),
         epochs=args['max_epochs'],
         steps_per_epoch=n_batches_per_epoch_train,
         validation_data=input_feeder_val(),
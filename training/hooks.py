@@ -9,6 +9,7 @@ import tensorflow as tf
 from tensorflow.python.keras import backend as K
 from tensorflow.python.keras.callbacks import Callback
 
+from data.input_pipeline import save_input_state
 from training.utils import is_multi_gpu_model, get_gpu_base_model
 
 
@@ -39,11 +40,17 @@ class ModelCheckpoint(Callback):
             saved (`model.save_weights(filepath)`), else the full model
             is saved (`model.save(filepath)`).
         period: Interval (number of epochs) between checkpoints.
+        input_state: InputStateTracker, its state is saved next to
+            each saved model to resume the input when training is
+            continued (see data/input_pipeline.py).
+        save_every_n_batches: additionally save the model every n
+            batches within an epoch (not with `save_best_only`).
     """
 
     def __init__(self, filepath, monitor='val_loss', verbose=0,
                  save_best_only=False, save_weights_only=False,
-                 mode='auto', period=1):
+                 mode='auto', period=1, input_state=None,
+                 save_every_n_batches=None):
         super(ModelCheckpoint, self).__init__()
         self.monitor = monitor
         self.verbose = verbose
@@ -52,6 +59,10 @@ class ModelCheckpoint(Callback):
         self.save_weights_only = save_weights_only
         self.period = period
         self.epochs_since_last_save = 0
+        self.input_state = input_state
+        self.save_every_n_batches = save_every_n_batches
+        self.batches_since_last_save = 0
+        self.epoch = 0
 
         if mode not in ['auto', 'min', 'max']:
             warnings.warn('ModelCheckpoint mode %s is unknown, '
@@ -73,9 +84,7 @@ class ModelCheckpoint(Callback):
                 self.monitor_op = np.less
                 self.best = np.Inf
 
-    def on_epoch_end(self, epoch, logs=None):
-
-        # assign model to save
+    def _assign_model_to_save(self):
         if is_multi_gpu_model(self.model):
             base_model = get_gpu_base_model(self.model)
             self.model_to_save = base_model
@@ -90,6 +99,37 @@ class ModelCheckpoint(Callback):
         else:
             self.model_to_save = self.model
 
+    def _save(self, filepath):
+        if self.save_weights_only:
+            self.model_to_save.save_weights(filepath, overwrite=True)
+        else:
+            self.model_to_save.save(filepath, overwrite=True)
+        if self.input_state is not None:
+            save_input_state(filepath, self.input_state.get_state())
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.batches_since_last_save = 0
+
+    def on_batch_end(self, batch, logs=None):
+        if self.save_every_n_batches is None or self.save_best_only:
+            return
+        self.batches_since_last_save += 1
+        if self.batches_since_last_save >= self.save_every_n_batches:
+            self.batches_since_last_save = 0
+            self._assign_model_to_save()
+            logs = logs or {}
+            filepath = self.filepath.format(epoch=self.epoch + 1, **logs)
+            if self.verbose > 0:
+                print('\nEpoch %05d batch %05d: saving model to %s' %
+                      (self.epoch + 1, batch + 1, filepath))
+            self._save(filepath)
+
+    def on_epoch_end(self, epoch, logs=None):
+
+        # assign model to save
+        self._assign_model_to_save()
+
         logs = logs or {}
         self.epochs_since_last_save += 1
         if self.epochs_since_last_save >= self.period:
@@ -108,10 +148,7 @@ class ModelCheckpoint(Callback):
                                   % (epoch + 1, self.monitor, self.best,
                                      current, filepath))
                         self.best = current
-                        if self.save_weights_only:
-                            self.model_to_save.save_weights(filepath, overwrite=True)
-                        else:
-                            self.model_to_save.save(filepath, overwrite=True)
+                        self._save(filepath)
                     else:
                         if self.verbose > 0:
                             print('\nEpoch %05d: %s did not improve from %0.5f' %
@@ -119,10 +156,44 @@ class ModelCheckpoint(Callback):
             else:
                 if self.verbose > 0:
                     print('\nEpoch %05d: saving model to %s' % (epoch + 1, filepath))
-                if self.save_weights_only:
-                    self.model_to_save.save_weights(filepath, overwrite=True)
-                else:
-                    self.model_to_save.save(filepath, overwrite=True)
+                self._save(filepath)
+
+
+class InputStateTracker(Callback):
+    """ Track how many training records were read, to save the input
+        state with the model checkpoints (must be before the checkpoints
+        in the list of callbacks)
+        Args:
+            seed (int): seed of the training input
+            batch_size (int): number of records per batch
+            epoch_size (int): number of records per epoch
+            skip_records (int): number of records skipped at the start
+                (read before training was continued)
+    """
+    def __init__(self, seed, batch_size, epoch_size, skip_records=0):
+        super(InputStateTracker, self).__init__()
+        self.seed = seed
+        self.batch_size = batch_size
+        self.epoch_size = epoch_size
+        self.records_read = skip_records
+        self.epoch = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        self.records_read += self.batch_size
+
+    def on_epoch_end(self, epoch, logs=None):
+        # checkpoints at the end of an epoch continue with the next one
+        self.epoch = epoch + 1
+
+    def get_state(self):
+        return {'seed': self.seed,
+                'batch_size': self.batch_size,
+                'epoch_size': self.epoch_size,
+                'records_read': self.records_read,
+                'epoch': self.epoch}
 
 
 class ReduceLearningRateOnPlateau(object):